@@ -9,22 +9,24 @@ from fhir.resources.R4B.extension import Extension
 from fhir.resources.R4B.imagingstudy import ImagingStudy, ImagingStudySeries, ImagingStudySeriesInstance
 from fhir.resources.R4B.endpoint import Endpoint
 from typing import Literal
-import base64
 import shutil
 from pathlib import Path
 import threading
 import concurrent.futures
 import psycopg2
 from requests.auth import HTTPBasicAuth
-import time
+import select
 import random
 import string
 from faker import Faker
+from tile_client import TileClient, TileCache, PyramidLevel, QIDO_LEVEL_FIELDS
+from upload_client import upload_file_chunked
 
 FHIR_PORT = 8081
 FHIR_BASE_URL = f"http://localhost:{FHIR_PORT}/fhir"
 FHIR_DOCUMENT_REFERENCE_URL = f"{FHIR_BASE_URL}/DocumentReference"
 FHIR_IMAGING_STUDY_URL = f"{FHIR_BASE_URL}/ImagingStudy"
+UPLOAD_URL = f"http://localhost:{FHIR_PORT}/upload/sessions"
 
 POSTGRES_REST_PORT = 3001
 POSTGRES_REST_BASE_URL = f"http://localhost:{POSTGRES_REST_PORT}"
@@ -34,6 +36,10 @@ USER_PASSWORD = "user"
 
 MAX_TAGS_COUNT = 10
 
+PROP_DB_STATUS_CHANNEL = "conversion_status" # matches channel in converter script change-me
+
+PYRAMID_LEVEL_EXTENSION_URL = "https://localhost:8080/fhir/StructureDefinition/PyramidLevel"
+
 # key: Tarball Name (used to locate file)
 # value: tuple with the folder inside the tarball and the filename. Together they form the path inside the tarball.
 VALID_TARBALLS = {
@@ -119,16 +125,11 @@ def create_tarball(path_to_file: str, filename: str, status_box) -> str:
     status_box.print("Created tarball.")
     return os.path.join(path_to_file, filename + ".tar.gz")
 
-def b_64_encode_file_(filename: str) -> str:
-    with open(filename, "rb") as f:
-        file_as_b64 = base64.b64encode(f.read())
-        file_as_b64_as_str = file_as_b64.decode()
-        return file_as_b64_as_str
-
-def create_document_reference(file_as_b64_as_str: str, path_in_tarball: str, additional_dcm_tags: dict[str, str]) -> DocumentReference:
-    def create_dr_content(file_as_b64_as_str: str) -> DocumentReferenceContent:
+def create_document_reference(upload_url: str, upload_size: int, path_in_tarball: str, additional_dcm_tags: dict[str, str]) -> DocumentReference:
+    def create_dr_content(upload_url: str, upload_size: int) -> DocumentReferenceContent:
+        # the tarball itself was streamed to the server beforehand, only reference it here
         content = DocumentReferenceContent(
-            attachment=Attachment(contentType="application/gzip", data=file_as_b64_as_str),
+            attachment=Attachment(contentType="application/gzip", url=upload_url, size=upload_size),
         )
         return content
     
@@ -147,7 +148,7 @@ def create_document_reference(file_as_b64_as_str: str, path_in_tarball: str, add
 
     dr = DocumentReference(
         status="current",
-        content=[create_dr_content(file_as_b64_as_str)]
+        content=[create_dr_content(upload_url, upload_size)]
     )
     dr.extension = [
         create_path_in_tarball_extension(path_in_tarball),
@@ -182,6 +183,69 @@ def get_sop_instance(series: ImagingStudySeries, instance_number_to_find=0) -> I
                 return instance
     raise RuntimeError(f"no sop instance with number {instance_number_to_find} exists in series!")
 
+def get_pyramid_level_geometry(instance: ImagingStudySeriesInstance) -> dict | None:
+    """
+    Read the pyramid level extension (written by the converter) of a single instance.
+    Returns None if the ImagingStudy was created before the extension existed.
+    """
+    for ext in instance.extension or []:
+        if ext.url == PYRAMID_LEVEL_EXTENSION_URL:
+            geometry = {}
+            for sub_ext in ext.extension or []:
+                for value in (sub_ext.valueInteger, sub_ext.valueDecimal, sub_ext.valueCode):
+                    if value is not None:
+                        geometry[sub_ext.url] = value
+                        break
+            return geometry
+    return None
+
+def wait_for_conversion(business_id: str, status_box, recheck_seconds: int = 60) -> tuple[bool, str]:
+    """
+    Wait until the conversion of the given business ID is done. Instead of polling, the prop database
+    pushes a notification on the `conversion_status` channel once the status changes. The status is
+    still re-checked every `recheck_seconds` in case a notification was missed.
+    """
+    conn = psycopg2.connect(
+        host="localhost", # container name change-me
+        port="5433", # port defined in docker-compose.yml change-me
+        database="prop", # defined in db.sql in prop folder change-me
+        user="postgres", # defined in environment variables for prop-postgres container secret-me
+        password="postgres" # defined in environment variables for prop-postgres container secret-me
+    )
+    conn.set_session(autocommit=True)
+    try:
+        cur = conn.cursor()
+        cur.execute(f"LISTEN {PROP_DB_STATUS_CHANNEL}")
+        status_box.print("Waiting for the conversion to finish...")
+        while True:
+            # check after LISTEN, so a conversion finishing in between is not missed
+            cur.execute("SELECT converted,error_msg FROM data WHERE id=%s::UUID", (business_id,))
+            converted, error_msg = cur.fetchone()
+            if converted or error_msg:
+                return converted, error_msg
+            is_relevant = False
+            while not is_relevant:
+                if select.select([conn], [], [], recheck_seconds) == ([], [], []):
+                    break # timeout, re-check the database
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    is_relevant = is_relevant or json.loads(notify.payload).get("id") == business_id
+    finally:
+        conn.close()
+
+def get_pyramid_levels(series: ImagingStudySeries) -> list[PyramidLevel]:
+    levels = []
+    for instance in series.instance:
+        geometry = get_pyramid_level_geometry(instance)
+        if geometry is not None and geometry.get("role") in ("base", "reduced"):
+            try:
+                levels.append(PyramidLevel.from_geometry(instance.uid, geometry))
+            except ValueError as e:
+                # no tile size in the extension, the level is read from the PACS once it is shown
+                print(e)
+    return levels
+
 def generate_random_dcm_values():
     dcm_tags = ["PatientID", "PatientName", "PatientAge", "PatientBirthDate", "PatientSex"]
     fake = Faker()
@@ -199,6 +263,9 @@ def generate_random_dcm_values():
 selected_folder = ""
 selected_file_name = ""
 access_token = None
+tile_cache = TileCache()
+tile_client = None
+tile_client_series_url = None
 # Run the Event Loop
 while True:
     event, values = window.read()
@@ -254,17 +321,20 @@ while True:
             return dcm_tags
 
 
+        last_printed_percent = -1
+        def _print_upload_progress(done: int, total: int):
+            global last_printed_percent
+            percent = done * 100 // total
+            if percent // 10 != last_printed_percent // 10:
+                window["-STATUS-"].print(f"Uploaded {percent}%")
+                last_printed_percent = percent
+
         print("selected:", selected_file_name)
         print("folder", selected_folder)
         window["-STATUS-"].print("Creating tarball...")
         #thread = threading.Thread(target=create_tarball, args=[selected_folder, selected_file_name, window["-STATUS-"]])
         #thread.start()
         # create_tarball(path_to_file=selected_folder, filename=selected_file_name, status_box=window["-STATUS-"])
-        window["-STATUS-"].print("Creating DocumentReference from given tags...")
-        dr = create_document_reference(file_as_b64_as_str=b_64_encode_file_(os.path.join("example_data", "tarballs", selected_file_name)),
-                                             path_in_tarball="/".join(VALID_TARBALLS[selected_file_name]),
-                                             additional_dcm_tags=_dcm_tags_as_dict(values))
-        window["-STATUS-"].print("Created DocumentReference.")
         window["-STATUS-"].print("Connecting to Keycloak for token...")
         keycloak_openid = KeycloakOpenID(
         server_url="http://localhost:8085",
@@ -283,6 +353,19 @@ while True:
             continue
         access_token = token["access_token"]
         window["-STATUS-"].print("Received new access token.")
+        path_to_tarball = os.path.join("example_data", "tarballs", selected_file_name)
+        window["-STATUS-"].print("Uploading tarball...")
+        try:
+            upload_url = upload_file_chunked(UPLOAD_URL, path_to_tarball, access_token, on_progress=_print_upload_progress)
+        except Exception as e:
+            sg.popup_error_with_traceback("Uploading the tarball failed!", e)
+            continue
+        window["-STATUS-"].print("Creating DocumentReference from given tags...")
+        dr = create_document_reference(upload_url=upload_url,
+                                       upload_size=os.path.getsize(path_to_tarball),
+                                       path_in_tarball="/".join(VALID_TARBALLS[selected_file_name]),
+                                       additional_dcm_tags=_dcm_tags_as_dict(values))
+        window["-STATUS-"].print("Created DocumentReference.")
         header_with_auth = {
             "Accept":"application/fhir+json",
             "Content-Type":"application/fhir+json",
@@ -305,39 +388,15 @@ while True:
         print(business_id)
         window["-STATUS-"].print(f"Sent DocumentReference to {url}.")
         window["-STATUS-"].print(f"Received ID: \"{business_id}\"")
-        while True:
-            window["-STATUS-"].print("Fetching information from db in 5 seconds...")
-            time.sleep(5)
-            try:
-                conn = psycopg2.connect(
-                    host="localhost", # container name change-me
-                    port="5433", # port defined in docker-compose.yml change-me
-                    database="prop", # defined in db.sql in prop folder change-me
-                    user="postgres", # defined in environment variables for prop-postgres container secret-me
-                    password="postgres" # defined in environment variables for prop-postgres container secret-me
-                )
-                cur = conn.cursor()
-                sql = \
-                    """
-                    SELECT converted,error_msg
-                    FROM data
-                    WHERE id=%s::UUID
-                    """
-                cur.execute(sql, (business_id,))
-                converted, error_msg = cur.fetchone()
-                if not converted and (error_msg is None or error_msg) == "":
-                    window["-STATUS-"].print("Not converted yet...")
-                    continue
-                if converted:
-                    window["-STATUS-"].print("Successfully converted to DICOM WSI.")
-                    break
-                else:
-                    window["-STATUS-"].print(f"Error while converting: {error_msg}")
-                    break
-            except Exception as e:
-                print(e)
-                print("error db")
-                break
+        try:
+            converted, error_msg = wait_for_conversion(business_id, window["-STATUS-"])
+            if converted:
+                window["-STATUS-"].print("Successfully converted to DICOM WSI.")
+            else:
+                window["-STATUS-"].print(f"Error while converting: {error_msg}")
+        except Exception as e:
+            print(e)
+            print("error db")
         window["-MANUAL BUSINESS ID-"].update(value=business_id)
         window["-USE BUSINESS ID-"].update(disabled=False)
 
@@ -411,45 +470,56 @@ while True:
 
         series_url = get_address_for(what_for="series", endpoints=imaging_study.contained)
 
-        width_tag = "00480006"
-        height_tag = "00480007"
-        number_of_frames_tag = "00280008"
-        url_to_get_first_instance_sizes = f"{series_url}/instances?SOPInstanceUID={sop_instance.uid}&includefield={width_tag}&includefield={height_tag}&includefield={number_of_frames_tag}"
-        url_to_get_first_instance_sizes = url_to_get_first_instance_sizes.replace("orthanc-pacs", "localhost") # not in container
-        response = requests.get(url=url_to_get_first_instance_sizes, headers={"Authorization": f"Bearer {access_token}"})
-        try:
-            response.raise_for_status()
-        except:
-            print(response.text)
-        return_str = response.json()
-        print(return_str)
-        image_width = return_str[0][width_tag]["Value"][0]
-        image_height = return_str[0][height_tag]["Value"][0]
-        number_of_frames = return_str[0][number_of_frames_tag]["Value"][0]
+        geometry = get_pyramid_level_geometry(sop_instance)
+        instance_level = None
+        if geometry is not None:
+            # the ImagingStudy already contains the sizes, no need to ask the PACS
+            try:
+                instance_level = PyramidLevel.from_geometry(sop_instance.uid, geometry)
+            except (KeyError, ValueError) as e:
+                print(e)
+        if instance_level is None:
+            included_fields = "&".join(f"includefield={tag}" for tag in QIDO_LEVEL_FIELDS)
+            url_to_get_first_instance_sizes = f"{series_url}/instances?SOPInstanceUID={sop_instance.uid}&{included_fields}"
+            url_to_get_first_instance_sizes = url_to_get_first_instance_sizes.replace("orthanc-pacs", "localhost") # not in container
+            response = requests.get(url=url_to_get_first_instance_sizes, headers={"Authorization": f"Bearer {access_token}"})
+            try:
+                response.raise_for_status()
+            except:
+                print(response.text)
+            return_str = response.json()
+            print(return_str)
+            instance_level = PyramidLevel.from_qido(sop_instance.uid, return_str[0])
+        image_width = instance_level.total_columns
+        image_height = instance_level.total_rows
+        number_of_frames = instance_level.number_of_frames
         print(image_width)
         print(image_height)
         print(number_of_frames)
         window["-TOTAL FRAME-"].update(f"/ {number_of_frames}")
-        frame_number = values["-FRAME-"]
-        url_to_rendered_first_instance = f"{series_url}instances/{sop_instance.uid}/frames/{frame_number}/rendered?viewport=,,,,{image_width},{image_height}"
-        # url_to_rendered_first_instance = f"{series_url}instances/{sop_instance.uid}/frames/{frame_number}/rendered"
-        url_to_rendered_first_instance = url_to_rendered_first_instance.replace("orthanc-pacs", "localhost") # not in container
-        print(url_to_rendered_first_instance)
-        headers = {
-            "Accept": "image/png",
-            "Authorization": f"Bearer {access_token}"
-        }
-        response = requests.get(url=url_to_rendered_first_instance, headers=headers, stream=True)
+        frame_number = int(values["-FRAME-"])
+        series_url = series_url.replace("orthanc-pacs", "localhost") # not in container
+        if tile_client is None or tile_client_series_url != series_url:
+            if tile_client is not None:
+                tile_client.close()
+            tile_client = TileClient(series_url=series_url, access_token=access_token, levels=get_pyramid_levels(series), cache=tile_cache)
+            tile_client_series_url = series_url
+        else:
+            tile_client.set_access_token(access_token)
         try:
-            response.raise_for_status()
+            level = tile_client.level_by_uid(sop_instance.uid)
+        except KeyError:
+            # ImagingStudy without pyramid level extension (or a label/overview image)
+            level = instance_level
+        try:
+            tile = tile_client.get_tile(level, frame_number)
         except Exception as e:
             print("error while get")
-            print(response.status_code)
-            print(response.text)
             sg.popup_error_with_traceback(f"Malformed input sent to the DICOMweb server!", e)
-        rendered_image_filename = os.path.join("fetched_images", sop_instance.uid.replace(".", "_") + ".png")
-        with open(rendered_image_filename, "wb") as file:
-            # response.raw.decode_content = False
-            file.write(response.content)
-        window["-IMAGE-"].update(filename=rendered_image_filename)
+            continue
+        window["-IMAGE-"].update(data=tile)
+        if level in tile_client.levels:
+            tile_client.prefetch_around(level, frame_number)
+if tile_client is not None:
+    tile_client.close()
 window.close()
\ No newline at end of file
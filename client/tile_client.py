@@ -0,0 +1,410 @@
+import io
+import os
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_CACHE_DIR = "fetched_images"
+DEFAULT_MEMORY_CACHE_TILES = 512
+DEFAULT_DISK_CACHE_BYTES = 512 * 1024 * 1024
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MAX_FRAMES_PER_REQUEST = 32
+
+# request the frames as stored in the PACS (no transcoding), every frame is one part of the multipart response
+MULTI_FRAME_ACCEPT_HEADER = 'multipart/related; type="application/octet-stream"; transfer-syntax=*'
+# transfer syntaxes where a frame is plain pixel data without any header
+UNCOMPRESSED_TRANSFER_SYNTAXES = ("1.2.840.10008.1.2", "1.2.840.10008.1.2.1")
+# TotalPixelMatrixColumns, TotalPixelMatrixRows, Columns, Rows and NumberOfFrames, see `PyramidLevel.from_qido`
+QIDO_LEVEL_FIELDS = ("00480006", "00480007", "00280011", "00280010", "00280008")
+
+
+class PyramidLevel:
+    """
+    Geometry of a single pyramid level (DICOM instance), as found in the PyramidLevel extension of the ImagingStudy.
+    """
+    def __init__(self, uid: str, total_columns: int, total_rows: int, tile_columns: int, tile_rows: int, number_of_frames: int) -> None:
+        self.uid = uid
+        self.total_columns = total_columns
+        self.total_rows = total_rows
+        self.tile_columns = tile_columns
+        self.tile_rows = tile_rows
+        self.number_of_frames = number_of_frames
+
+    @staticmethod
+    def from_geometry(uid: str, geometry: dict) -> "PyramidLevel":
+        """
+        :raises ValueError: If the level has multiple frames but the extension has no tile size, use `from_qido` then.
+        """
+        number_of_frames = geometry.get("numberOfFrames", 1)
+        if number_of_frames > 1 and ("tileColumns" not in geometry or "tileRows" not in geometry):
+            raise ValueError(f"pyramid level {uid} has {number_of_frames} frames but no tile size!")
+        return PyramidLevel(
+            uid=uid,
+            total_columns=geometry["totalPixelMatrixColumns"],
+            total_rows=geometry["totalPixelMatrixRows"],
+            # a single frame covers the whole image
+            tile_columns=geometry.get("tileColumns", geometry["totalPixelMatrixColumns"]),
+            tile_rows=geometry.get("tileRows", geometry["totalPixelMatrixRows"]),
+            number_of_frames=number_of_frames
+        )
+
+    @staticmethod
+    def from_qido(uid: str, attributes: dict) -> "PyramidLevel":
+        """
+        :param attributes: A single instance of a QIDO-RS response (DICOM JSON) including the `QIDO_LEVEL_FIELDS`.
+        """
+        def value(tag: str) -> int | None:
+            values = attributes.get(tag, {}).get("Value")
+            return int(values[0]) if values else None
+        tile_columns, tile_rows = value("00280011"), value("00280010")
+        if tile_columns is None or tile_rows is None:
+            raise ValueError(f"QIDO-RS response for {uid} has no Columns/Rows!")
+        return PyramidLevel(
+            uid=uid,
+            # instances which are not tiled (e.g. a label) have no total pixel matrix, their only frame is the image
+            total_columns=value("00480006") or tile_columns,
+            total_rows=value("00480007") or tile_rows,
+            tile_columns=tile_columns,
+            tile_rows=tile_rows,
+            number_of_frames=value("00280008") or 1
+        )
+
+    @property
+    def tiles_across(self) -> int:
+        return -(-self.total_columns // self.tile_columns) # ceil division
+
+    @property
+    def tiles_down(self) -> int:
+        return -(-self.total_rows // self.tile_rows)
+
+    def frame_to_position(self, frame_number: int) -> tuple[int, int]:
+        """
+        Frames are numbered starting with 1 in row-major order (TILED_FULL). Returns (column, row) of the tile.
+        """
+        index = frame_number - 1
+        return index % self.tiles_across, index // self.tiles_across
+
+    def position_to_frame(self, column: int, row: int) -> int | None:
+        if column < 0 or row < 0 or column >= self.tiles_across or row >= self.tiles_down:
+            return None
+        frame_number = row * self.tiles_across + column + 1
+        return frame_number if frame_number <= self.number_of_frames else None
+
+
+class TileCache:
+    """
+    Two tier tile cache: a bounded in-memory LRU in front of a bounded directory on disk.
+    All methods are thread safe.
+    """
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_memory_tiles: int = DEFAULT_MEMORY_CACHE_TILES, max_disk_bytes: int = DEFAULT_DISK_CACHE_BYTES) -> None:
+        self._cache_dir = Path(cache_dir)
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        self._max_memory_tiles = max_memory_tiles
+        self._max_disk_bytes = max_disk_bytes
+        self._memory: OrderedDict[tuple[str, int], bytes] = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = sum(f.stat().st_size for f in self._cache_dir.glob("*.png"))
+
+    def path_for(self, uid: str, frame_number: int) -> str:
+        return os.path.join(self._cache_dir, f"{uid.replace('.', '_')}_{frame_number}.png")
+
+    def get(self, uid: str, frame_number: int) -> bytes | None:
+        key = (uid, frame_number)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        path = self.path_for(uid, frame_number)
+        try:
+            with open(path, "rb") as f:
+                tile = f.read()
+            os.utime(path) # mark as recently used for the disk eviction
+        except FileNotFoundError:
+            return None
+        self._put_in_memory(key, tile)
+        return tile
+
+    def put(self, uid: str, frame_number: int, tile: bytes) -> None:
+        self._put_in_memory((uid, frame_number), tile)
+        path = self.path_for(uid, frame_number)
+        if os.path.exists(path):
+            return
+        tmp_path = f"{path}.{threading.get_ident()}.part"
+        with open(tmp_path, "wb") as f:
+            f.write(tile)
+        os.replace(tmp_path, path) # atomic, so concurrent readers never see half written tiles
+        with self._lock:
+            self._disk_bytes += len(tile)
+            over_limit = self._disk_bytes > self._max_disk_bytes
+        if over_limit:
+            self._evict_from_disk()
+
+    def _put_in_memory(self, key: tuple[str, int], tile: bytes) -> None:
+        with self._lock:
+            self._memory[key] = tile
+            self._memory.move_to_end(key)
+            while len(self._memory) > self._max_memory_tiles:
+                self._memory.popitem(last=False)
+
+    def _evict_from_disk(self) -> None:
+        files = sorted(self._cache_dir.glob("*.png"), key=lambda f: f.stat().st_mtime)
+        with self._lock:
+            target = self._max_disk_bytes * 0.9 # evict a bit more to not evict on every put
+            for f in files:
+                if self._disk_bytes <= target:
+                    break
+                try:
+                    size = f.stat().st_size
+                    f.unlink()
+                    self._disk_bytes -= size
+                except FileNotFoundError:
+                    pass
+
+
+class TileClient:
+    """
+    Fetches frames (tiles) from a DICOMweb (WADO-RS) series endpoint.
+
+    - A single keep-alive session with a connection pool is reused for all requests.
+    - Missing tiles of the same level are coalesced into multi-frame requests, which are sent in parallel
+      on a bounded thread pool; concurrent requests for the same tile are merged.
+    - Fetched tiles are stored in a `TileCache`, so already seen tiles are never fetched twice.
+    - `prefetch_around` fetches the neighbouring tiles and the tiles of the next (finer) zoom level in the background.
+    """
+    def __init__(self, series_url: str, access_token: str, levels: list[PyramidLevel], cache: TileCache | None = None, max_workers: int = DEFAULT_MAX_WORKERS, max_frames_per_request: int = DEFAULT_MAX_FRAMES_PER_REQUEST) -> None:
+        """
+        :param series_url: The WADO-RS series url (ends with "/series/<SeriesInstanceUID>/").
+        :param access_token: The bearer token used for all requests.
+        :param levels: The pyramid levels of the series. They will be sorted from the coarsest to the finest level.
+        :param cache: The cache to use. A new one in `fetched_images/` is created if not given.
+        :param max_workers: Maximum amount of parallel requests.
+        :param max_frames_per_request: Maximum amount of frames fetched with a single multi-frame request.
+        """
+        self._series_url = series_url if series_url.endswith("/") else series_url + "/"
+        self.levels = sorted(levels, key=lambda level: level.total_columns)
+        self.cache = cache if cache is not None else TileCache()
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self.set_access_token(access_token)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tile-fetch")
+        self._in_flight: dict[tuple[str, int], concurrent.futures.Future] = {}
+        self._in_flight_lock = threading.Lock()
+        self._max_frames_per_request = max_frames_per_request
+
+    def set_access_token(self, access_token: str) -> None:
+        self._session.headers.update({"Authorization": f"Bearer {access_token}"})
+
+    def level_by_uid(self, uid: str) -> PyramidLevel:
+        for level in self.levels:
+            if level.uid == uid:
+                return level
+        raise KeyError(f"no pyramid level with uid {uid}!")
+
+    def get_tile(self, level: PyramidLevel, frame_number: int) -> bytes:
+        """
+        Get a single tile, blocking until it is available. Cached tiles are returned immediately.
+        """
+        return self.get_tiles(level, [frame_number])[frame_number]
+
+    def get_tiles(self, level: PyramidLevel, frame_numbers: Iterable[int]) -> dict[int, bytes]:
+        """
+        Get multiple tiles of the same level (e.g. all tiles in the viewport), blocking until all are available.
+        Missing tiles are fetched with as few (batched) requests as possible.
+        """
+        futures = self.fetch_tiles_async(level, frame_numbers)
+        return {frame_number: future.result() for frame_number, future in futures.items()}
+
+    def fetch_tile_async(self, level: PyramidLevel, frame_number: int) -> concurrent.futures.Future:
+        return self.fetch_tiles_async(level, [frame_number])[frame_number]
+
+    def fetch_tiles_async(self, level: PyramidLevel, frame_numbers: Iterable[int]) -> dict[int, concurrent.futures.Future]:
+        """
+        Schedule fetching tiles of a single level on the thread pool. Tiles which are neither cached nor
+        already being fetched are coalesced into multi-frame WADO-RS requests (`frames/1,2,3`) of at most
+        `max_frames_per_request` frames each. Every tile gets its own future, which is resolved as soon as
+        its part of the multipart response was received.
+        """
+        futures: dict[int, concurrent.futures.Future] = {}
+        to_request: list[int] = []
+        for frame_number in frame_numbers:
+            tile = self.cache.get(level.uid, frame_number)
+            if tile is not None:
+                futures[frame_number] = concurrent.futures.Future()
+                futures[frame_number].set_result(tile)
+                continue
+            key = (level.uid, frame_number)
+            with self._in_flight_lock:
+                future = self._in_flight.get(key)
+                if future is None:
+                    future = concurrent.futures.Future()
+                    self._in_flight[key] = future
+                    to_request.append(frame_number)
+            futures[frame_number] = future
+        to_request.sort()
+        for i in range(0, len(to_request), self._max_frames_per_request):
+            batch = to_request[i:i + self._max_frames_per_request]
+            self._executor.submit(self._fetch_batch_and_cache, level, batch)
+        return futures
+
+    def prefetch_around(self, level: PyramidLevel, frame_number: int, radius: int = 1) -> list[concurrent.futures.Future]:
+        """
+        Prefetch the tiles surrounding the given tile on the same level and the tiles covering
+        the same area on the next finer level (the most likely next zoom step).
+        """
+        column, row = level.frame_to_position(frame_number)
+        to_fetch: list[tuple[PyramidLevel, int]] = []
+        for d_row in range(-radius, radius + 1):
+            for d_column in range(-radius, radius + 1):
+                neighbour = level.position_to_frame(column + d_column, row + d_row)
+                if neighbour is not None and neighbour != frame_number:
+                    to_fetch.append((level, neighbour))
+        finer_level = self._next_finer_level(level)
+        if finer_level is not None:
+            to_fetch.extend((finer_level, frame) for frame in self._covering_frames(level, column, row, finer_level))
+        frames_per_level: dict[str, list[int]] = {}
+        for lvl, frame in to_fetch:
+            frames_per_level.setdefault(lvl.uid, []).append(frame)
+        futures = []
+        for uid, frames in frames_per_level.items():
+            futures.extend(self.fetch_tiles_async(self.level_by_uid(uid), frames).values())
+        return futures
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._session.close()
+
+    def _next_finer_level(self, level: PyramidLevel) -> PyramidLevel | None:
+        index = self.levels.index(level)
+        return self.levels[index + 1] if index + 1 < len(self.levels) else None
+
+    @staticmethod
+    def _covering_frames(level: PyramidLevel, column: int, row: int, finer_level: PyramidLevel) -> list[int]:
+        """
+        The frames on `finer_level` which cover the same image area as the tile (column, row) on `level`.
+        """
+        scale_x = finer_level.total_columns / level.total_columns
+        scale_y = finer_level.total_rows / level.total_rows
+        x_start = int(column * level.tile_columns * scale_x) // finer_level.tile_columns
+        x_end = int(((column + 1) * level.tile_columns * scale_x) - 1) // finer_level.tile_columns
+        y_start = int(row * level.tile_rows * scale_y) // finer_level.tile_rows
+        y_end = int(((row + 1) * level.tile_rows * scale_y) - 1) // finer_level.tile_rows
+        frames = []
+        for finer_row in range(y_start, y_end + 1):
+            for finer_column in range(x_start, x_end + 1):
+                frame = finer_level.position_to_frame(finer_column, finer_row)
+                if frame is not None:
+                    frames.append(frame)
+        return frames
+
+    def _fetch_batch_and_cache(self, level: PyramidLevel, frame_numbers: list[int]) -> None:
+        url = f"{self._series_url}instances/{level.uid}/frames/{','.join(str(frame_number) for frame_number in frame_numbers)}"
+        remaining = list(frame_numbers)
+        try:
+            with self._session.get(url=url, headers={"Accept": MULTI_FRAME_ACCEPT_HEADER}, stream=True) as response:
+                response.raise_for_status()
+                boundary = _get_content_type_parameter(response.headers.get("Content-Type", ""), "boundary")
+                if boundary is None:
+                    raise RuntimeError(f"response for {url} is not a multipart response!")
+                # the frames are returned in the requested order
+                for headers, body in iter_multipart_parts(response.iter_content(chunk_size=64 * 1024), boundary):
+                    frame_number = remaining[0]
+                    tile = _frame_to_png(body, headers.get("content-type", ""), level)
+                    self.cache.put(level.uid, frame_number, tile)
+                    remaining.pop(0)
+                    self._resolve((level.uid, frame_number), result=tile)
+            if remaining:
+                raise RuntimeError(f"PACS returned fewer frames than requested for {url}!")
+        except Exception as e:
+            for frame_number in remaining:
+                self._resolve((level.uid, frame_number), exception=e)
+
+    def _resolve(self, key: tuple[str, int], result: bytes | None = None, exception: Exception | None = None) -> None:
+        with self._in_flight_lock:
+            future = self._in_flight.pop(key, None)
+        if future is None:
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+
+def iter_multipart_parts(chunks: Iterable[bytes], boundary: str) -> Iterator[tuple[dict[str, str], bytes]]:
+    """
+    Parse a multipart (RFC 2046) body while it is being received. Each part is yielded as soon as it is
+    complete, so only a single part has to be kept in memory at a time.
+
+    :param chunks: The body of the response in chunks of arbitrary size.
+    :param boundary: The boundary parameter of the Content-Type header of the response.
+    :return: An iterator over (headers, body) of every part. The header names are lower case.
+    """
+    delimiter = b"--" + boundary.encode()
+    part_delimiter = b"\r\n" + delimiter
+    buffer = bytearray()
+    chunk_iter = iter(chunks)
+
+    def _fill() -> bool:
+        chunk = next(chunk_iter, None)
+        if chunk is None:
+            return False
+        buffer.extend(chunk)
+        return True
+
+    # skip the preamble
+    while (start := buffer.find(delimiter)) < 0:
+        if not _fill():
+            return
+    del buffer[:start + len(delimiter)]
+    while True:
+        while len(buffer) < 2:
+            if not _fill():
+                return
+        if buffer.startswith(b"--"): # closing delimiter
+            return
+        while (header_end := buffer.find(b"\r\n\r\n")) < 0:
+            if not _fill():
+                raise RuntimeError("multipart response ended inside the headers of a part!")
+        headers = {}
+        for line in bytes(buffer[:header_end]).decode("latin-1").split("\r\n"):
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        del buffer[:header_end + 4]
+        search_from = 0
+        while (body_end := buffer.find(part_delimiter, search_from)) < 0:
+            search_from = max(0, len(buffer) - len(part_delimiter))
+            if not _fill():
+                raise RuntimeError("multipart response ended inside the body of a part!")
+        yield headers, bytes(buffer[:body_end])
+        del buffer[:body_end + len(part_delimiter)]
+
+
+def _get_content_type_parameter(content_type: str, name: str) -> str | None:
+    for parameter in content_type.split(";")[1:]:
+        key, _, value = parameter.strip().partition("=")
+        if key.strip().lower() == name:
+            return value.strip().strip('"')
+    return None
+
+
+def _frame_to_png(body: bytes, content_type: str, level: PyramidLevel) -> bytes:
+    """
+    Convert a frame as stored in the PACS (usually JPEG) into PNG, which is what the viewer can display.
+    """
+    from PIL import Image # only needed when frames are actually fetched
+    transfer_syntax = _get_content_type_parameter(content_type, "transfer-syntax")
+    if body.startswith(b"\x89PNG"):
+        return body
+    if transfer_syntax in UNCOMPRESSED_TRANSFER_SYNTAXES:
+        image = Image.frombytes("RGB", (level.tile_columns, level.tile_rows), body)
+    else:
+        image = Image.open(io.BytesIO(body))
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
@@ -0,0 +1,66 @@
+import os
+import time
+import requests
+from typing import Callable
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_MAX_RETRIES = 5
+
+
+def upload_file_chunked(upload_url: str, path_to_file: str, access_token: str, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                        max_retries: int = DEFAULT_MAX_RETRIES, on_progress: Callable[[int, int], None] | None = None) -> str:
+    """
+    Stream a (large) file to the resumable upload endpoint of the FHIR server (`/upload/sessions`).
+    Only a single chunk is kept in memory at a time, independent of the file size. If sending a chunk
+    fails, the current offset is requested from the server and the upload continues from there.
+
+    :param upload_url: The url to the upload endpoint (e.g. "http://localhost:8081/upload/sessions").
+    :param path_to_file: The file to upload (the tarball).
+    :param access_token: The bearer token of the uploading user.
+    :param chunk_size: Size of a single chunk in bytes.
+    :param max_retries: How often a single chunk may fail in a row before giving up.
+    :param on_progress: Called with (uploaded bytes, total bytes) after every chunk.
+    :return: The url of the finished upload, which is referenced in DocumentReference.content.attachment.url.
+    """
+    length = os.path.getsize(path_to_file)
+    with requests.Session() as session:
+        session.headers.update({"Authorization": f"Bearer {access_token}"})
+        response = session.post(upload_url, headers={"Upload-Length": str(length)})
+        response.raise_for_status()
+        session_url = response.headers["Location"]
+        offset = 0
+        failures = 0
+        with open(path_to_file, "rb") as f:
+            while offset < length:
+                f.seek(offset)
+                chunk = f.read(chunk_size)
+                try:
+                    response = session.patch(session_url, headers={
+                        "Upload-Offset": str(offset),
+                        "Content-Type": "application/offset+octet-stream"
+                    }, data=chunk)
+                    if response.status_code == 409: # server has a different offset, continue from there
+                        offset = int(response.headers["Upload-Offset"])
+                        continue
+                    response.raise_for_status()
+                    offset = int(response.headers["Upload-Offset"])
+                    failures = 0
+                except requests.RequestException:
+                    failures += 1
+                    if failures > max_retries:
+                        raise
+                    time.sleep(min(2 ** failures, 30))
+                    offset = _get_upload_offset(session, session_url, offset)
+                    continue
+                if on_progress is not None:
+                    on_progress(offset, length)
+    return session_url
+
+
+def _get_upload_offset(session: requests.Session, session_url: str, fallback: int) -> int:
+    try:
+        response = session.head(session_url)
+        response.raise_for_status()
+        return int(response.headers["Upload-Offset"])
+    except requests.RequestException:
+        return fallback
@@ -0,0 +1,174 @@
+from __future__ import annotations
+import os
+import struct
+import threading
+import time
+import metrics
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# budget in bytes, detected from the container (cgroup memory limit) if not set. The scratch disk is reserved
+# per root, see scratch.py
+MEMORY_BUDGET_BYTES = int(os.environ.get("CONVERTER_MEMORY_BUDGET_BYTES", "0")) # change-me
+# share of the detected memory which may be reserved, the rest is headroom for everything not estimated
+MEMORY_BUDGET_FRACTION = 0.8
+
+# footprint model, see `estimate_memory_bytes` and `scratch.estimate_disk_bytes`. The numbers are conservative estimates
+# and can be tuned with the peak RSS and sizes recorded in the job ledger (table job_resources).
+MEMORY_BASE_BYTES = int(os.environ.get("CONVERTER_MEMORY_BASE_BYTES", str(512 * 1024 * 1024))) # change-me
+MEMORY_BYTES_PER_PIXEL = float(os.environ.get("CONVERTER_MEMORY_BYTES_PER_PIXEL", "0.05")) # change-me
+# the output of wsidicomizer is about the size of the extracted input (tiles are mostly copied, not re-encoded)
+OUTPUT_TO_INPUT_RATIO = float(os.environ.get("CONVERTER_OUTPUT_TO_INPUT_RATIO", "1.2")) # change-me
+
+_GZIP_SIZE_MODULO = 2 ** 32
+
+
+def uncompressed_tarball_size(path_to_tarball: str) -> int:
+    """
+    Estimate the extracted size of a .tar.gz without decompressing it. The gzip trailer contains the uncompressed
+    size modulo 4 GiB. Slides are already compressed, so the uncompressed size is never much smaller than the
+    compressed size; the smallest candidate above that is used.
+
+    :param path_to_tarball: Path to the tarball.
+    :type path_to_tarball: str
+    :return: The estimated size in bytes after extraction.
+    :rtype: int
+    """
+    compressed_size = os.path.getsize(path_to_tarball)
+    with open(path_to_tarball, "rb") as f:
+        f.seek(-4, os.SEEK_END)
+        size_modulo = struct.unpack("<I", f.read(4))[0]
+    minimum = int(compressed_size * 0.9)
+    if size_modulo >= minimum:
+        return size_modulo
+    wraps = (minimum - size_modulo + _GZIP_SIZE_MODULO - 1) // _GZIP_SIZE_MODULO
+    return size_modulo + wraps * _GZIP_SIZE_MODULO
+
+
+def estimate_memory_bytes(uncompressed_bytes: int, level_dimensions: list[tuple[int, int]] | None = None) -> int:
+    """
+    Peak memory of a job if the runtime model has no prediction yet (see runtime_model.py). The conversion grows
+    with the pixel count of the slide (tile buffers, downsampling), the filler reads one DICOM instance at a time
+    completely (the base level is the largest one, up to about the size of the extracted slide).
+
+    :param uncompressed_bytes: Size of the extracted slide.
+    :type uncompressed_bytes: int
+    :param level_dimensions: (width, height) of every level as reported by OpenSlide, if already known.
+    :type level_dimensions: list[tuple[int, int]] | None
+    :return: The estimated peak memory in bytes.
+    :rtype: int
+    """
+    largest_instance = uncompressed_bytes * OUTPUT_TO_INPUT_RATIO
+    convert = 0
+    if level_dimensions:
+        convert = sum(width * height for width, height in level_dimensions) * MEMORY_BYTES_PER_PIXEL
+    return int(MEMORY_BASE_BYTES + max(largest_instance, convert))
+
+
+def detect_memory_bytes() -> int:
+    """
+    :return: The memory limit of the container (cgroup v2/v1) or the total memory of the machine.
+    """
+    for limit_file in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(limit_file, "r") as f:
+                value = f.read().strip()
+            if value != "max" and int(value) < 2 ** 60: # cgroup v1 reports a huge number if unlimited
+                return int(value)
+        except (OSError, ValueError):
+            pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+class AdmissionController:
+    """
+    Holds jobs back until their estimated memory footprint fits into the budget, so several jobs can run
+    concurrently without the container being OOM-killed.
+
+    Every job reserves memory before the conversion starts (predicted by the runtime model or estimated from the
+    OpenSlide level dimensions). A job with a RAM-backed scratch folder reserves the pages of the folder and the
+    conversion together before the tarball is extracted (see scratch.py) instead, so no job waits for memory while
+    it holds some. Everything is released once the job is done (see `release`).
+
+    A job which alone exceeds the budget is admitted once nothing else holds that resource, so it still runs.
+    """
+    def __init__(self, memory_budget_bytes: int) -> None:
+        self.budget = {"memory": memory_budget_bytes}
+        self._reserved = {"memory": 0}
+        self._reservations: dict[str, dict[str, int]] = {}
+        self._condition = threading.Condition()
+        self._waiting = 0
+        metrics.ADMISSION_BUDGET.labels(resource="memory").set(memory_budget_bytes)
+
+    def acquire(self, business_id: str, resource: str, amount: int, timeout: float | None = None) -> bool:
+        """
+        Block until `amount` bytes of the resource can be reserved for the job.
+
+        :param business_id: The business ID of the job.
+        :type business_id: str
+        :param resource: "memory".
+        :type resource: str
+        :param amount: Bytes to reserve.
+        :type amount: int
+        :param timeout: Seconds to wait at most, None waits until the budget allows.
+        :type timeout: float | None
+        :return: False if the timeout passed without reserving anything.
+        :rtype: bool
+        """
+        started_at = time.monotonic()
+        with self._condition:
+            self._waiting += 1
+            metrics.ADMISSION_WAITING.set(self._waiting)
+            try:
+                admitted = self._condition.wait_for(lambda: self._fits(resource, amount), timeout=timeout)
+            finally:
+                self._waiting -= 1
+                metrics.ADMISSION_WAITING.set(self._waiting)
+            if not admitted:
+                return False
+            self._reserved[resource] += amount
+            reservation = self._reservations.setdefault(business_id, {"memory": 0})
+            reservation[resource] += amount
+            metrics.ADMISSION_RESERVED.labels(resource=resource).set(self._reserved[resource])
+        waited = time.monotonic() - started_at
+        metrics.ADMISSION_WAIT_SECONDS.labels(resource=resource).observe(waited)
+        logger.info("Reserved %s bytes of %s for %s after %.1fs (%s of %s bytes reserved)", amount, resource, business_id, waited, self._reserved[resource], self.budget[resource])
+        return True
+
+    def reserved(self, business_id: str, resource: str) -> int:
+        """
+        :return: Bytes of the resource currently reserved for the job.
+        :rtype: int
+        """
+        with self._condition:
+            return self._reservations.get(business_id, {}).get(resource, 0)
+
+    def release(self, business_id: str) -> None:
+        """
+        Release everything reserved for the job.
+        """
+        with self._condition:
+            reservation = self._reservations.pop(business_id, None)
+            if reservation is None:
+                return
+            for resource, amount in reservation.items():
+                self._reserved[resource] -= amount
+                metrics.ADMISSION_RESERVED.labels(resource=resource).set(self._reserved[resource])
+            self._condition.notify_all()
+
+    def _fits(self, resource: str, amount: int) -> bool:
+        reserved = self._reserved[resource]
+        return reserved == 0 or reserved + amount <= self.budget[resource]
+
+
+def _create_controller() -> AdmissionController:
+    memory_budget = MEMORY_BUDGET_BYTES or int(detect_memory_bytes() * MEMORY_BUDGET_FRACTION)
+    logger.info("Admission budget: %s bytes memory", memory_budget)
+    return AdmissionController(memory_budget)
+
+
+# process-wide, shared by all jobs of this converter
+controller = _create_controller()
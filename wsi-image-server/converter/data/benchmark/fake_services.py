@@ -0,0 +1,239 @@
+"""
+In-process stand-ins for the services the converter talks to, so the pipeline can be benchmarked without
+the docker stack. All HTTP services share a single local server and are separated by a path prefix:
+
+- `/orthanc`: Orthanc REST API (`POST /instances`, `POST /tools/find` which finds no stored instances)
+- `/fhir`: HAPI FHIR (`GET /Patient?identifier=`, `POST /Patient`, `POST /ImagingStudy`)
+- `/keycloak`: Keycloak token endpoint and the admin endpoints used for the realm roles
+
+The prop database is replaced by an in-memory connection which only counts the executed statements.
+"""
+from __future__ import annotations
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_READ_BUFFER_SIZE = 1024 * 1024
+
+
+class ServiceStats:
+    """
+    Amount of requests and received bytes per service ("orthanc", "fhir", "keycloak").
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.requests: dict[str, int] = {}
+        self.bytes_received: dict[str, int] = {}
+
+    def record(self, service: str, received: int) -> None:
+        with self._lock:
+            self.requests[service] = self.requests.get(service, 0) + 1
+            self.bytes_received[service] = self.bytes_received.get(service, 0) + received
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {"requests": dict(self.requests), "bytes_received": dict(self.bytes_received)}
+
+
+class FakeServices:
+    """
+    Starts the fake HTTP services on a free local port and points the converter modules (`sender`, `fhir_handler`)
+    to them while the context is active.
+
+    .. code-block:: python
+    with FakeServices(latency_seconds=0.005) as services:
+        sender.send_and_cleanup(...)
+    print(services.stats.as_dict())
+    """
+    def __init__(self, latency_seconds: float = 0.0) -> None:
+        """
+        :param latency_seconds: Artificial delay added to every response (to simulate network latency).
+        :type latency_seconds: float
+        """
+        self.latency_seconds = latency_seconds
+        self.stats = ServiceStats()
+        self._server: ThreadingHTTPServer | None = None
+        self._thread: threading.Thread | None = None
+        self._original_urls: dict = {}
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> FakeServices:
+        import sender
+        from fhir_communication import fhir_handler
+        handler = type("BoundFakeServiceHandler", (_FakeServiceHandler,), {"services": self})
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-services", daemon=True)
+        self._thread.start()
+        self._original_urls = {
+            (sender, "ORTHANC_URL"): sender.ORTHANC_URL,
+            (sender, "KEYCLOAK_URL"): sender.KEYCLOAK_URL,
+            (fhir_handler, "HAPI_WEB_URL"): fhir_handler.HAPI_WEB_URL
+        }
+        sender.ORTHANC_URL = f"{self.base_url}/orthanc"
+        sender.KEYCLOAK_URL = f"{self.base_url}/keycloak"
+        fhir_handler.HAPI_WEB_URL = f"{self.base_url}/fhir"
+        logger.info("Fake services are listening on %s", self.base_url)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        for (module, name), value in self._original_urls.items():
+            setattr(module, name, value)
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _FakeServiceHandler(BaseHTTPRequestHandler):
+    services: FakeServices
+    protocol_version = "HTTP/1.1" # keep-alive, like the real services
+
+    def do_GET(self) -> None:
+        self._handle("GET")
+
+    def do_POST(self) -> None:
+        self._handle("POST")
+
+    def do_PUT(self) -> None:
+        self._handle("PUT")
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(format, *args)
+
+    def _handle(self, method: str) -> None:
+        received = self._drain_body()
+        path = urlparse(self.path).path
+        service = path.strip("/").split("/", 1)[0]
+        self.services.stats.record(service, received)
+        if self.services.latency_seconds:
+            time.sleep(self.services.latency_seconds)
+        status, body = _route(method, path)
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _drain_body(self) -> int:
+        # read (and discard) the body in chunks, the DICOM files can be large
+        remaining = int(self.headers.get("Content-Length", 0))
+        received = 0
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, _READ_BUFFER_SIZE))
+            if not chunk:
+                break
+            received += len(chunk)
+            remaining -= len(chunk)
+        return received
+
+
+def _route(method: str, path: str) -> tuple[int, dict | list | None]:
+    if path == "/orthanc/instances" and method == "POST":
+        instance_id = str(uuid.uuid4())
+        return 200, {"ID": instance_id, "Path": f"/instances/{instance_id}", "Status": "Success"}
+    if path == "/orthanc/tools/find" and method == "POST":
+        return 200, []
+    if path == "/fhir/Patient" and method == "GET":
+        return 200, {"resourceType": "Bundle", "type": "searchset", "total": 0}
+    if path == "/fhir/Patient" and method == "POST":
+        return 201, {"resourceType": "Patient", "id": str(uuid.uuid4())}
+    if path == "/fhir/ImagingStudy" and method == "POST":
+        return 201, {"resourceType": "ImagingStudy", "id": str(uuid.uuid4())}
+    if path.endswith("/protocol/openid-connect/token") and method == "POST":
+        return 200, {
+            "access_token": "benchmark-access-token",
+            "expires_in": 300,
+            "refresh_token": "benchmark-refresh-token",
+            "refresh_expires_in": 1800,
+            "token_type": "Bearer"
+        }
+    if path.endswith("/role-mappings/realm") and method == "POST":
+        return 204, None
+    if "/admin/realms/" in path and "/roles" in path:
+        if method == "POST":
+            return 201, None
+        if method == "GET":
+            role_name = path.rsplit("/", 1)[1]
+            return 200, {"id": str(uuid.uuid5(uuid.NAMESPACE_OID, role_name)), "name": role_name, "composite": False}
+    logger.warning("Fake services do not support %s %s", method, path)
+    return 404, {"error": f"{method} {path} is not supported by the fake services"}
+
+
+class FakePropDB:
+    """
+    Replaces the pooled prop database connections (`prop_db.connection`) with an in-memory stand-in while the
+    context is active. The executed statements are only counted.
+    """
+    def __init__(self) -> None:
+        self.statements = 0
+        self._lock = threading.Lock()
+        self._original_connection = None
+
+    def __enter__(self) -> FakePropDB:
+        import prop_db
+        self._original_connection = prop_db.connection
+        prop_db.connection = self._connection
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        import prop_db
+        prop_db.flush(10.0)
+        prop_db.connection = self._original_connection
+
+    @contextmanager
+    def _connection(self):
+        yield _FakeConnection(self)
+
+    def _count(self) -> None:
+        with self._lock:
+            self.statements += 1
+
+
+class _FakeConnection:
+    def __init__(self, db: FakePropDB) -> None:
+        self._db = db
+
+    def cursor(self) -> _FakeCursor:
+        return _FakeCursor(self._db)
+
+    def commit(self) -> None:
+        pass
+
+    def rollback(self) -> None:
+        pass
+
+
+class _FakeCursor:
+    # every statement "affects" a row (e.g. a lease is always acquired), queries return nothing (e.g. no completion markers)
+    rowcount = 1
+
+    def __init__(self, db: FakePropDB) -> None:
+        self._db = db
+
+    def __enter__(self) -> _FakeCursor:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+    def execute(self, sql: str, params: tuple | None = None) -> None:
+        self._db._count()
+
+    def fetchone(self) -> None:
+        return None
+
+    def fetchall(self) -> list:
+        return []
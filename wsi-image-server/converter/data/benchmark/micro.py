@@ -0,0 +1,282 @@
+"""
+Microbenchmarks of the hot functions of the converter and the Orthanc auth filter, with regression thresholds.
+Run from the converter folder (`/app` in the container):
+
+    python -m benchmark.micro                       # print the results
+    python -m benchmark.micro --check               # fail (exit code 1) if a case is slower than its threshold
+    python -m benchmark.micro --update-thresholds   # record the current numbers (+ headroom) as new thresholds
+
+The thresholds (median microseconds per call) are kept in `micro_thresholds.json` next to this file. Cases without
+a threshold are measured but not checked, record them on the reference machine with `--update-thresholds`.
+Changes to one of these functions should come with the output of this script before and after the change.
+"""
+from __future__ import annotations
+import argparse
+import fnmatch
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+import types
+import uuid
+from pathlib import Path
+from typing import Callable
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+THRESHOLDS_FILE = os.path.join(os.path.dirname(__file__), "micro_thresholds.json")
+# new thresholds are the measured median times this factor, to not fail on noise
+THRESHOLD_HEADROOM = 1.5
+DEFAULT_REPEAT = 7
+# the auth filter is not part of the converter image, it is only benchmarked if the repository is checked out
+AUTH_SCRIPT = Path(__file__).resolve().parents[3] / "orthanc" / "python-scripts" / "auth.py"
+
+# pixel data sizes of the synthetic instances for the filler (label, small level, large level)
+FILLER_INSTANCE_SIZES = {"64KiB": 64 * 1024, "1MiB": 1024 * 1024, "16MiB": 16 * 1024 * 1024}
+FHIR_STUDY_INSTANCES = 8
+WSM_SOP_CLASS_UID = "1.2.840.10008.5.1.4.1.1.77.1.6" # VL Whole Slide Microscopy Image Storage
+
+
+class Case:
+    """
+    A single microbenchmark. Either `func` is called repeatedly (timed with timeit, gc disabled), or, if `setup` is
+    given, every call gets fresh arguments from `setup` which are created outside of the timed section.
+    """
+    def __init__(self, name: str, func: Callable, setup: Callable[[], tuple] | None = None) -> None:
+        self.name = name
+        self.func = func
+        self.setup = setup
+
+    def run(self, repeat: int) -> dict:
+        if self.setup is None:
+            timer = timeit.Timer(self.func)
+            number, _ = timer.autorange() # enough calls for a round of at least 0.2 seconds
+            per_call = [seconds / number for seconds in timer.repeat(repeat=repeat, number=number)]
+        else:
+            number = 1
+            per_call = []
+            for _ in range(repeat):
+                args = self.setup()
+                started_at = time.perf_counter()
+                self.func(*args)
+                per_call.append(time.perf_counter() - started_at)
+        return {
+            "calls_per_round": number,
+            "rounds": repeat,
+            "best_us": round(min(per_call) * 1e6, 3),
+            "median_us": round(statistics.median(per_call) * 1e6, 3)
+        }
+
+
+def conversion_util_cases() -> list[Case]:
+    import conversion_util
+    business_id = "61ec173e-e818-4e3e-96fd-263aaa2d086a"
+    dcm_uid = conversion_util.from_uuid_dcm_uid(business_id)
+    return [
+        Case("conversion_util.from_uuid_dcm_uid", lambda: conversion_util.from_uuid_dcm_uid(business_id)),
+        Case("conversion_util.from_dcm_uid_to_uuid", lambda: conversion_util.from_dcm_uid_to_uuid(dcm_uid))
+    ]
+
+
+def filler_cases(working_dir: str) -> list[Case]:
+    import filler
+    str_tags = ["PatientName", "PatientID", "PatientAge", "PatientBirthDate", "PatientSex"]
+    tag_values = {"PatientName": "Benchmark", "PatientID": "benchmark-patient", "PatientAge": "042Y", "PatientBirthDate": "19700101", "PatientSex": "O"}
+    business_id = str(uuid.uuid4())
+    cases = [Case("filler._convert_str_tags_to_dcm_tags", lambda: filler._convert_str_tags_to_dcm_tags(str_tags))]
+    for size_name, pixel_bytes in FILLER_INSTANCE_SIZES.items():
+        template = os.path.join(working_dir, f"template-{size_name}.dcm")
+        _create_instance(pixel_bytes, instance_number=1).save_as(template, write_like_original=False)
+
+        def setup(template=template):
+            # the filler renames (and deletes) the file, so every call needs its own copy
+            target_dir = tempfile.mkdtemp(dir=working_dir)
+            target = os.path.join(target_dir, "instance.dcm")
+            shutil.copyfile(template, target)
+            return [target], business_id, tag_values
+
+        cases.append(Case(f"filler.fill_default_metadata_and_dcm_tags[{size_name}]", filler.fill_default_metadata_and_dcm_tags, setup))
+    return cases
+
+
+def fhir_handler_cases() -> list[Case]:
+    from fhir_communication import fhir_handler
+    business_id = str(uuid.uuid4())
+    # a typical pyramid: levels with decreasing size, plus a label
+    ds_list = [_create_instance(0, instance_number=number) for number in range(1, FHIR_STUDY_INSTANCES + 1)]
+    return [
+        Case(f"fhir_handler.construct_fhir_imaging_study[{FHIR_STUDY_INSTANCES} instances]",
+             lambda: fhir_handler.construct_fhir_imaging_study(business_id, "Patient/1", ds_list))
+    ]
+
+
+def auth_cases(path_to_auth_script: Path) -> list[Case]:
+    if not path_to_auth_script.exists():
+        logger.info("Auth filter %s not found, skipping its benchmarks.", path_to_auth_script)
+        return []
+    auth = _load_auth_filter(path_to_auth_script)
+    import conversion_util
+    business_id = str(uuid.uuid4())
+    study_uid = f"2.25.{conversion_util.from_uuid_dcm_uid(business_id)}"
+    uri = f"/dicom-web/studies/{study_uid}/series/{study_uid}.1/instances/{study_uid}.1.1/frames/1"
+    get_request = {"method": 1, "headers": {"authorization": "Bearer benchmark-token"}}
+    post_request = {"method": 2, "headers": {"authorization": "Bearer benchmark-token"}}
+
+    def with_roles(roles: list[str], request: dict, request_uri: str) -> Callable:
+        introspection = {"active": True, "realm_access": {"roles": roles}}
+        def call():
+            _KeycloakIntrospectionStandIn.token_info = introspection
+            return auth.filter(request_uri, **request)
+        return call
+
+    return [
+        Case("auth.filter[granted study role]", with_roles(["default-roles-myrealm", f"imaging_study_{business_id}"], get_request, uri)),
+        Case("auth.filter[denied]", with_roles(["default-roles-myrealm"], get_request, uri)),
+        Case("auth.filter[converter upload]", with_roles(["converter_pacs_upload"], post_request, "/instances")),
+        Case("auth.filter[no token]", lambda: auth.filter(uri, method=1, headers={}))
+    ]
+
+
+class _KeycloakIntrospectionStandIn:
+    """
+    Replaces KeycloakOpenID in the auth filter, so the decision path is measured without the HTTP round trip
+    of the token introspection.
+    """
+    token_info: dict = {"active": False}
+
+    def __init__(self, **kwargs) -> None:
+        pass
+
+    def introspect(self, token: str) -> dict:
+        return self.token_info
+
+
+def _load_auth_filter(path_to_auth_script: Path) -> types.ModuleType:
+    # the "orthanc" module only exists inside of Orthanc, the filter only needs it for registering itself
+    orthanc_stand_in = types.ModuleType("orthanc")
+    orthanc_stand_in.RegisterIncomingHttpRequestFilter = lambda filter: None
+    sys.modules.setdefault("orthanc", orthanc_stand_in)
+    spec = importlib.util.spec_from_file_location("orthanc_auth_filter", path_to_auth_script)
+    auth = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(auth)
+    auth.KeycloakOpenID = _KeycloakIntrospectionStandIn
+    auth.logger.setLevel(logging.ERROR) # every decision is logged, which would dominate the measurement
+    return auth
+
+
+def _create_instance(pixel_bytes: int, instance_number: int):
+    import pydicom
+    from pydicom.dataset import FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+    ds = pydicom.Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = WSM_SOP_CLASS_UID
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.SOPClassUID = WSM_SOP_CLASS_UID
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = generate_uid()
+    ds.Modality = "SM"
+    ds.InstanceNumber = instance_number
+    flavor = "LABEL" if instance_number == FHIR_STUDY_INSTANCES else "VOLUME"
+    ds.ImageType = ["ORIGINAL", "PRIMARY", flavor, "NONE"]
+    level_columns = max(256, 65536 // (4 ** (instance_number - 1)))
+    ds.TotalPixelMatrixColumns = level_columns
+    ds.TotalPixelMatrixRows = level_columns
+    ds.Columns = 256
+    ds.Rows = 256
+    ds.NumberOfFrames = max(1, pixel_bytes // (256 * 256 * 3))
+    ds.PixelSpacing = [0.00025 * 4 ** (instance_number - 1)] * 2
+    ds.PatientName = ""
+    ds.PatientID = ""
+    if pixel_bytes:
+        ds.PixelData = bytes(pixel_bytes)
+        ds["PixelData"].VR = "OB"
+    return ds
+
+
+def collect_cases(working_dir: str, path_to_auth_script: Path) -> list[Case]:
+    cases = []
+    groups = [conversion_util_cases, lambda: filler_cases(working_dir), fhir_handler_cases, lambda: auth_cases(path_to_auth_script)]
+    for group in groups:
+        try:
+            cases += group()
+        except ImportError as e:
+            # e.g. running outside of the converter image, where pydicom/fhir.resources are not installed
+            logger.warning("Skipping benchmarks which need %s", e.name)
+    return cases
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the hot functions with regression thresholds.")
+    parser.add_argument("--filter", default="*", help="only run cases matching this glob pattern, e.g. 'filler.*'")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--auth-script", type=Path, default=AUTH_SCRIPT)
+    parser.add_argument("--check", action="store_true", help="exit with code 1 if a case exceeds its threshold")
+    parser.add_argument("--update-thresholds", action="store_true", help=f"store the measured medians (x{THRESHOLD_HEADROOM}) as thresholds")
+    parser.add_argument("--output", help="write the json results to this file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.INFO) # the converter modules log every filled tag (and set their own logger levels)
+    import tracing
+    tracing.TRACE_FILE = "" # the filler and fhir_handler are traced, do not measure the span export
+    thresholds = _load_thresholds()
+    results = {}
+    regressions = []
+    with tempfile.TemporaryDirectory(prefix="converter-micro-") as working_dir:
+        for case in collect_cases(working_dir, args.auth_script):
+            if not fnmatch.fnmatch(case.name, args.filter):
+                continue
+            result = case.run(args.repeat)
+            threshold = thresholds.get(case.name)
+            result["threshold_us"] = threshold
+            result["passed"] = threshold is None or result["median_us"] <= threshold
+            if not result["passed"]:
+                regressions.append(case.name)
+            results[case.name] = result
+            print(f"{case.name:<70} median {result['median_us']:>12.3f} us  best {result['best_us']:>12.3f} us  threshold {threshold if threshold is not None else '-'}", file=sys.stderr)
+
+    if args.update_thresholds:
+        thresholds.update({name: round(result["median_us"] * THRESHOLD_HEADROOM, 3) for name, result in results.items()})
+        with open(THRESHOLDS_FILE, "w") as f:
+            json.dump(dict(sorted(thresholds.items())), f, indent=4)
+            f.write("\n")
+        logger.warning("Updated thresholds in %s", THRESHOLDS_FILE)
+
+    output = json.dumps({
+        "benchmark": "micro",
+        "timestamp": time.time(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "results": results,
+        "regressions": regressions
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + "\n")
+    if args.check and regressions:
+        logger.error("Slower than the threshold: %s", regressions)
+        sys.exit(1)
+
+
+def _load_thresholds() -> dict[str, float]:
+    try:
+        with open(THRESHOLDS_FILE, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""
+End-to-end benchmark of the conversion pipeline (`Converter.handle` -> `filler` -> `sender`) against the in-process
+fake services (see `fake_services.py`). Run from the converter folder (`/app` in the container):
+
+    python -m benchmark.pipeline --slide "create-data/CMU-1.tar.gz:Generic CMU-1.tiff" --repeat 3 --concurrency 1,2,4 --output bench.json
+
+Instead of (or in addition to) existing tarballs, synthetic slides can be generated (see `synthetic_slide.py`), which
+needs no network access and allows sweeping the slide size:
+
+    python -m benchmark.pipeline --synthetic 2k --synthetic 10k --synthetic 30kx20k --concurrency 1,2 --output bench.json
+
+A single small job as a smoke check of the whole pipeline (exits with 1 if the job fails or produces no instances):
+
+    python -m benchmark.pipeline --smoke
+
+The result is a json document with one entry per slide and concurrency level, containing the wall time of every
+stage, throughput (input MB/s, tiles/s, jobs/s), peak RSS and CPU seconds.
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import pydicom
+import converter
+import job_ledger
+import progress
+import scratch
+import sender
+import tracing
+from benchmark.fake_services import FakePropDB, FakeServices
+from benchmark import synthetic_slide
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# keywords, like the client sends them (see `filler._convert_str_tags_to_dcm_tags`)
+BENCHMARK_TAGS = [
+    {"key": "PatientName", "value": "Benchmark"},
+    {"key": "PatientID", "value": "benchmark-patient"},
+    {"key": "PatientAge", "value": "042Y"},
+    {"key": "PatientBirthDate", "value": "19700101"},
+    {"key": "PatientSex", "value": "O"}
+]
+# small enough to run in a few seconds, see `smoke_check`
+SMOKE_SLIDE_SIZE = (2048, 1536)
+BENCHMARK_KEYCLOAK_USER_ID = "benchmark-user"
+MB = 1024 * 1024
+
+
+def run_job(path_to_tarball: str, path_in_tarball: str) -> dict:
+    """
+    Run a single conversion job through the whole pipeline. The working directory has to contain `create-data/`
+    (the tarball is linked there under a fresh business ID, like the FHIR server does).
+
+    :param path_to_tarball: The (absolute) path to the proprietary tarball.
+    :type path_to_tarball: str
+    :param path_in_tarball: The path of the file inside the tarball which is opened with OpenSlide.
+    :type path_in_tarball: str
+    :return: The measurements of this job.
+    :rtype: dict
+    """
+    business_id = str(uuid.uuid4())
+    tarball_in_storage = os.path.join("create-data", f"{business_id}.tar.gz")
+    _link_or_copy(path_to_tarball, tarball_in_storage)
+    input_bytes = os.path.getsize(tarball_in_storage)
+    data = {
+        "uuid": business_id,
+        "keycloak_user_id": BENCHMARK_KEYCLOAK_USER_ID,
+        "path_to_wsi_tarball": f"./app/{tarball_in_storage}",
+        "path_in_tarball_for_openslide": path_in_tarball,
+        "tags": BENCHMARK_TAGS
+    }
+    ledger = job_ledger.JobLedger(business_id, record=False)
+    reporter = progress.ProgressReporter(business_id, publish=False)
+    ledger.start_job(input_bytes=input_bytes)
+    started_at = time.perf_counter()
+    try:
+        conv, kc_info = converter.Converter.fromBroker(data, reporter, ledger)
+        _, path_to_dcm_folder = conv.handle()
+        output_files, output_bytes, frames = _output_stats(path_to_dcm_folder)
+        sender.send_and_cleanup(business_id, kc_info=kc_info, path_to_dcm_folder=path_to_dcm_folder, progress_reporter=reporter, ledger=ledger)
+        sender.update_prop_db_status(business_id, converted=True)
+    finally:
+        wall_seconds = time.perf_counter() - started_at
+        ledger.finish_job()
+        os.remove(tarball_in_storage)
+        shutil.rmtree(scratch.job_folder(business_id), ignore_errors=True)
+    return {
+        "id": business_id,
+        "wall_seconds": wall_seconds,
+        "stage_seconds": dict(ledger.stage_seconds),
+        "input_bytes": input_bytes,
+        "output_bytes": output_bytes,
+        "output_files": output_files,
+        "frames": frames,
+        "peak_rss_bytes": ledger.peak_rss_bytes,
+        "rss_delta_bytes": ledger.rss_delta_bytes,
+        "concurrent_jobs": ledger.concurrent_jobs,
+        "cpu_seconds": ledger.cpu_seconds
+    }
+
+
+def run_level(path_to_tarball: str, path_in_tarball: str, concurrency: int, repeat: int) -> dict:
+    """
+    Run `concurrency * repeat` jobs of the same slide with `concurrency` jobs at a time and aggregate the results.
+
+    NOTE: peak RSS and CPU seconds are measured for the whole process, so with a concurrency > 1 they include all
+    jobs running at the same time (see `concurrent_jobs` of the jobs).
+    """
+    jobs_total = concurrency * repeat
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        jobs = list(executor.map(lambda _: run_job(path_to_tarball, path_in_tarball), range(jobs_total)))
+    elapsed = time.perf_counter() - started_at
+    stages = sorted({stage for job in jobs for stage in job["stage_seconds"]})
+    convert_seconds = [job["stage_seconds"].get("convert") for job in jobs if job["stage_seconds"].get("convert")]
+    return {
+        "concurrency": concurrency,
+        "jobs": jobs_total,
+        "elapsed_seconds": round(elapsed, 3),
+        "jobs_per_second": round(jobs_total / elapsed, 4),
+        "input_mb_per_second": round(sum(job["input_bytes"] for job in jobs) / MB / elapsed, 3),
+        "tiles_per_second": round(sum(job["frames"] for job in jobs) / elapsed, 1),
+        "convert_tiles_per_second": round(statistics.median(job["frames"] for job in jobs) / statistics.median(convert_seconds), 1) if convert_seconds else None,
+        "wall_seconds": _summary([job["wall_seconds"] for job in jobs]),
+        "stage_seconds": {stage: _summary([job["stage_seconds"][stage] for job in jobs if stage in job["stage_seconds"]]) for stage in stages},
+        "peak_rss_bytes": max(job["peak_rss_bytes"] for job in jobs),
+        "rss_delta_bytes": _summary([job["rss_delta_bytes"] for job in jobs]),
+        "cpu_seconds": _summary([job["cpu_seconds"] for job in jobs if job["cpu_seconds"] is not None]),
+        "output_bytes": jobs[0]["output_bytes"],
+        "frames": jobs[0]["frames"]
+    }
+
+
+def run_benchmark(slides: list[tuple[str, str]], concurrency_levels: list[int], repeat: int, latency_seconds: float = 0.0) -> dict:
+    """
+    Benchmark every slide at every concurrency level. The jobs run in a temporary working directory.
+
+    :param slides: Pairs of (path to tarball, path inside the tarball).
+    :type slides: list[tuple[str, str]]
+    :return: The json serializable results.
+    :rtype: dict
+    """
+    slides = [(os.path.abspath(path_to_tarball), path_in_tarball) for path_to_tarball, path_in_tarball in slides]
+    results = []
+    original_working_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="converter-benchmark-") as working_dir, FakeServices(latency_seconds) as services, FakePropDB() as prop_db_stand_in:
+        os.makedirs(os.path.join(working_dir, "create-data"))
+        os.chdir(working_dir) # the converter uses paths relative to the working directory (temp_data/<uuid>/)
+        try:
+            for path_to_tarball, path_in_tarball in slides:
+                levels = []
+                for concurrency in concurrency_levels:
+                    logger.info("Benchmarking %s with concurrency %s", path_to_tarball, concurrency)
+                    levels.append(run_level(path_to_tarball, path_in_tarball, concurrency, repeat))
+                baseline = levels[0]["jobs_per_second"]
+                for level in levels:
+                    level["speedup"] = round(level["jobs_per_second"] / baseline, 3) if baseline else None
+                results.append({
+                    "slide": os.path.basename(path_to_tarball),
+                    "path_in_tarball": path_in_tarball,
+                    "levels": levels
+                })
+        finally:
+            os.chdir(original_working_dir)
+        fake_service_stats = services.stats.as_dict()
+        prop_db_statements = prop_db_stand_in.statements
+    return {
+        "benchmark": "pipeline",
+        "timestamp": time.time(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()
+        },
+        "parameters": {"concurrency": concurrency_levels, "repeat": repeat, "latency_seconds": latency_seconds},
+        "fake_services": fake_service_stats,
+        "prop_db_statements": prop_db_statements,
+        "results": results
+    }
+
+
+def smoke_check() -> bool:
+    """
+    Run a single job of a small synthetic slide against the fake services.
+
+    :return: Whether the job completed and produced DICOM instances.
+    :rtype: bool
+    """
+    width, height = SMOKE_SLIDE_SIZE
+    with tempfile.TemporaryDirectory(prefix="synthetic-slides-") as slide_dir:
+        path_to_tarball = os.path.join(slide_dir, f"synthetic-{width}x{height}.tar.gz")
+        path_in_tarball = synthetic_slide.create_slide_tarball(path_to_tarball, width, height)
+        try:
+            results = run_benchmark([(path_to_tarball, path_in_tarball)], [1], 1)
+        except Exception:
+            logger.exception("Smoke check failed")
+            return False
+    level = results["results"][0]["levels"][0]
+    if not level["frames"] or not level["output_bytes"]:
+        logger.error("Smoke check produced no DICOM instances: %s", level)
+        return False
+    logger.info("Smoke check passed: %s frames, %s bytes in %ss", level["frames"], level["output_bytes"], level["elapsed_seconds"])
+    return True
+
+
+def _output_stats(path_to_dcm_folder: str) -> tuple[int, int, int]:
+    # headers only, the pixel data is not needed to count the frames
+    files = 0
+    size = 0
+    frames = 0
+    for dcm_file in os.scandir(path_to_dcm_folder):
+        if not dcm_file.is_file():
+            continue
+        files += 1
+        size += dcm_file.stat().st_size
+        ds = pydicom.dcmread(dcm_file.path, stop_before_pixels=True)
+        frames += int(getattr(ds, "NumberOfFrames", 1) or 1)
+    return files, size, frames
+
+
+def _summary(values: list[float]) -> dict:
+    if not values:
+        return {}
+    ordered = sorted(values)
+    return {
+        "min": round(ordered[0], 4),
+        "median": round(statistics.median(ordered), 4),
+        "p90": round(ordered[min(len(ordered) - 1, int(0.9 * len(ordered)))], 4),
+        "max": round(ordered[-1], 4)
+    }
+
+
+def _link_or_copy(source: str, target: str) -> None:
+    try:
+        os.link(source, target)
+    except OSError: # e.g. different file systems
+        shutil.copyfile(source, target)
+
+
+def _parse_slide(value: str) -> tuple[str, str]:
+    path_to_tarball, separator, path_in_tarball = value.partition(":")
+    if not separator:
+        raise argparse.ArgumentTypeError("Slides have to be given as '<tarball>:<path in tarball>'")
+    return path_to_tarball, path_in_tarball
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the conversion pipeline against local fake services.")
+    parser.add_argument("--slide", action="append", type=_parse_slide, default=[], help="'<tarball>:<path in tarball>', may be given multiple times")
+    parser.add_argument("--synthetic", action="append", type=synthetic_slide.parse_size, default=[], help="size of a generated slide, e.g. '4096', '20kx15k', may be given multiple times")
+    parser.add_argument("--synthetic-compression", choices=list(synthetic_slide.COMPRESSIONS), default="jpeg")
+    parser.add_argument("--synthetic-tissue-fraction", type=float, default=0.5)
+    parser.add_argument("--concurrency", default="1", help="comma separated concurrency levels, e.g. '1,2,4'")
+    parser.add_argument("--repeat", type=int, default=3, help="jobs per worker and concurrency level")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="artificial latency of every fake service response")
+    parser.add_argument("--output", help="write the json results to this file (default: stdout)")
+    parser.add_argument("--smoke", action="store_true", help="run a single small synthetic job and exit with 1 if it fails")
+    args = parser.parse_args(argv)
+
+    tracing.TRACE_FILE = "" # do not mix benchmark spans into the production traces
+    if args.smoke:
+        sys.exit(0 if smoke_check() else 1)
+    if not args.slide and not args.synthetic:
+        parser.error("at least one --slide or --synthetic is required")
+
+    concurrency_levels = [int(level) for level in args.concurrency.split(",")]
+    with tempfile.TemporaryDirectory(prefix="synthetic-slides-") as slide_dir:
+        slides = list(args.slide)
+        for width, height in args.synthetic:
+            path_to_tarball = os.path.join(slide_dir, f"synthetic-{width}x{height}.tar.gz")
+            path_in_tarball = synthetic_slide.create_slide_tarball(path_to_tarball, width, height, compression=args.synthetic_compression,
+                                                                   tissue_fraction=args.synthetic_tissue_fraction)
+            slides.append((path_to_tarball, path_in_tarball))
+        results = run_benchmark(slides, concurrency_levels, args.repeat, args.latency_ms / 1000)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+        logger.info("Wrote results to %s", args.output)
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+Generator for synthetic, pyramidal whole slide images, packaged as the tarballs the converter expects. The slides are
+tiled TIFF files with an Aperio (SVS) image description, so OpenSlide reads them as "aperio" including the MPP, which
+wsidicomizer needs. Tiles are generated one at a time, so slides up to 100k x 100k pixels can be written with a small
+amount of memory. The same seed always produces the same slide.
+
+    python -m benchmark.synthetic_slide --size 20kx15k --tile-size 256 --compression jpeg \
+        --tissue-fraction 0.4 --output create-data/synthetic-20k.tar.gz
+"""
+from __future__ import annotations
+import argparse
+import math
+import os
+import tarfile
+import tempfile
+import numpy as np
+import tifffile
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# compression name -> tifffile compression (jpeg needs the imagecodecs package)
+COMPRESSIONS = {
+    "none": None,
+    "deflate": "zlib",
+    "lzw": "lzw",
+    "jpeg": "jpeg"
+}
+LEVEL_DOWNSAMPLE = 4 # like most Aperio scanners
+MIN_LEVEL_SIZE = 1024 # no further levels once both dimensions are below this size
+TISSUE_GRID_SIZE = 64 # resolution of the (coarse) tissue mask along the longer side
+MPP = 0.25 # ~40x
+APP_MAG = 40
+
+# typical H&E colors (RGB): eosin, hematoxylin, background
+_EOSIN = np.array([232, 160, 190], dtype=np.float32)
+_HEMATOXYLIN = np.array([110, 70, 160], dtype=np.float32)
+_BACKGROUND = np.array([243, 243, 243], dtype=np.float32)
+
+
+class SyntheticSlide:
+    """
+    Procedural slide content. Every pixel is defined in full resolution slide coordinates, so all pyramid levels
+    show the same tissue without downsampling the full resolution image.
+    """
+    def __init__(self, width: int, height: int, tissue_fraction: float = 0.5, blank_background: bool = True, seed: int = 0) -> None:
+        """
+        :param width: Width of the full resolution level in pixels.
+        :type width: int
+        :param height: Height of the full resolution level in pixels.
+        :type height: int
+        :param tissue_fraction: Fraction of the slide covered with tissue (0 to 1).
+        :type tissue_fraction: float
+        :param blank_background: If True, the background is a single color (compresses very well, like many scanners
+            produce it). Otherwise the background has slight noise.
+        :type blank_background: bool
+        :param seed: Seed of the random generator.
+        :type seed: int
+        """
+        if not 0 <= tissue_fraction <= 1:
+            raise ValueError("tissue_fraction has to be between 0 and 1!")
+        self.width = width
+        self.height = height
+        self.tissue_fraction = tissue_fraction
+        self.blank_background = blank_background
+        self.seed = seed
+        self._tissue_mask = self._create_tissue_mask()
+
+    def _create_tissue_mask(self) -> np.ndarray:
+        scale = TISSUE_GRID_SIZE / max(self.width, self.height)
+        grid_shape = (max(1, math.ceil(self.height * scale)), max(1, math.ceil(self.width * scale)))
+        rng = np.random.default_rng(self.seed)
+        noise = rng.random(grid_shape)
+        # a few box blurs turn the noise into blobs, which look more like tissue sections than single cells
+        for _ in range(3):
+            padded = np.pad(noise, 2, mode="edge")
+            noise = sum(padded[dy:dy + grid_shape[0], dx:dx + grid_shape[1]] for dy in range(5) for dx in range(5)) / 25
+        if self.tissue_fraction <= 0:
+            return np.zeros(grid_shape, dtype=bool)
+        threshold = np.quantile(noise, 1 - self.tissue_fraction)
+        return noise >= threshold
+
+    def tile(self, level_downsample: int, x: int, y: int, tile_size: int) -> np.ndarray:
+        """
+        :param level_downsample: Downsample factor of the level (1 for the full resolution level).
+        :param x: Left pixel of the tile in level coordinates.
+        :param y: Top pixel of the tile in level coordinates.
+        :param tile_size: Width and height of the tile.
+        :return: The RGB tile (tile_size x tile_size x 3, uint8). Edge tiles are cropped to the level size by the TIFF writer.
+        :rtype: np.ndarray
+        """
+        grid_height, grid_width = self._tissue_mask.shape
+        columns = (np.arange(x, x + tile_size) * level_downsample * grid_width // self.width).clip(0, grid_width - 1)
+        rows = (np.arange(y, y + tile_size) * level_downsample * grid_height // self.height).clip(0, grid_height - 1)
+        tissue = self._tissue_mask[np.ix_(rows, columns)]
+        rng = np.random.default_rng((self.seed, level_downsample, x, y))
+        if self.blank_background:
+            tile = np.broadcast_to(_BACKGROUND, (tile_size, tile_size, 3)).copy()
+        else:
+            tile = _BACKGROUND + rng.normal(0, 2, (tile_size, tile_size, 1)).astype(np.float32)
+        if tissue.any():
+            # mix of eosin and hematoxylin with some texture (nuclei), noise keeps the compression realistic
+            nuclei = rng.random((tile_size, tile_size, 1), dtype=np.float32) ** 4
+            texture = _EOSIN * (1 - nuclei) + _HEMATOXYLIN * nuclei + rng.normal(0, 8, (tile_size, tile_size, 1)).astype(np.float32)
+            tile = np.where(tissue[..., None], texture, tile)
+        return tile.clip(0, 255).astype(np.uint8)
+
+
+def level_sizes(width: int, height: int) -> list[tuple[int, int, int]]:
+    """
+    :return: (downsample, width, height) of every pyramid level, starting with the full resolution.
+    :rtype: list[tuple[int, int, int]]
+    """
+    levels = [(1, width, height)]
+    while max(levels[-1][1], levels[-1][2]) > MIN_LEVEL_SIZE:
+        downsample = levels[-1][0] * LEVEL_DOWNSAMPLE
+        levels.append((downsample, max(1, width // downsample), max(1, height // downsample)))
+    return levels
+
+
+def write_svs(slide: SyntheticSlide, path: str, tile_size: int = 256, compression: str = "jpeg", jpeg_quality: int = 80) -> None:
+    """
+    Write the slide as tiled, pyramidal TIFF with an Aperio image description (one tiled page per level).
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression}, use one of {list(COMPRESSIONS)}!")
+    tiff_compression = COMPRESSIONS[compression]
+    compression_args = {"compression": tiff_compression}
+    if compression == "jpeg":
+        compression_args["compressionargs"] = {"level": jpeg_quality}
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        for index, (downsample, width, height) in enumerate(level_sizes(slide.width, slide.height)):
+            description = _aperio_description(slide, width, height, tile_size, compression, jpeg_quality, index == 0)
+            tif.write(
+                _tiles(slide, downsample, width, height, tile_size),
+                shape=(height, width, 3),
+                dtype=np.uint8,
+                tile=(tile_size, tile_size),
+                photometric="rgb",
+                description=description,
+                metadata=None,
+                **compression_args
+            )
+            logger.info("Wrote level with downsample %s (%sx%s)", downsample, width, height)
+
+
+def _tiles(slide: SyntheticSlide, downsample: int, width: int, height: int, tile_size: int):
+    # row-major order, which is the order tifffile expects for tiled pages
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            yield slide.tile(downsample, x, y, tile_size)
+
+
+def _aperio_description(slide: SyntheticSlide, width: int, height: int, tile_size: int, compression: str, jpeg_quality: int, base_level: bool) -> str:
+    # OpenSlide detects the "aperio" format by this prefix and reads the properties after the "|" separators
+    header = f"Aperio Image Library v12.0.15\r\n{slide.width}x{slide.height} [0,0 {slide.width}x{slide.height}] ({tile_size}x{tile_size}) {compression.upper()}/RGB Q={jpeg_quality}"
+    if not base_level:
+        header += f" -> {width}x{height}"
+    properties = {
+        "AppMag": APP_MAG,
+        "MPP": MPP,
+        "ScanScope ID": "SYNTHETIC",
+        "Filename": "synthetic",
+        "TissueFraction": slide.tissue_fraction,
+        "Seed": slide.seed
+    }
+    return header + "".join(f"|{key} = {value}" for key, value in properties.items())
+
+
+def create_slide_tarball(output_path: str, width: int, height: int, tile_size: int = 256, compression: str = "jpeg",
+                         tissue_fraction: float = 0.5, blank_background: bool = True, seed: int = 0, jpeg_quality: int = 80) -> str:
+    """
+    Generate a synthetic slide and package it as tarball like the FHIR server stores it
+    (a folder with the slide file, see `VALID_TARBALLS` in the client).
+
+    :param output_path: Path of the tarball (e.g. "create-data/synthetic.tar.gz"). The name without extension is used
+        as the folder and file name inside the tarball.
+    :type output_path: str
+    :return: The path inside the tarball, which has to be sent as "path_in_tarball_for_openslide".
+    :rtype: str
+    """
+    name = os.path.basename(output_path).removesuffix(".tar.gz")
+    slide = SyntheticSlide(width, height, tissue_fraction=tissue_fraction, blank_background=blank_background, seed=seed)
+    path_in_tarball = f"{name}/{name}.svs"
+    with tempfile.TemporaryDirectory(prefix="synthetic-slide-") as working_dir:
+        path_to_svs = os.path.join(working_dir, f"{name}.svs")
+        write_svs(slide, path_to_svs, tile_size=tile_size, compression=compression, jpeg_quality=jpeg_quality)
+        with tarfile.open(output_path, "w:gz") as tar:
+            tar.add(path_to_svs, arcname=path_in_tarball)
+    logger.info("Created synthetic slide %s (%sx%s, %s tiles, %s) at %s", path_in_tarball, width, height, tile_size, compression, output_path)
+    return path_in_tarball
+
+
+def parse_size(value: str) -> tuple[int, int]:
+    """
+    Parse "<width>x<height>" or a single number for square slides (e.g. "20000x15000", "4096"). The suffix "k" is allowed.
+    """
+    def _parse(number: str) -> int:
+        number = number.strip().lower()
+        return int(float(number[:-1]) * 1000) if number.endswith("k") else int(number)
+    width, _, height = value.lower().partition("x")
+    return _parse(width), _parse(height or width)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Generate a synthetic pyramidal slide tarball for benchmarks and load tests.")
+    parser.add_argument("--size", type=parse_size, required=True, help="'<width>x<height>' or a single number, e.g. '4096', '20kx15k', '100k'")
+    parser.add_argument("--tile-size", type=int, default=256)
+    parser.add_argument("--compression", choices=list(COMPRESSIONS), default="jpeg")
+    parser.add_argument("--jpeg-quality", type=int, default=80)
+    parser.add_argument("--tissue-fraction", type=float, default=0.5)
+    parser.add_argument("--noisy-background", action="store_true", help="add noise to the background instead of a blank color")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", required=True, help="path of the tarball, e.g. create-data/synthetic.tar.gz")
+    args = parser.parse_args(argv)
+    width, height = args.size
+    path_in_tarball = create_slide_tarball(args.output, width, height, tile_size=args.tile_size, compression=args.compression,
+                                           tissue_fraction=args.tissue_fraction, blank_background=not args.noisy_background,
+                                           seed=args.seed, jpeg_quality=args.jpeg_quality)
+    print(f"{args.output}:{path_in_tarball}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,17 @@ from pathlib import Path
 import filler
 import json
 import os
-import shutil
+import tarfile
 import logging
 import exceptions
+import progress
+import tracing
+import admission
+import scratch
+import runtime_model
+from progress import ProgressReporter
+from job_ledger import JobLedger
+from job_manifest import JobManifest
 from keycloak_info import KeycloakInfo
 from pydicom.datadict import keyword_for_tag
 
@@ -19,13 +27,13 @@ class Converter():
     Handles the conversion from proprietary files to dicom files using the wsidicomizer library 
     (which interally uses wsidicom and OpenSlide).
     """
-    def __init__(self, business_id: str, path_to_wsi_tarball: str, path_in_tarball_for_openslide: str, dicom_tags: dict[str, str]) -> None:
+    def __init__(self, business_id: str, path_to_wsi_tarball: str, path_in_tarball_for_openslide: str, dicom_tags: dict[str, str], progress_reporter: ProgressReporter | None = None, ledger: JobLedger | None = None, manifest: JobManifest | None = None) -> None:
         """
         Creates a new converter object. Most commonly created through the static `fromBroker` method.
 
-        A temporary folder at `./temp_data/` will be created to temporarily to store the extracted tarball and the converted
-        dicom files before they are uploaded. The extracted tarball will be placed at `./temp_data/<uuid>/` and the dicom
-        files will be placed at `./temp_data/<uuid>/dicom/`.
+        A temporary folder at `./temp_data/` (or another scratch root, see scratch.py) will be created to temporarily to store
+        the extracted tarball and the converted dicom files before they are uploaded. The extracted tarball will be placed at
+        `./temp_data/<uuid>/` and the dicom files will be placed at `./temp_data/<uuid>/dicom/`.
         
         Once they are uploaded and confirmed by the PACS (done by another python script),
         they will be deleted, although that is the responsibility of the other script.
@@ -49,6 +57,13 @@ class Converter():
             The additional supplied dicom tags which will be set in the converted dicom files.
             The key is the dicom tag as hexnumbers formatted with a ',' so for example: "(0010,0010)".
             The value is the dicom value as a string. As of now only fields with string types can be set (no automatic casting to other types is done).
+        progress_reporter : ProgressReporter | None
+            Receives the progress of every stage. If not set, the progress is not published.
+        ledger : JobLedger | None
+            Records the duration of every stage and the vendor format in the prop database. If not set, nothing is recorded.
+        manifest : JobManifest | None
+            Checkpoints of the completed stages, a job with an existing manifest resumes at the first incomplete stage.
+            If not set, the manifest in the job folder (`temp_data/<uuid>/`) is used.
         """
         self.business_id: str = business_id
         # The path usually is "./app/create-data/<uuid>.tar.gz" and the outer parent folder "/app/" is not needed,
@@ -57,18 +72,26 @@ class Converter():
         path_object = Path(path_to_wsi_tarball)
         self._path_to_wsi_tarball: str = path_object.relative_to(*path_object.parts[:1])
         self._path_in_tarball_for_openslide: str = path_in_tarball_for_openslide
-        self._output_folder_path: str = f"temp_data/{business_id}/dicom"
+        self._job_folder_path: str = scratch.job_folder(business_id)
+        self._output_folder_path: str = os.path.join(self._job_folder_path, "dicom")
         self.dcm_tags: dict[str, str] = dicom_tags
+        self.progress: ProgressReporter = progress_reporter if progress_reporter is not None else ProgressReporter(business_id, publish=False)
+        self.ledger: JobLedger = ledger if ledger is not None else JobLedger(business_id, record=False)
+        self.manifest: JobManifest = manifest if manifest is not None else JobManifest(business_id, folder=self._job_folder_path)
         Path(self._output_folder_path).mkdir(parents=True, exist_ok=True)
         logger.info("Created folder (and potential subfolder) %s", self._output_folder_path)
 
     @staticmethod
-    def fromBroker(data) -> tuple[Converter, KeycloakInfo]:
+    def fromBroker(data, progress_reporter: ProgressReporter | None = None, ledger: JobLedger | None = None, manifest: JobManifest | None = None) -> tuple[Converter, KeycloakInfo]:
         """
         Entry point for when a converter is needed. It takes the json message and creates a Converter object with the necessary data.
 
         :param jsonMessage: The json message received from the message broker.
         :type jsonMessage: str
+        :param progress_reporter: Receives the progress of every stage, defaults to None.
+        :type progress_reporter: ProgressReporter | None
+        :param ledger: Records the stages of the job in the prop database, defaults to None.
+        :type ledger: JobLedger | None
         :return: A converter object where the `handle()` method may be invoked to start the conversion process.
         :rtype: Converter
         """
@@ -85,11 +108,12 @@ class Converter():
                         Path in Tarball for OpsenSlide: %s\n \
                         Dicom Tags: %s", \
                         business_id, keycloak_user_id, path_to_wsi_tarball, path_in_tarball_for_openslide, dicom_tags)
-            return Converter(business_id, path_to_wsi_tarball, path_in_tarball_for_openslide, dicom_tags), KeycloakInfo(user_id=keycloak_user_id)
+            return Converter(business_id, path_to_wsi_tarball, path_in_tarball_for_openslide, dicom_tags, progress_reporter, ledger, manifest), KeycloakInfo(user_id=keycloak_user_id)
         except Exception as e:
             logger.error("Error occurred while extracting data from rabbitmq %s", e)
             raise exceptions.ConverterConstructionException from e
 
+    @tracing.traced("converter.handle")
     def handle(self) -> tuple[str, str]:
         """
         Entry point for starting the conversion once a Converter object was created.
@@ -100,14 +124,35 @@ class Converter():
         3. Fill in supplied dicom tags
         4. Validate that no tags, which are deemed as necessary, are missing
 
+        Steps which already completed in a previous attempt (see `JobManifest`) are skipped.
+
         NOTE: The generated files won't be deleted as they are not uploaded yet. Deleting the files once
         the dicom files are uploaded is in the responsibility of the uploading script.
         :return: The path to the dicom files (`./temp_data/<uuid>/dicom/)`.
         :rtype: str
         """
-        self.uncompress_file(self._path_to_wsi_tarball)
-        converted_files: list[str] = self.convert()
-        dataset = filler.fill_default_metadata_and_dcm_tags(converted_files, self.business_id, self.dcm_tags)
+        if self.manifest.is_done("extracted"):
+            logger.info("Resuming job %s at stage %s", self.business_id, self.manifest.resume_point())
+        else:
+            with self.ledger.stage("extract"):
+                self.uncompress_file(self._path_to_wsi_tarball)
+            self.manifest.complete("extracted")
+        if self.manifest.is_done("converted"):
+            converted_files = [os.path.join(self._output_folder_path, dcm_file) for dcm_file in os.listdir(self._output_folder_path)]
+        else:
+            # its own stage, so the recorded convert time (which the runtime model learns from) does not include
+            # waiting for memory
+            with self.ledger.stage("reserve_memory"):
+                prediction, input_size = self.prepare_conversion()
+            with self.ledger.stage("convert"):
+                converted_files: list[str] = self.convert(prediction, input_size)
+            self.manifest.complete("converted")
+        if self.manifest.is_done("filled"):
+            return self.business_id, self._output_folder_path
+        with self.ledger.stage("fill"):
+            self.progress.start_stage("fill", total=len(converted_files), unit="instances")
+            dataset = filler.fill_default_metadata_and_dcm_tags(converted_files, self.business_id, self.dcm_tags, progress_reporter=self.progress)
+            self.progress.finish_stage()
         missing_tags = filler.validate_no_missing_mandatory_tags(dataset)
         if missing_tags:
             missing_tags = [keyword_for_tag(tag) for tag in missing_tags] # human readable tag names
@@ -115,6 +160,7 @@ class Converter():
             raise exceptions.MandatoryTagIsMissing(f"Some mandatory tags are missing: {missing_tags}!")
         else:
             logger.info("All necessary DICOM tags are provided.")
+        self.manifest.complete("filled")
         return self.business_id, self._output_folder_path
     
     @staticmethod
@@ -169,6 +215,7 @@ class Converter():
                 raise exceptions.DicomTagKeyIsMissingException(f"Dicom tag has either missing key or value!") from e
         return dcm_tags_as_dict
 
+    @tracing.traced("converter.uncompress_file")
     def uncompress_file(self, path_to_wsi_tarball: str) -> None:
         """
         Uncompresses the proprietary tarball file.
@@ -182,40 +229,117 @@ class Converter():
             this converter container and the proprietary file storage container (e.g. create-data/<uuid>.tar.gz).
         """
         try:
-            uncompressed_file_path = f"temp_data/{self.business_id}"
-            shutil.unpack_archive(filename=path_to_wsi_tarball, extract_dir=uncompressed_file_path, format="gztar")
+            uncompressed_file_path = self._job_folder_path
+            tarball_size = os.path.getsize(path_to_wsi_tarball)
+            tracing.set_attribute("compressed_bytes", tarball_size)
+            self.progress.start_stage("extract", total=tarball_size, unit="bytes")
+            # extract member by member to be able to report the progress (in compressed bytes read)
+            with open(path_to_wsi_tarball, "rb") as raw_file, tarfile.open(fileobj=raw_file, mode="r:gz") as tar:
+                for member in tar:
+                    tar.extract(member, path=uncompressed_file_path)
+                    self.progress.update(raw_file.tell(), extracted_bytes=tar.offset)
+            self.progress.finish_stage()
+            tracing.set_attribute("extracted_bytes", tar.offset)
             self._path_to_wsi_tarball = uncompressed_file_path
             print("path to uncompressed wsi file:", self._path_to_wsi_tarball)
             logger.info("Unpacked file. Can be found at %s", self._path_to_wsi_tarball)
-        except ValueError as e:
+        except (ValueError, OSError, tarfile.TarError) as e:
             logger.exception("Error while extracting tarball from path %s with message: %s", self._path_to_wsi_tarball, e)
             raise exceptions.WsiTarballExtractionException("Tarball cannot be extracted!") from e
 
-    def convert(self) -> list[str]:
+    @tracing.traced("converter.prepare_conversion")
+    def prepare_conversion(self) -> tuple[runtime_model.Prediction | None, int]:
+        """
+        Probe the extracted slide, predict the conversion from the history and wait until its memory fits into the
+        budget (see admission.py).
+
+        Files left behind by an interrupted conversion (the folder is not empty) are deleted first.
+        :return: The prediction (None without enough history) and the extracted input size in bytes.
+        :rtype: tuple[runtime_model.Prediction | None, int]
+        """
+        path_to_wsi_file = os.path.join(self._job_folder_path, self._path_in_tarball_for_openslide)
+        existing_dcm_files = os.listdir(self._output_folder_path)
+        if len(existing_dcm_files) > 0:
+            logger.warning("Deleting %s files of an incomplete conversion in %s", len(existing_dcm_files), self._output_folder_path)
+            for existing_dcm_file in existing_dcm_files:
+                os.remove(os.path.join(self._output_folder_path, existing_dcm_file))
+        _, input_size = progress.folder_size(self._job_folder_path)
+        tracing.set_attribute("input_bytes", input_size)
+        features = self._probe_slide(path_to_wsi_file, input_size)
+        prediction = runtime_model.predict(features)
+        self._reserve_memory(features, prediction)
+        return prediction, input_size
+
+    @tracing.traced("converter.convert")
+    def convert(self, prediction: runtime_model.Prediction | None, input_size: int) -> list[str]:
         """
         Convert the (extracted) proprietary file to dicom files using the wsidicomizer library.
-        The files will be created at `temp_data/<uuid>/dicom/`.
+        The files will be created at `temp_data/<uuid>/dicom/`. Call `prepare_conversion` first.
+
+        Parameters
+        ----------
+        prediction : runtime_model.Prediction | None
+            The prediction of `prepare_conversion`, used for the progress.
+        input_size : int
+            The extracted input size in bytes, the expected output size without a prediction.
 
-        For the development phase the conversion is skipped if the folder is not empty.
         Returns
         -------
         list[str]
             The filenames of the converted dicom files, NOT including the parent paths.
             The filenames will be their SOPInstanceUIDs.
         """
-        path_to_wsi_file = os.path.join(f"temp_data/{self.business_id}", self._path_in_tarball_for_openslide)
-        existing_dcm_files = os.listdir(self._output_folder_path)
-        if len(existing_dcm_files) > 0:
-            logger.warning("Skipping conversion to DICOM as files already exist in the folder (probably for development, should not happen in production!)")
-            return [os.path.join(self._output_folder_path, existing_dcm_file) for existing_dcm_file in existing_dcm_files]
+        path_to_wsi_file = os.path.join(self._job_folder_path, self._path_in_tarball_for_openslide)
         logger.info("Starting conversion...")
+        # wsidicomizer does not report progress, so watch the output folder instead. The size of the output is
+        # predicted from the history if possible, else the extracted input size is used as an estimate (tiles are
+        # mostly copied, not re-encoded).
+        if prediction is not None:
+            self.progress.start_stage("convert", total=prediction.output_bytes, unit="bytes", predicted_seconds=round(prediction.convert_seconds, 1))
+        else:
+            self.progress.start_stage("convert", total=input_size, unit="bytes")
         try:
-            converted_files = WsiDicomizer.convert(
-                filepath=path_to_wsi_file,
-                output_path=self._output_folder_path
-            )
+            with progress.FolderSizeMonitor(self.progress, self._output_folder_path):
+                converted_files = WsiDicomizer.convert(
+                    filepath=path_to_wsi_file,
+                    output_path=self._output_folder_path
+                )
+            files_written, bytes_written = progress.folder_size(self._output_folder_path)
+            self.progress.finish_stage(files_written=files_written, bytes_written=bytes_written)
+            tracing.set_attribute("output_files", files_written)
+            tracing.set_attribute("output_bytes", bytes_written)
             logger.info("Converted to WSI DICOM at path %s", self._output_folder_path)
             return converted_files
         except Exception as e:
             logger.error("Error occurred while converting to WSI DICOM %s", e)
             raise exceptions.WsiDicomizerConversionException("wsidicomizer encountered an issue while converting!") from e
+
+    def _reserve_memory(self, features: runtime_model.SlideFeatures, prediction: runtime_model.Prediction | None) -> None:
+        """
+        Wait until the expected memory of the conversion (and the following stages) fits into the budget of the
+        converter. The reservation is released by the consumer once the job is done.
+
+        A job with a RAM-backed scratch folder already reserved the memory of its conversion together with the pages
+        of the folder (see scratch.py). It does not reserve more: waiting for memory while holding the folder's could
+        deadlock with other jobs doing the same.
+        """
+        if admission.controller.reserved(self.business_id, "memory") > 0:
+            logger.info("Memory of the conversion was reserved with the RAM-backed scratch folder")
+            return
+        if prediction is not None and prediction.peak_rss_bytes is not None:
+            memory_bytes = int(prediction.upper("peak_rss_bytes"))
+        else:
+            memory_bytes = admission.estimate_memory_bytes(features.extracted_bytes, features.level_dimensions)
+        admission.controller.acquire(self.business_id, "memory", memory_bytes)
+
+    def _probe_slide(self, path_to_wsi_file: str, extracted_bytes: int) -> runtime_model.SlideFeatures:
+        """
+        Record vendor format, level dimensions and tiles (as reported by OpenSlide) in the job ledger. Conversion
+        runtimes differ a lot between vendors and slide sizes, the runtime model learns from these.
+        """
+        features = runtime_model.probe(path_to_wsi_file, extracted_bytes)
+        self.ledger.set_slide_features(features)
+        tracing.set_attribute("vendor", features.vendor)
+        tracing.set_attribute("pixels", features.pixels)
+        tracing.set_attribute("tiles", features.tiles)
+        return features
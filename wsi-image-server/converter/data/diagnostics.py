@@ -0,0 +1,116 @@
+from __future__ import annotations
+import cProfile
+import json
+import os
+import random
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# not deleted after the job (unlike temp_data/<uuid>), mounted as volume in docker-compose.yml
+DIAGNOSTICS_DIR = os.environ.get("CONVERTER_DIAGNOSTICS_DIR", "diagnostics") # change-me
+# fraction of all jobs which are diagnosed even without the "diagnostics" flag in the message (0 = only flagged jobs)
+SAMPLE_RATE = float(os.environ.get("CONVERTER_DIAGNOSTICS_SAMPLE_RATE", "0")) # change-me
+TOP_ALLOCATIONS = 30
+TRACEMALLOC_FRAMES = 10
+
+# tracemalloc traces the whole process, it runs as long as at least one diagnosed job is running
+_tracemalloc_users = 0
+_tracemalloc_lock = threading.Lock()
+
+
+def should_diagnose(data: dict) -> bool:
+    """
+    :param data: The json message of the job. A job is diagnosed if it contains `"diagnostics": true` or if it is sampled.
+    :type data: dict
+    :rtype: bool
+    """
+    return bool(data.get("diagnostics", False)) or (SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE)
+
+
+class JobDiagnostics:
+    """
+    Runs every stage of a job under cProfile and tracemalloc and writes the results to
+    `DIAGNOSTICS_DIR/<business_id>/`:
+
+    - `<stage>.prof`: the cProfile stats of the stage (open with `python -m pstats` or snakeviz)
+    - `<stage>.allocations.txt`: the top allocations made during the stage (by line) and the traced peak
+    - `job.json`: duration, traced peak and the diagnosed stages
+
+    NOTE: cProfile only profiles the thread of the job, so the worker threads of wsidicomizer are not part of the
+    `convert` profile. tracemalloc on the other hand traces the whole process, so allocations of concurrently
+    running jobs end up in the snapshots as well.
+    """
+    def __init__(self, business_id: str) -> None:
+        self.business_id = business_id
+        self.output_dir = os.path.join(DIAGNOSTICS_DIR, business_id)
+        self._stages: list[dict] = []
+        self._started_at = 0.0
+
+    def __enter__(self) -> JobDiagnostics:
+        global _tracemalloc_users
+        os.makedirs(self.output_dir, exist_ok=True)
+        with _tracemalloc_lock:
+            if _tracemalloc_users == 0:
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            _tracemalloc_users += 1
+        self._started_at = time.monotonic()
+        logger.info("Diagnostics enabled for %s, writing to %s", self.business_id, self.output_dir)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        global _tracemalloc_users
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        summary = {
+            "id": self.business_id,
+            "duration_seconds": round(time.monotonic() - self._started_at, 3),
+            "traced_peak_bytes": peak_bytes,
+            "stages": self._stages
+        }
+        with _tracemalloc_lock:
+            _tracemalloc_users -= 1
+            if _tracemalloc_users == 0:
+                tracemalloc.stop()
+        self._write("job.json", json.dumps(summary, indent=2))
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Profile a single stage (see `JobLedger.stage`, which calls this for diagnosed jobs).
+        """
+        profiler = cProfile.Profile()
+        before = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        started_at = time.monotonic()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            duration = time.monotonic() - started_at
+            try:
+                profiler.dump_stats(os.path.join(self.output_dir, f"{name}.prof"))
+                if before is not None:
+                    self._write_allocations(name, before)
+            except Exception as e:
+                logger.warning("Could not write diagnostics of stage %s for %s: %s", name, self.business_id, e)
+            self._stages.append({"stage": name, "duration_seconds": round(duration, 3)})
+
+    def _write_allocations(self, stage: str, before: tracemalloc.Snapshot) -> None:
+        after = tracemalloc.take_snapshot()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        lines = [f"traced peak so far: {peak_bytes} bytes", f"top {TOP_ALLOCATIONS} allocations during stage {stage} (by line):", ""]
+        lines += [str(stat) for stat in after.compare_to(before, "lineno")[:TOP_ALLOCATIONS]]
+        self._write(f"{stage}.allocations.txt", "\n".join(lines))
+
+    def _write(self, filename: str, content: str) -> None:
+        try:
+            with open(os.path.join(self.output_dir, filename), "w", encoding="utf-8") as f:
+                f.write(content)
+        except OSError as e:
+            logger.warning("Could not write diagnostics file %s for %s: %s", filename, self.business_id, e)
@@ -42,4 +42,7 @@ class UploadToFHIRException(Exception):
     pass
 
 class GrantKeycloakRoleException(Exception):
+    pass
+
+class LeaseLostException(Exception):
     pass
\ No newline at end of file
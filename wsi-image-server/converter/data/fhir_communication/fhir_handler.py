@@ -1,4 +1,3 @@
-import requests
 from requests.auth import HTTPBasicAuth
 from fhir.resources.R4B.patient import Patient
 from fhir.resources.R4B.imagingstudy import ImagingStudy, ImagingStudySeries, ImagingStudySeriesInstance
@@ -8,7 +7,10 @@ from fhir.resources.R4B.coding import Coding
 from fhir.resources.R4B.codeableconcept import CodeableConcept
 from fhir.resources.R4B.humanname import HumanName
 from fhir.resources.R4B.endpoint import Endpoint
+from fhir.resources.R4B.extension import Extension
 import sender
+import tracing
+import retry_policy
 import pydicom
 
 import logging
@@ -24,6 +26,9 @@ HAPI_WEB_URL = f"http://{CONTAINER_NAME}:{PORT}/fhir" # change-me
 HAPI_USERNAME = "admin" # secret-me
 HAPI_PASSWORD = "admin" # secret-me
 
+PYRAMID_LEVEL_EXTENSION_URL = "https://localhost:8080/fhir/StructureDefinition/PyramidLevel" # change-me
+
+@tracing.traced("fhir_handler.construct_fhir_imaging_study")
 def construct_fhir_imaging_study(business_id: str, fhir_patient_reference_path: str, ds_list: list[pydicom.Dataset]) -> ImagingStudy:
     """
     Construct a FHIR ImagingStudy based on the DICOM dataset.
@@ -92,6 +97,7 @@ def _construct_imaging_study_instances(ds_list: list[pydicom.Dataset]) -> list[I
     :return: A list of FHIR ImagingStudySeriesInstances
     :rtype: list[ImagingStudySeriesInstance]
     """
+    base_level_columns = max((_get_total_pixel_matrix_size(ds)[0] for ds in ds_list if _get_image_flavor(ds) == "VOLUME"), default=0)
     instances = []
     for sop_instance in ds_list:
         instance = ImagingStudySeriesInstance(
@@ -99,11 +105,117 @@ def _construct_imaging_study_instances(ds_list: list[pydicom.Dataset]) -> list[I
             sopClass=_get_instance_sop_class_as_fhir_coding(sop_instance.SOPClassUID),
             number=sop_instance.InstanceNumber
         )
+        instance.extension = [_construct_pyramid_level_extension(sop_instance, base_level_columns)]
         instances.append(instance)
         logger.debug("Constructed FHIR ImagingStudySeriesInstance number %s.", sop_instance.InstanceNumber)
     logger.debug("Constructed FHIR ImagingStudySeriesInstances")
     return instances
 
+def _construct_pyramid_level_extension(ds: pydicom.Dataset, base_level_columns: int) -> Extension:
+    """
+    Construct a FHIR Extension containing the geometry of a single pyramid level (DICOM instance).
+    With this information a viewer can plan all tile (frame) requests with a single read of the ImagingStudy,
+    without querying the PACS (QIDO-RS) for the sizes of every instance first.
+
+    The following sub-extensions are set (if present in the DICOM dataset):
+    DICOM <-> Extension
+    --------------------
+    TotalPixelMatrixColumns <-> totalPixelMatrixColumns
+    TotalPixelMatrixRows <-> totalPixelMatrixRows
+    Columns <-> tileColumns
+    Rows <-> tileRows
+    NumberOfFrames <-> numberOfFrames
+    PixelSpacing <-> pixelSpacingRow and pixelSpacingColumn (in mm)
+    ImageType <-> role (one of "base", "reduced", "label", "overview", "thumbnail")
+
+    :param ds: The DICOM dataset of a single instance.
+    :type ds: pydicom.Dataset
+    :param base_level_columns: The TotalPixelMatrixColumns of the largest VOLUME instance in the study.
+    It is used to distinguish the base level from the reduced levels.
+    :type base_level_columns: int
+    :return: A FHIR Extension with the url `PYRAMID_LEVEL_EXTENSION_URL`.
+    :rtype: Extension
+    """
+    total_columns, total_rows = _get_total_pixel_matrix_size(ds)
+    sub_extensions = [Extension(url="role", valueCode=_get_pyramid_role(ds, base_level_columns))]
+    integer_values = {
+        "totalPixelMatrixColumns": total_columns,
+        "totalPixelMatrixRows": total_rows,
+        "tileColumns": ds.get("Columns"),
+        "tileRows": ds.get("Rows"),
+        "numberOfFrames": ds.get("NumberOfFrames", 1)
+    }
+    for url, value in integer_values.items():
+        if value:
+            sub_extensions.append(Extension(url=url, valueInteger=int(value)))
+    pixel_spacing = _get_pixel_spacing(ds)
+    if pixel_spacing is not None:
+        # PixelSpacing is defined as (row spacing, column spacing) in DICOM
+        sub_extensions.append(Extension(url="pixelSpacingRow", valueDecimal=float(pixel_spacing[0])))
+        sub_extensions.append(Extension(url="pixelSpacingColumn", valueDecimal=float(pixel_spacing[1])))
+    logger.debug("Constructed pyramid level extension for instance number %s.", ds.get("InstanceNumber"))
+    return Extension(url=PYRAMID_LEVEL_EXTENSION_URL, extension=sub_extensions)
+
+def _get_image_flavor(ds: pydicom.Dataset) -> str:
+    """
+    Get the image flavor (third value of ImageType, e.g. "VOLUME", "LABEL", "OVERVIEW" or "THUMBNAIL").
+
+    :param ds: The DICOM dataset of a single instance.
+    :type ds: pydicom.Dataset
+    :return: The image flavor in upper case. Returns an empty string if ImageType is not set.
+    :rtype: str
+    """
+    image_type = ds.get("ImageType")
+    if not image_type or len(image_type) < 3:
+        return ""
+    return str(image_type[2]).upper()
+
+def _get_total_pixel_matrix_size(ds: pydicom.Dataset) -> tuple[int, int]:
+    """
+    Get the size of the whole image of an instance. Falls back to the size of a single frame if the
+    instance is not tiled (e.g. some label images).
+
+    :param ds: The DICOM dataset of a single instance.
+    :type ds: pydicom.Dataset
+    :return: The columns (width) and rows (height) in pixels.
+    :rtype: tuple[int, int]
+    """
+    columns = ds.get("TotalPixelMatrixColumns", ds.get("Columns", 0))
+    rows = ds.get("TotalPixelMatrixRows", ds.get("Rows", 0))
+    return int(columns), int(rows)
+
+def _get_pixel_spacing(ds: pydicom.Dataset):
+    """
+    Get the PixelSpacing from the shared functional groups (where wsidicom places it).
+
+    :param ds: The DICOM dataset of a single instance.
+    :type ds: pydicom.Dataset
+    :return: The PixelSpacing (row spacing, column spacing) in mm or None if it is not set.
+    """
+    try:
+        return ds.SharedFunctionalGroupsSequence[0].PixelMeasuresSequence[0].PixelSpacing
+    except (AttributeError, IndexError):
+        return ds.get("PixelSpacing")
+
+def _get_pyramid_role(ds: pydicom.Dataset, base_level_columns: int) -> str:
+    """
+    Get the role of an instance in the pyramid.
+
+    :param ds: The DICOM dataset of a single instance.
+    :type ds: pydicom.Dataset
+    :param base_level_columns: The TotalPixelMatrixColumns of the largest VOLUME instance in the study.
+    :type base_level_columns: int
+    :return: One of "base", "reduced", "label", "overview" or "thumbnail".
+    :rtype: str
+    """
+    flavor = _get_image_flavor(ds)
+    if flavor == "VOLUME":
+        return "base" if _get_total_pixel_matrix_size(ds)[0] >= base_level_columns else "reduced"
+    if flavor in ("LABEL", "OVERVIEW", "THUMBNAIL"):
+        return flavor.lower()
+    logger.warning("Unknown ImageType %s, treating instance as reduced level.", ds.get("ImageType"))
+    return "reduced"
+
 def _construct_patient_reference(fhir_patient_reference_path: str) -> Reference:
     """
     Construct a FHIR Reference based on the reference string.
@@ -193,14 +305,19 @@ def _get_study_uid_as_fhir_identifier(study_uid: str) -> Identifier:
     idf.value = f"urn:oid:{study_uid}"
     return idf
 
-def upload_imaging_study(fhir_imaging_study: ImagingStudy, header_with_auth: dict[str, str]) -> None:
+@tracing.traced("fhir_handler.upload_imaging_study")
+def upload_imaging_study(fhir_imaging_study: ImagingStudy, header_with_auth: dict[str, str], business_id: str | None = None) -> None:
     """
     Upload a FHIR ImagingStudy to a FHIR server.
+    If the business ID is given, the ImagingStudy is only created if none with that identifier exists yet
+    (conditional create), so uploading the same conversion twice does not create a duplicate.
 
     :param fhir_imaging_study: The FHIR ImagingStudy to be uploaded. It is a FHIR representation of the DICOM study uploaded to the PACS previously.
     :type fhir_imaging_study: ImagingStudy
     :param header_with_auth: HTTP header containing bearer token.
     :type header_with_auth: dict[str, str]
+    :param business_id: The business ID, which is also an identifier of the ImagingStudy, defaults to None.
+    :type business_id: str | None
     :raises e: When a HTTP error occurred.
     """
     url = HAPI_WEB_URL + f"/ImagingStudy"
@@ -208,9 +325,14 @@ def upload_imaging_study(fhir_imaging_study: ImagingStudy, header_with_auth: dic
         "Accept":"application/fhir+json",
         "Content-Type":"application/fhir+json"
     } | header_with_auth
+    if business_id is not None:
+        business_id_identifier = _get_business_id_as_fhir_identifier(business_id)
+        headers["If-None-Exist"] = f"identifier={business_id_identifier.system}|{business_id_identifier.value}"
     to_upload = fhir_imaging_study.json()
     logger.debug("Uploading ImagingStudy with content %s", to_upload)
-    r = requests.post(url, headers=headers, data=to_upload)
+    tracing.set_attribute("bytes", len(to_upload))
+    r = retry_policy.request("POST", url, target="fhir", headers=headers, data=to_upload)
+    tracing.set_attribute("http.status_code", r.status_code)
     try:
         r.raise_for_status()
     except Exception as e:
@@ -219,6 +341,7 @@ def upload_imaging_study(fhir_imaging_study: ImagingStudy, header_with_auth: dic
     logger.info("Uploaded ImagingStudy to FHIR server.")
 
 
+@tracing.traced("fhir_handler.patient_already_exists")
 def patient_already_exists(patient_id: str, header_with_auth: dict[str, str]) -> str:
     """
     Checks the FHIR server if a patient is already associated with the given patient ID.
@@ -232,7 +355,8 @@ def patient_already_exists(patient_id: str, header_with_auth: dict[str, str]) ->
     :rtype: str
     """
     url = HAPI_WEB_URL + f"/Patient?identifier={patient_id}"
-    r = requests.get(url, headers=header_with_auth)
+    r = retry_policy.request("GET", url, target="fhir", headers=header_with_auth)
+    tracing.set_attribute("http.status_code", r.status_code)
     try:
         r.raise_for_status()
     except Exception as e:
@@ -321,9 +445,12 @@ def _dcm_2_fhir_gender(dicom_gender: str) -> str:
     except KeyError:
         return "unknown"
 
+@tracing.traced("fhir_handler.upload_patient")
 def upload_patient(fhir_patient: Patient, header_with_auth: dict[str, str]) -> str:
     """
     Upload a FHIR Patient to a FHIR server.
+    The Patient is only created if none with the same identifier exists (conditional create), so a retried upload
+    whose first response got lost does not create a duplicate.
 
     :param fhir_patient: The FHIR Patient to be uploaded.
     :type fhir_patient: Patient
@@ -337,9 +464,12 @@ def upload_patient(fhir_patient: Patient, header_with_auth: dict[str, str]) -> s
         "Accept":"application/fhir+json",
         "Content-Type":"application/fhir+json"
     } | header_with_auth
+    if fhir_patient.identifier:
+        headers["If-None-Exist"] = f"identifier={fhir_patient.identifier[0].system}|{fhir_patient.identifier[0].value}"
     to_upload = fhir_patient.json()
     logger.debug("Uploading Patient with content %s", to_upload)
-    r = requests.post(url, headers=headers, data=to_upload)
+    r = retry_policy.request("POST", url, target="fhir", headers=headers, data=to_upload)
+    tracing.set_attribute("http.status_code", r.status_code)
     try:
         r.raise_for_status()
     except Exception as e:
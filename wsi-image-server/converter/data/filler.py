@@ -1,5 +1,7 @@
 import pydicom
+import hashlib
 import json
+import os
 import os.path
 from pathlib import Path
 from pydicom.tag import Tag
@@ -11,6 +13,7 @@ from collections.abc import Sequence
 import conversion_util
 from pydicom.datadict import dictionary_VR
 import exceptions
+import tracing
 import logging
 
 logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
@@ -46,6 +49,24 @@ with open(os.path.join(os.path.dirname(__file__), "mandatory_tags.json"), "r") a
     # mandatory_tags = _convert_str_tags_to_dcm_tags(str_mandatory_tags)
 logger.debug("Loadded mandatory tags: %s", mandatory_tags)
 
+# derive the SOPInstanceUIDs from the business ID and the identity of the instance (pyramid level, image type, ...)
+# instead of random digits. A re-run of the same job then produces the same UIDs and re-uploads are no-ops at the PACS.
+DETERMINISTIC_SOP_INSTANCE_UIDS = os.environ.get("CONVERTER_DETERMINISTIC_SOP_INSTANCE_UIDS", "false").lower() in ("1", "true", "yes") # change-me
+# attributes which tell the instances of a single series apart (written by wsidicomizer)
+INSTANCE_IDENTITY_KEYWORDS = (
+    "ImageType",
+    "TotalPixelMatrixColumns",
+    "TotalPixelMatrixRows",
+    "Columns",
+    "Rows",
+    "InstanceNumber",
+    "ConcatenationUID",
+    "InConcatenationNumber",
+    "ConcatenationFrameOffsetNumber"
+)
+# a file is filled into `<file>.filling` and renamed to `<SOPInstanceUID>.dcm` afterwards
+_FILLING_SUFFIX = ".filling"
+
 
 
 class DicomTagFiller:
@@ -80,14 +101,21 @@ def _get_vendor_specific_dict(image: op.OpenSlide) -> dict[str, str]:
     return vendor_specific_dict
 
 
-def fill_default_metadata_and_dcm_tags(path_to_dcm_files:list[str], business_id: str, str_dcm_keys_values:dict[str, str]) -> list[pydicom.Dataset]:
+@tracing.traced("filler.fill_default_metadata_and_dcm_tags")
+def fill_default_metadata_and_dcm_tags(path_to_dcm_files:list[str], business_id: str, str_dcm_keys_values:dict[str, str], progress_reporter=None) -> list[pydicom.Dataset]:
     """
     Fills in the user supplied dicom tags into the freshly converted dicom files (all of them).
 
+    Resumable: files which were already filled by an interrupted previous attempt are kept as they are (see `_is_filled`).
+    Every file is written to `<file>.filling` first and only renamed to `<SOPInstanceUID>.dcm` after the original was
+    deleted, so an instance never exists twice (e.g. with another random SOPInstanceUID).
+
     :param path_to_dcm_files: The path to were the dicom files exist (probably `./temp_data/<uuid>/dicom/`).
     :type path_to_dcm_files: list[str]
     :param str_dcm_keys_values: A dictionary containing the dicom tags as keys and the dicom values as values.
     :type str_dcm_keys_values: dict[str, str]
+    :param progress_reporter: Receives the amount of filled instances after every instance, defaults to None.
+    :type progress_reporter: progress.ProgressReporter, optional
     :return: All the dicom files in this folder as pydicom objects.
     :rtype: list[pydicom.Dataset]
     """
@@ -95,8 +123,14 @@ def fill_default_metadata_and_dcm_tags(path_to_dcm_files:list[str], business_id:
     dcm_keys_values: dict[Tag, str] = {key: value for key, value in zip(dcm_tags, str_dcm_keys_values.values())}
     
     dcm_datasets: list[pydicom.Dataset] = []
-    for dcm_file in path_to_dcm_files:
-        with pydicom.dcmread(dcm_file) as ds:
+    for dcm_file in _recover_interrupted_fill(path_to_dcm_files):
+        if _is_filled(dcm_file, business_id):
+            logger.info("%s was already filled by a previous attempt, skipping.", dcm_file)
+            dcm_datasets.append(pydicom.dcmread(dcm_file, stop_before_pixels=True))
+            if progress_reporter is not None:
+                progress_reporter.update(len(dcm_datasets))
+            continue
+        with tracing.span("filler.fill_file", bytes=os.path.getsize(dcm_file)), pydicom.dcmread(dcm_file) as ds:
             new_file_name, ds = _fill_default_metadata(ds,business_id=business_id)
             dcm_file_path = Path(dcm_file)
             new_file_path = os.path.join(dcm_file_path.parent, new_file_name)
@@ -111,12 +145,46 @@ def fill_default_metadata_and_dcm_tags(path_to_dcm_files:list[str], business_id:
                 
             ds = _fill_patient_id(ds)
             dcm_datasets.append(ds) 
-            ds.save_as(new_file_path)
-            logger.info("Saving dataset with path and name=%s", new_file_path)
-            # delete old file
-            os.remove(dcm_file)
+            temp_file_path = f"{dcm_file}{_FILLING_SUFFIX}"
+            ds.save_as(temp_file_path)
+        # delete old file before the filled one gets its final name (see `_recover_interrupted_fill`)
+        os.remove(dcm_file)
+        os.replace(temp_file_path, new_file_path)
+        logger.info("Saving dataset with path and name=%s", new_file_path)
+        if progress_reporter is not None:
+            progress_reporter.update(len(dcm_datasets))
     return dcm_datasets
 
+def _recover_interrupted_fill(path_to_dcm_files: list[str]) -> list[str]:
+    """
+    Clean up after a fill which was interrupted while writing a file: a `<file>.filling` whose original still exists
+    is incomplete and deleted, one whose original was already deleted is complete and gets its final name.
+
+    :return: The files which are left to fill (or were already filled).
+    :rtype: list[str]
+    """
+    remaining = [dcm_file for dcm_file in path_to_dcm_files if not dcm_file.endswith(_FILLING_SUFFIX)]
+    for temp_file in path_to_dcm_files:
+        if not temp_file.endswith(_FILLING_SUFFIX):
+            continue
+        original_file = temp_file[:-len(_FILLING_SUFFIX)]
+        if os.path.exists(original_file):
+            logger.info("Deleting incompletely filled file %s", temp_file)
+            os.remove(temp_file)
+            continue
+        sop_instance_uid = pydicom.dcmread(temp_file, stop_before_pixels=True, specific_tags=["SOPInstanceUID"]).SOPInstanceUID
+        new_file_path = os.path.join(os.path.dirname(temp_file), f"{sop_instance_uid}.dcm")
+        os.replace(temp_file, new_file_path)
+        logger.info("Completed interrupted fill of %s", new_file_path)
+        remaining.append(new_file_path)
+    return remaining
+
+def _is_filled(dcm_file: str, business_id: str) -> bool:
+    # the converter output has UIDs of its own, a filled file belongs to the study of the job and is named after its SOPInstanceUID
+    ds = pydicom.dcmread(dcm_file, stop_before_pixels=True, specific_tags=["StudyInstanceUID", "SOPInstanceUID"])
+    study_instance_uid = f"2.25.{conversion_util.from_uuid_dcm_uid(business_id)}"
+    return ds.get("StudyInstanceUID") == study_instance_uid and os.path.basename(dcm_file) == f"{ds.get('SOPInstanceUID')}.dcm"
+
 def _fill_patient_id(dataset) -> pydicom.Dataset:
     tag = Tag("PatientID")
     if tag not in dataset or dataset[tag].is_empty:
@@ -140,9 +208,14 @@ def _fill_default_metadata(dataset, business_id: str) -> tuple[str, pydicom.Data
     dataset.SeriesInstanceUID = f"{dataset.StudyInstanceUID}.1"
     logger.debug("Set SeriesInstanceUID=%s", dataset.SeriesInstanceUID)
     # SOPInstanceUID has a length of 46+1+17=64 characters (max limit)
-    # the last 17 digits are randomly generated. The probability of a collision within a single study
-    # should be stastically impossible when using average/small tile size and size per dicom object.
-    dataset.SOPInstanceUID = f"{dataset.SeriesInstanceUID}.{_generate_random_sop_instance_uid()}"
+    # the last 17 digits are randomly generated (or derived from the instance, see `DETERMINISTIC_SOP_INSTANCE_UIDS`).
+    # The probability of a collision within a single study should be stastically impossible when using
+    # average/small tile size and size per dicom object.
+    if DETERMINISTIC_SOP_INSTANCE_UIDS:
+        sop_instance_uid_suffix = _generate_deterministic_sop_instance_uid(dataset, business_id)
+    else:
+        sop_instance_uid_suffix = _generate_random_sop_instance_uid()
+    dataset.SOPInstanceUID = f"{dataset.SeriesInstanceUID}.{sop_instance_uid_suffix}"
     logger.debug("Set SOPInstanceUID=%s", dataset.SOPInstanceUID)
     # set Modality (0008,0060) to 'SM' (Slide Microscopy) because FHIR needs it
     dataset.Modality = "SM"
@@ -153,6 +226,25 @@ def _fill_default_metadata(dataset, business_id: str) -> tuple[str, pydicom.Data
 def _generate_random_sop_instance_uid():
     return str(random.randrange(0, 10**17))
 
+def _generate_deterministic_sop_instance_uid(dataset, business_id: str) -> str:
+    """
+    Derive the last component of the SOPInstanceUID from the business ID and the identity of the instance
+    (see `INSTANCE_IDENTITY_KEYWORDS`), so the same instance of the same job always gets the same UID.
+
+    :param dataset: The converted dicom file, before any UIDs are replaced.
+    :type dataset: pydicom.Dataset
+    :param business_id: The business ID of the job.
+    :type business_id: str
+    :return: At most 17 digits, without leading zeros (as required for UID components).
+    :rtype: str
+    """
+    identity = [business_id]
+    for keyword in INSTANCE_IDENTITY_KEYWORDS:
+        value = dataset.get(keyword)
+        identity.append(f"{keyword}={'/'.join(map(str, value)) if isinstance(value, Sequence) and not isinstance(value, str) else value}")
+    digest = hashlib.sha256("|".join(identity).encode()).digest()
+    return str(int.from_bytes(digest, "big") % 10**17)
+
 def validate_no_missing_mandatory_tags(dcm_datasets: list[pydicom.Dataset]) -> list[Tag]:
     """
     Validate that no mandatory tag (can be found in `mandatory_tags.json`) is missing.
@@ -0,0 +1,154 @@
+"""
+Durable intake of conversion jobs (table `job_intake`, see `prop-db/db.sql`).
+
+Messages of the conversion queue are stored here and acknowledged right away, so the broker queue does not hold
+jobs back in FIFO order. Every replica feeds all pending jobs of the table into its scheduler (see scheduler.py),
+which orders them fair between users and by expected size. A job stays in the table until it completed or failed
+permanently; a transient failure only postpones it (`not_before`), a job of a crashed replica becomes pending again
+once its lease expired (see job_lease.py).
+"""
+from __future__ import annotations
+import os
+import threading
+from dataclasses import dataclass
+from typing import Callable
+import metrics
+import prop_db
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# pending jobs which were accepted by other replicas or whose retry delay passed are picked up within this time
+POLL_INTERVAL_SECONDS = float(os.environ.get("CONVERTER_INTAKE_POLL_SECONDS", "10")) # change-me
+
+
+@dataclass(frozen=True)
+class PendingJob:
+    business_id: str
+    body: str
+    user: str | None
+    expected_bytes: int
+    # amount of job-level retries so far
+    attempt: int
+
+
+def accept(job: PendingJob) -> None:
+    """
+    Store a job received from the broker. Written synchronously, the message is acknowledged afterwards.
+    A job which is already pending (e.g. a duplicate message) is kept as it is.
+    """
+    sql = \
+        """
+        INSERT INTO job_intake (job_id, body, user_id, expected_bytes, attempt)
+        VALUES (%s::UUID, %s, %s, %s, %s)
+        ON CONFLICT (job_id) DO NOTHING
+        """
+    prop_db.execute(sql, (job.business_id, job.body, job.user, job.expected_bytes, job.attempt))
+
+
+def pending() -> list[PendingJob]:
+    """
+    :return: All jobs which may start now: their retry delay passed and no replica holds their lease.
+    :rtype: list[PendingJob]
+    """
+    sql = \
+        """
+        SELECT i.job_id::TEXT, i.body, i.user_id, i.expected_bytes, i.attempt
+        FROM job_intake i
+        LEFT JOIN job_lease l ON l.job_id = i.job_id AND l.expires_at > now()
+        WHERE i.not_before <= now() AND l.job_id IS NULL
+        ORDER BY i.received_at
+        """
+    with prop_db.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql)
+            return [PendingJob(*row) for row in cur.fetchall()]
+
+
+def get_due(business_id: str) -> PendingJob | None:
+    """
+    :return: The job if it is still in the intake and its retry delay passed, else None.
+    :rtype: PendingJob | None
+    """
+    sql = \
+        """
+        SELECT job_id::TEXT, body, user_id, expected_bytes, attempt
+        FROM job_intake
+        WHERE job_id=%s::UUID AND not_before <= now()
+        """
+    with prop_db.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, (business_id,))
+            row = cur.fetchone()
+    return PendingJob(*row) if row is not None else None
+
+
+def postpone(business_id: str, delay_seconds: int) -> None:
+    """
+    Retry the job after `delay_seconds`, it resumes at its first incomplete stage (see JobManifest).
+    """
+    sql = \
+        """
+        UPDATE job_intake
+        SET attempt=attempt + 1, not_before=now() + %s * interval '1 second'
+        WHERE job_id=%s::UUID
+        """
+    prop_db.execute(sql, (delay_seconds, business_id))
+
+
+def remove(business_id: str) -> None:
+    """
+    Remove a job which completed or failed permanently.
+    """
+    prop_db.execute("DELETE FROM job_intake WHERE job_id=%s::UUID", (business_id,))
+
+
+class IntakeFeeder:
+    """
+    Keeps the scheduler of this replica filled with the pending jobs of the intake. Jobs received by this replica
+    are offered right away, the others (and postponed ones) with the next poll. A job is offered at most once
+    until it was handled (`done`).
+
+    Every replica offers every pending job, the first one to acquire its lease runs it (see
+    `rabbit_consumer.start_conversion`), the others skip it.
+    """
+    def __init__(self, submit: Callable[[PendingJob], None]) -> None:
+        """
+        :param submit: Queues a job in the scheduler.
+        :type submit: Callable[[PendingJob], None]
+        """
+        self._submit = submit
+        self._offered: set[str] = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def offer(self, job: PendingJob) -> None:
+        with self._lock:
+            if job.business_id in self._offered:
+                return
+            self._offered.add(job.business_id)
+        self._submit(job)
+
+    def done(self, business_id: str) -> None:
+        with self._lock:
+            self._offered.discard(business_id)
+
+    def start(self) -> None:
+        threading.Thread(target=self._poll, name="intake-feeder", daemon=True).start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _poll(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                jobs = pending()
+                metrics.INTAKE_PENDING.set(len(jobs))
+                for job in jobs:
+                    self.offer(job)
+            except Exception as e:
+                # retried with the next poll, jobs received by this replica are still offered directly
+                logger.warning("Could not poll the job intake: %s", e)
+            self._stopped.wait(POLL_INTERVAL_SECONDS)
@@ -0,0 +1,162 @@
+from __future__ import annotations
+import os
+import socket
+import threading
+import time
+import uuid
+import exceptions
+import prop_db
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# identifies this converter replica in the lease table (container hostname and pid by default)
+OWNER = os.environ.get("CONVERTER_REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}" # change-me
+# a lease which is not renewed within this time is taken over by the next replica receiving the job
+LEASE_SECONDS = float(os.environ.get("CONVERTER_LEASE_SECONDS", "120")) # change-me
+HEARTBEAT_INTERVAL_SECONDS = LEASE_SECONDS / 4
+
+
+class JobLease:
+    """
+    A claim of a single business ID by this replica in the prop database (table `job_lease`, see `prop-db/db.sql`),
+    so several converter replicas consuming the same queue never work on the same job at the same time.
+
+    The lease expires after `LEASE_SECONDS` unless it is renewed, which a background thread does every
+    `HEARTBEAT_INTERVAL_SECONDS`. If the lease was taken over in the meantime (e.g. the database was not reachable
+    for longer than the lease), it is lost and `check` raises before the next stage starts.
+
+    All times are taken from the database, so the clocks of the replicas do not matter.
+    """
+    def __init__(self, business_id: str) -> None:
+        self.business_id = business_id
+        # unique per attempt, so a message redelivered to the same replica does not share the lease of a running attempt
+        self.owner = f"{OWNER}/{uuid.uuid4().hex[:8]}"
+        self.lost = False
+        self._stopped = threading.Event()
+        self._heartbeat_thread: threading.Thread | None = None
+
+    def acquire(self, wait_seconds: float = 0.0) -> bool:
+        """
+        Claim the job, if it is not claimed by another replica or their lease expired.
+
+        :param wait_seconds: How long to keep trying while another replica holds the lease.
+        :type wait_seconds: float
+        :return: Whether this replica holds the lease now.
+        :rtype: bool
+        """
+        deadline = time.monotonic() + wait_seconds
+        while not self._try_acquire():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(min(HEARTBEAT_INTERVAL_SECONDS, max(deadline - time.monotonic(), 0)))
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, name=f"lease-{self.business_id}", daemon=True)
+        self._heartbeat_thread.start()
+        logger.info("Acquired lease of job %s as %s", self.business_id, self.owner)
+        return True
+
+    def _try_acquire(self) -> bool:
+        sql = \
+            """
+            INSERT INTO job_lease (job_id, owner, acquired_at, heartbeat_at, expires_at)
+            VALUES (%s::UUID, %s, now(), now(), now() + %s * interval '1 second')
+            ON CONFLICT (job_id) DO UPDATE
+            SET owner=excluded.owner, acquired_at=excluded.acquired_at, heartbeat_at=excluded.heartbeat_at,
+                expires_at=excluded.expires_at, attempts=job_lease.attempts + 1
+            WHERE job_lease.expires_at < now()
+            """
+        with prop_db.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, (self.business_id, self.owner, LEASE_SECONDS))
+                return cur.rowcount == 1
+
+    def check(self) -> None:
+        """
+        :raises exceptions.LeaseLostException: The lease was taken over by another replica.
+        """
+        if self.lost:
+            raise exceptions.LeaseLostException(f"The lease of job {self.business_id} was taken over by another replica!")
+
+    def release(self) -> None:
+        """
+        Stop renewing and give up the lease, so a redelivery of the job may be handled immediately by any replica.
+        """
+        self._stopped.set()
+        if self._heartbeat_thread is None:
+            return
+        self._heartbeat_thread.join()
+        try:
+            prop_db.execute("DELETE FROM job_lease WHERE job_id=%s::UUID AND owner=%s", (self.business_id, self.owner))
+        except Exception as e:
+            # the lease expires on its own
+            logger.warning("Could not release lease of job %s: %s", self.business_id, e)
+
+    def _heartbeat(self) -> None:
+        sql = \
+            """
+            UPDATE job_lease
+            SET heartbeat_at=now(), expires_at=now() + %s * interval '1 second'
+            WHERE job_id=%s::UUID AND owner=%s
+            """
+        while not self._stopped.wait(HEARTBEAT_INTERVAL_SECONDS):
+            try:
+                with prop_db.connection() as conn:
+                    with conn.cursor() as cur:
+                        cur.execute(sql, (LEASE_SECONDS, self.business_id, self.owner))
+                        renewed = cur.rowcount == 1
+            except Exception as e:
+                # retried with the next heartbeat, the lease is only lost once another replica took it over
+                logger.warning("Could not renew lease of job %s: %s", self.business_id, e)
+                continue
+            if not renewed:
+                logger.error("Lost lease of job %s, another replica took it over", self.business_id)
+                self.lost = True
+                return
+
+
+def get_completion(business_id: str, stage: str) -> str | None:
+    """
+    Look up the completion marker of a stage (table `job_completion`). Stages with a marker are skipped when a
+    job is delivered again, so redeliveries do not create duplicate resources.
+
+    :param business_id: The business ID of the job.
+    :type business_id: str
+    :param stage: Name of the stage (e.g. "send_to_fhir", "keycloak") or "job" for the whole job.
+    :type stage: str
+    :return: The detail recorded with the marker ("" if none), None if the stage was not completed.
+    :rtype: str | None
+    """
+    with prop_db.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT detail FROM job_completion WHERE job_id=%s::UUID AND stage=%s", (business_id, stage))
+            row = cur.fetchone()
+    return row[0] if row is not None else None
+
+
+def mark_completed(business_id: str, stage: str, detail: str = "") -> None:
+    """
+    Record that a stage completed. Written synchronously, the marker has to exist before the message is acknowledged.
+
+    :param detail: Result of the stage which later stages need if it is skipped (e.g. the patient ID).
+    :type detail: str
+    """
+    sql = \
+        """
+        INSERT INTO job_completion (job_id, stage, detail)
+        VALUES (%s::UUID, %s, %s)
+        ON CONFLICT (job_id, stage) DO UPDATE SET detail=excluded.detail, completed_at=now()
+        """
+    prop_db.execute(sql, (business_id, stage, detail))
+
+
+def leased_job_ids() -> set[str]:
+    """
+    :return: The business IDs of all jobs currently leased by any replica.
+    :rtype: set[str]
+    """
+    with prop_db.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT job_id::TEXT FROM job_lease WHERE expires_at > now()")
+            return {row[0] for row in cur.fetchall()}
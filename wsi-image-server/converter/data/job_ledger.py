@@ -0,0 +1,213 @@
+from __future__ import annotations
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import prop_db
+from runtime_model import SlideFeatures
+import metrics
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+RSS_SAMPLE_INTERVAL_SECONDS = 0.5
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+# ledgers of the jobs which are measured right now, see `JobLedger.concurrent_jobs`
+_running: set[JobLedger] = set()
+_running_lock = threading.Lock()
+
+
+class JobLedger:
+    """
+    Records the history of a single conversion job in the prop database (tables `job_stage` and `job_resources`,
+    see `prop-db/db.sql`): start and end of every stage, as well as input size, output size, vendor format,
+    peak RSS and CPU seconds of the whole job.
+
+    NOTE: RSS and CPU time are measured for the whole converter process (wsidicomizer uses its own worker threads,
+    which a per-thread measurement would miss). The RSS at the start of the job is recorded as well, so the peak
+    minus the start is the memory the job added. When several jobs run concurrently, they share these numbers:
+    `concurrent_jobs` (stored next to them) is the most jobs which ran at the same time while this one did,
+    only the measurements with a value of 1 belong to this job alone.
+
+    Writing to the ledger never fails the job: errors are logged and the record is dropped.
+    """
+    def __init__(self, business_id: str, record: bool = True) -> None:
+        """
+        :param business_id: The business ID of the job.
+        :type business_id: str
+        :param record: Whether anything is written to the database. If False, the ledger only measures.
+        :type record: bool
+        """
+        self.business_id = business_id
+        self._record = record
+        self._started_at: datetime | None = None
+        self._cpu_at_start = 0.0
+        self._peak_rss_bytes = 0
+        self._start_rss_bytes = 0
+        self._rss_sampler_stopped = threading.Event()
+        self._rss_sampler: threading.Thread | None = None
+        # set for jobs which run under cProfile/tracemalloc (see diagnostics.JobDiagnostics)
+        self.diagnostics = None
+        # set if the job is claimed in the prop database (see job_lease.JobLease), no stage starts once it is lost
+        self.lease = None
+        # duration of every finished stage in seconds (the last attempt, if a stage runs more than once)
+        self.stage_seconds: dict[str, float] = {}
+        self.cpu_seconds: float | None = None
+        self.concurrent_jobs = 0
+
+    def start_job(self, input_bytes: int | None = None) -> None:
+        """
+        Start measuring the job.
+
+        :param input_bytes: Size of the (compressed) proprietary tarball.
+        :type input_bytes: int | None
+        """
+        self._started_at = datetime.now(timezone.utc)
+        with _running_lock:
+            _running.add(self)
+            for ledger in _running:
+                ledger.concurrent_jobs = max(ledger.concurrent_jobs, len(_running))
+        self._cpu_at_start = time.process_time()
+        self._start_rss_bytes = current_rss_bytes()
+        self._peak_rss_bytes = self._start_rss_bytes
+        self._rss_sampler = threading.Thread(target=self._sample_rss, daemon=True)
+        self._rss_sampler.start()
+        sql = \
+            """
+            INSERT INTO job_resources (job_id, input_bytes, started_at)
+            VALUES (%s::UUID, %s, %s)
+            ON CONFLICT (job_id) DO UPDATE
+            SET input_bytes=excluded.input_bytes, started_at=excluded.started_at, finished_at=NULL
+            """
+        self._execute(sql, (self.business_id, input_bytes, self._started_at))
+
+    def set_slide_features(self, features: SlideFeatures) -> None:
+        """
+        Record the features of the slide, which the runtime model learns from (see runtime_model.py).
+
+        :param features: Vendor format (e.g. "aperio", "mirax"), level dimensions and tiles as reported by OpenSlide.
+        :type features: SlideFeatures
+        """
+        sql = \
+            """
+            UPDATE job_resources
+            SET vendor=%s, level_dimensions=%s::jsonb, tiles=%s, extracted_bytes=%s
+            WHERE job_id=%s::UUID
+            """
+        level_dimensions = json.dumps(features.level_dimensions) if features.level_dimensions else None
+        self._execute(sql, (features.vendor, level_dimensions, features.tiles or None, features.extracted_bytes, self.business_id))
+
+    def finish_job(self, output_bytes: int | None = None) -> None:
+        """
+        Stop measuring the job and record the used resources.
+
+        :param output_bytes: Size of the converted DICOM files (if the conversion got that far).
+        :type output_bytes: int | None
+        """
+        self._rss_sampler_stopped.set()
+        if self._rss_sampler is not None:
+            self._rss_sampler.join()
+        with _running_lock:
+            _running.discard(self)
+        cpu_seconds = time.process_time() - self._cpu_at_start
+        self.cpu_seconds = cpu_seconds
+        if "convert" not in self.stage_seconds:
+            # an attempt resumed after the conversion (see JobManifest) keeps the resources of the attempt which
+            # converted, the runtime model learns from them
+            sql = \
+                """
+                UPDATE job_resources
+                SET output_bytes=COALESCE(%s, output_bytes), finished_at=%s
+                WHERE job_id=%s::UUID
+                """
+            self._execute(sql, (output_bytes, datetime.now(timezone.utc), self.business_id))
+            return
+        sql = \
+            """
+            UPDATE job_resources
+            SET output_bytes=COALESCE(%s, output_bytes), peak_rss_bytes=%s, start_rss_bytes=%s, cpu_seconds=%s,
+                concurrent_jobs=%s, finished_at=%s
+            WHERE job_id=%s::UUID
+            """
+        self._execute(sql, (output_bytes, self._peak_rss_bytes, self._start_rss_bytes, cpu_seconds, self.concurrent_jobs,
+                            datetime.now(timezone.utc), self.business_id))
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Record the start and end of a stage. The stage is marked as failed if the block raises.
+
+        .. code-block:: python
+        with ledger.stage("convert"):
+            ...
+
+        :param name: Name of the stage (e.g. "extract", "convert", "fill", "send_to_pacs", "send_to_fhir", "keycloak").
+        :type name: str
+        """
+        if self.lease is not None:
+            self.lease.check()
+        started_at = datetime.now(timezone.utc)
+        try:
+            if self.diagnostics is None:
+                yield
+            else:
+                with self.diagnostics.stage(name):
+                    yield
+        except BaseException as e:
+            self._record_stage(name, started_at, succeeded=False, error_msg=repr(e))
+            raise
+        self._record_stage(name, started_at, succeeded=True)
+
+    @property
+    def peak_rss_bytes(self) -> int:
+        return self._peak_rss_bytes
+
+    @property
+    def rss_delta_bytes(self) -> int:
+        """
+        Peak RSS minus the RSS at the start of the job, includes other jobs if `concurrent_jobs` is larger than 1.
+        """
+        return max(self._peak_rss_bytes - self._start_rss_bytes, 0)
+
+    def _record_stage(self, name: str, started_at: datetime, succeeded: bool, error_msg: str | None = None) -> None:
+        finished_at = datetime.now(timezone.utc)
+        duration_seconds = (finished_at - started_at).total_seconds()
+        logger.info("Stage %s of job %s took %.3fs (succeeded=%s)", name, self.business_id, duration_seconds, succeeded)
+        metrics.observe_stage(name, duration_seconds, succeeded)
+        self.stage_seconds[name] = duration_seconds
+        sql = \
+            """
+            INSERT INTO job_stage (job_id, stage, started_at, finished_at, succeeded, error_msg)
+            VALUES (%s::UUID, %s, %s, %s, %s, %s)
+            """
+        self._execute(sql, (self.business_id, name, started_at, finished_at, succeeded, error_msg))
+
+    def _execute(self, sql: str, params: tuple) -> None:
+        if not self._record:
+            return
+        try:
+            # written in the background (batched with the rows of other jobs), the ledger is not needed by the conversion itself
+            prop_db.execute_async(sql, params)
+        except Exception as e:
+            logger.warning("Could not write to the job ledger for %s: %s", self.business_id, e)
+
+    def _sample_rss(self) -> None:
+        while not self._rss_sampler_stopped.wait(RSS_SAMPLE_INTERVAL_SECONDS):
+            self._peak_rss_bytes = max(self._peak_rss_bytes, current_rss_bytes())
+
+
+def current_rss_bytes() -> int:
+    """
+    :return: The current resident set size of this process in bytes (0 if it cannot be determined).
+    :rtype: int
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
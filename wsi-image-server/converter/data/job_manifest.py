@@ -0,0 +1,99 @@
+from __future__ import annotations
+import json
+import os
+from datetime import datetime, timezone
+import job_lease
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MANIFEST_FILE_NAME = "manifest.json"
+# in pipeline order
+STAGES = ("extracted", "converted", "filled", "pacs_uploaded", "fhir_created", "roles_assigned")
+# these stages changed the FHIR server and Keycloak, so they stay completed even if the job is resumed on another
+# replica (without the temp data). All other stages refer to the files in `temp_data/<uuid>/` of this replica.
+SHARED_STAGES = ("fhir_created", "roles_assigned")
+
+
+class JobManifest:
+    """
+    Checkpoints of a single job, so a retry resumes from the first incomplete stage instead of extracting and
+    converting the slide again.
+
+    The manifest is written to `temp_data/<uuid>/manifest.json` (next to the files the stages produced) and every
+    completed stage is also recorded in the prop database (table `job_completion`). A local stage only counts as
+    completed if all local stages before it are, e.g. a re-extracted slide invalidates the conversion.
+    """
+    def __init__(self, business_id: str, folder: str | None = None, record: bool = True) -> None:
+        """
+        :param business_id: The business ID of the job.
+        :type business_id: str
+        :param folder: The temp folder of the job, defaults to `temp_data/<uuid>`.
+        :type folder: str | None
+        :param record: Whether the stages are also recorded in (and looked up from) the prop database.
+        :type record: bool
+        """
+        self.business_id = business_id
+        self.path = os.path.join(folder or f"temp_data/{business_id}", MANIFEST_FILE_NAME)
+        self._record = record
+        self._stages: dict[str, dict] = self._load()
+
+    def is_done(self, stage: str) -> bool:
+        if stage in SHARED_STAGES:
+            return stage in self._stages or (self._record and job_lease.get_completion(self.business_id, stage) is not None)
+        local_stages = [local_stage for local_stage in STAGES if local_stage not in SHARED_STAGES]
+        return all(local_stage in self._stages for local_stage in local_stages[:local_stages.index(stage) + 1])
+
+    def detail(self, stage: str) -> str | None:
+        """
+        :return: The detail recorded with the completed stage (e.g. the patient ID of "fhir_created"), None if not completed.
+        """
+        if stage in self._stages:
+            return self._stages[stage]["detail"]
+        if stage in SHARED_STAGES and self._record:
+            return job_lease.get_completion(self.business_id, stage)
+        return None
+
+    def complete(self, stage: str, detail: str = "") -> None:
+        """
+        Record that a stage completed.
+
+        :param stage: One of `STAGES`.
+        :type stage: str
+        :param detail: Result of the stage which later stages need if it is skipped.
+        :type detail: str
+        """
+        if stage not in SHARED_STAGES:
+            # a repeated stage produced new files, the local stages after it refer to the old ones
+            for later_stage in STAGES[STAGES.index(stage) + 1:]:
+                if later_stage not in SHARED_STAGES:
+                    self._stages.pop(later_stage, None)
+        self._stages[stage] = {"completed_at": datetime.now(timezone.utc).isoformat(), "detail": detail}
+        if os.path.isdir(os.path.dirname(self.path)):
+            # replaced atomically, a crash while writing never leaves a corrupt manifest behind
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump({"business_id": self.business_id, "stages": self._stages}, f)
+            os.replace(temp_path, self.path)
+        if self._record:
+            job_lease.mark_completed(self.business_id, stage, detail)
+
+    def resume_point(self) -> str | None:
+        """
+        :return: The first stage which is not completed, None if all are.
+        """
+        return next((stage for stage in STAGES if not self.is_done(stage)), None)
+
+    def _load(self) -> dict[str, dict]:
+        try:
+            with open(self.path, "r") as f:
+                stages = json.load(f)["stages"]
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Ignoring unreadable manifest %s: %s", self.path, e)
+            return {}
+        logger.info("Found manifest of job %s with completed stages %s", self.business_id, list(stages))
+        return stages
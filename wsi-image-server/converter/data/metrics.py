@@ -0,0 +1,123 @@
+from __future__ import annotations
+import os
+import threading
+import time
+from contextlib import contextmanager
+import pika
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+METRICS_PORT = int(os.environ.get("CONVERTER_METRICS_PORT", "9100")) # change-me
+QUEUE_DEPTH_POLL_INTERVAL_SECONDS = 15.0
+# amount of jobs the converter is expected to handle at the same time, used as the denominator of the worker utilization
+WORKER_CAPACITY = int(os.environ.get("CONVERTER_WORKERS", str(os.cpu_count() or 1))) # change-me
+
+# conversions of large slides take minutes, the uploads can take even longer
+_STAGE_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, float("inf"))
+
+QUEUE_DEPTH = Gauge("converter_queue_depth", "Messages waiting in the conversion queue.", ["queue"])
+JOBS_IN_FLIGHT = Gauge("converter_jobs_in_flight", "Conversion jobs currently being processed.")
+JOBS_TOTAL = Counter("converter_jobs_total", "Finished conversion jobs.", ["outcome"])
+JOB_FAILURES = Counter("converter_job_failures_total", "Failed conversion jobs by exception class (see exceptions.py).", ["exception"])
+JOB_DURATION = Histogram("converter_job_duration_seconds", "Duration of a whole conversion job.", buckets=_STAGE_BUCKETS)
+STAGE_DURATION = Histogram("converter_stage_duration_seconds", "Duration of a single stage of a conversion job.", ["stage", "outcome"], buckets=_STAGE_BUCKETS)
+BYTES_PROCESSED = Counter("converter_bytes_processed_total", "Bytes read (compressed tarballs) and written (DICOM files).", ["direction"])
+WORKER_CAPACITY_GAUGE = Gauge("converter_worker_capacity", "Amount of jobs the converter is expected to handle concurrently.")
+# utilization = rate(converter_worker_busy_seconds_total[5m]) / converter_worker_capacity
+WORKER_BUSY_SECONDS = Counter("converter_worker_busy_seconds_total", "Sum of the time spent in conversion jobs over all workers.")
+ADMISSION_BUDGET = Gauge("converter_admission_budget_bytes", "Memory which may be reserved by jobs.", ["resource"])
+ADMISSION_RESERVED = Gauge("converter_admission_reserved_bytes", "Memory currently reserved by jobs.", ["resource"])
+ADMISSION_WAITING = Gauge("converter_admission_waiting_jobs", "Jobs waiting for their memory reservation.")
+ADMISSION_WAIT_SECONDS = Histogram("converter_admission_wait_seconds", "Time a job waited for its reservation.", ["resource"], buckets=_STAGE_BUCKETS)
+SCRATCH_QUOTA = Gauge("converter_scratch_quota_bytes", "Scratch space which may be reserved by jobs, per scratch root.", ["root"])
+SCRATCH_RESERVED = Gauge("converter_scratch_reserved_bytes", "Scratch space currently reserved by jobs, per scratch root.", ["root"])
+SCRATCH_WAITING = Gauge("converter_scratch_waiting_jobs", "Jobs waiting for their scratch space reservation.")
+SCRATCH_RECLAIMED_BYTES = Counter("converter_scratch_reclaimed_bytes_total", "Bytes of orphaned job folders deleted by the reclaimer.", ["root"])
+SCHEDULER_QUEUED = Gauge("converter_scheduler_queued_jobs", "Jobs of the intake queued in this replica, waiting for a worker.", ["lane"])
+INTAKE_PENDING = Gauge("converter_intake_pending_jobs", "Jobs accepted from the broker which may start now (not leased, retry delay passed).")
+REQUEST_RETRIES = Counter("converter_request_retries_total", "Retried requests to Orthanc, HAPI FHIR and Keycloak after transient failures.", ["target"])
+PACS_SKIPPED_BYTES = Counter("converter_pacs_skipped_bytes_total", "Bytes of DICOM files not uploaded because Orthanc already stored them.")
+SCHEDULER_ACTIVE_USERS = Gauge("converter_scheduler_active_users", "Users with jobs waiting for a worker.")
+SCHEDULER_WAIT_SECONDS = Histogram("converter_scheduler_wait_seconds", "Time a job waited for a worker.", ["lane"], buckets=_STAGE_BUCKETS)
+
+
+def start(queue_name: str, rabbitmq_host: str) -> None:
+    """
+    Start the metrics HTTP endpoint (`:METRICS_PORT/metrics`) and the background thread polling the queue depth.
+
+    :param queue_name: The queue the converter consumes from.
+    :type queue_name: str
+    :param rabbitmq_host: The host of the message broker.
+    :type rabbitmq_host: str
+    """
+    start_http_server(METRICS_PORT)
+    WORKER_CAPACITY_GAUGE.set(WORKER_CAPACITY)
+    threading.Thread(target=_poll_queue_depth, args=(queue_name, rabbitmq_host), name="queue-depth-poller", daemon=True).start()
+    logger.info("Serving metrics on port %s", METRICS_PORT)
+
+
+@contextmanager
+def track_job():
+    """
+    Track a single job as in flight and record its duration and busy time.
+    The outcome has to be recorded separately with `job_succeeded` or `job_failed`.
+    """
+    started_at = time.monotonic()
+    JOBS_IN_FLIGHT.inc()
+    try:
+        yield
+    finally:
+        duration = time.monotonic() - started_at
+        JOBS_IN_FLIGHT.dec()
+        JOB_DURATION.observe(duration)
+        WORKER_BUSY_SECONDS.inc(duration)
+
+
+def job_succeeded() -> None:
+    JOBS_TOTAL.labels(outcome="converted").inc()
+
+
+def job_retried() -> None:
+    JOBS_TOTAL.labels(outcome="retried").inc()
+
+
+def job_failed(exception: BaseException) -> None:
+    """
+    :param exception: The outer-most exception, which is one of the classes in exceptions.py for all known failures.
+    :type exception: BaseException
+    """
+    JOBS_TOTAL.labels(outcome="failed").inc()
+    JOB_FAILURES.labels(exception=type(exception).__name__).inc()
+
+
+def observe_stage(stage: str, duration_seconds: float, succeeded: bool) -> None:
+    STAGE_DURATION.labels(stage=stage, outcome="succeeded" if succeeded else "failed").observe(duration_seconds)
+
+
+def add_bytes(direction: str, amount: int | None) -> None:
+    """
+    :param direction: "input" (compressed tarball) or "output" (DICOM files).
+    :type direction: str
+    """
+    if amount:
+        BYTES_PROCESSED.labels(direction=direction).inc(amount)
+
+
+def _poll_queue_depth(queue_name: str, rabbitmq_host: str) -> None:
+    # a separate connection, the consuming connection is blocked in start_consuming and must not be used from another thread
+    connection = None
+    while True:
+        try:
+            if connection is None or not connection.is_open:
+                connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbitmq_host))
+                channel = connection.channel()
+            declared = channel.queue_declare(queue=queue_name, passive=True)
+            QUEUE_DEPTH.labels(queue=queue_name).set(declared.method.message_count)
+        except Exception as e:
+            logger.warning("Could not poll depth of queue %s: %s", queue_name, e)
+            connection = None
+        time.sleep(QUEUE_DEPTH_POLL_INTERVAL_SECONDS)
@@ -0,0 +1,123 @@
+"""
+Lookup of the instances Orthanc already stored, so repeated uploads of a study (retries, resumed or re-run jobs,
+see `filler.DETERMINISTIC_SOP_INSTANCE_UIDS`) only send the files which are missing.
+
+All instances of a study are listed with a single `/tools/find` request. A local file counts as stored if Orthanc
+has an instance with the same SOPInstanceUID, the same size and (optionally) the same MD5.
+
+Only depends on `requests` and `pydicom`, so it can be used by `upload_to_orthanc.py` outside of the converter.
+"""
+from __future__ import annotations
+import hashlib
+import io
+import os
+from dataclasses import dataclass
+from typing import Callable
+import pydicom
+import requests
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_READ_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class StoredInstance:
+    orthanc_id: str
+    file_size: int
+
+
+class StoredInstances:
+    """
+    The instances of a single study in Orthanc.
+
+    .. code-block:: python
+    stored = StoredInstances("http://orthanc-pacs:8042", study_instance_uid, headers=pacs_header_with_auth)
+    if not stored.contains(sop_instance_uid, os.path.getsize(path), lambda: file_md5(path)):
+        upload_file(path, pacs_header_with_auth)
+    """
+    def __init__(self, orthanc_url: str, study_instance_uid: str, verify_md5: bool = True, send: Callable[..., requests.Response] = requests.request, **request_kwargs) -> None:
+        """
+        :param orthanc_url: URL to the REST API of Orthanc.
+        :type orthanc_url: str
+        :param study_instance_uid: The StudyInstanceUID of the files which will be uploaded.
+        :type study_instance_uid: str
+        :param verify_md5: Whether the MD5 of a stored instance with the same UID and size is compared as well
+            (one additional request per instance, but no upload).
+        :type verify_md5: bool
+        :param send: Sends the requests, with the signature of `requests.request` (e.g. to add retries).
+        :type send: Callable[..., requests.Response]
+        :param request_kwargs: Passed on to every request (e.g. `headers` or `auth`).
+        """
+        self._orthanc_url = orthanc_url
+        self._verify_md5 = verify_md5
+        self._send = send
+        self._request_kwargs = request_kwargs
+        self._instances = self._find(study_instance_uid)
+        logger.info("Orthanc already stores %s instances of study %s", len(self._instances), study_instance_uid)
+
+    def __len__(self) -> int:
+        return len(self._instances)
+
+    def contains(self, sop_instance_uid: str, size: int, local_md5: Callable[[], str]) -> bool:
+        """
+        :param sop_instance_uid: The SOPInstanceUID of the local file.
+        :type sop_instance_uid: str
+        :param size: Size of the local file in bytes.
+        :type size: int
+        :param local_md5: Computes the MD5 (hex) of the local file, only called if UID and size match.
+        :type local_md5: Callable[[], str]
+        :return: Whether Orthanc already stores exactly this file.
+        :rtype: bool
+        """
+        instance = self._instances.get(sop_instance_uid)
+        if instance is None or instance.file_size != size:
+            return False
+        if not self._verify_md5:
+            return True
+        r = self._send("GET", f"{self._orthanc_url}/instances/{instance.orthanc_id}/attachments/dicom/md5", **self._request_kwargs)
+        if r.status_code == 404:
+            # Orthanc only knows the MD5 if "StoreMD5ForAttachments" is enabled (the default)
+            logger.info("Orthanc has no MD5 of instance %s, uploading it again", instance.orthanc_id)
+            return False
+        r.raise_for_status()
+        return r.text.strip().strip('"') == local_md5()
+
+    def _find(self, study_instance_uid: str) -> dict[str, StoredInstance]:
+        query = {
+            "Level": "Instance",
+            "Query": {"StudyInstanceUID": study_instance_uid},
+            "Expand": True
+        }
+        r = self._send("POST", f"{self._orthanc_url}/tools/find", json=query, **self._request_kwargs)
+        r.raise_for_status()
+        return {
+            instance["MainDicomTags"]["SOPInstanceUID"]: StoredInstance(instance["ID"], instance["FileSize"])
+            for instance in r.json()
+            if "SOPInstanceUID" in instance.get("MainDicomTags", {})
+        }
+
+
+def read_uids(dicom: str | os.PathLike | bytes) -> tuple[str, str]:
+    """
+    Read StudyInstanceUID and SOPInstanceUID from the header of a DICOM file, without the pixel data.
+
+    :param dicom: Path to the file or its content.
+    :type dicom: str | os.PathLike | bytes
+    :return: StudyInstanceUID and SOPInstanceUID.
+    :rtype: tuple[str, str]
+    """
+    source = io.BytesIO(dicom) if isinstance(dicom, (bytes, bytearray)) else dicom
+    ds = pydicom.dcmread(source, stop_before_pixels=True, specific_tags=["StudyInstanceUID", "SOPInstanceUID"])
+    return str(ds.StudyInstanceUID), str(ds.SOPInstanceUID)
+
+
+def file_md5(path: str | os.PathLike) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(_READ_BUFFER_SIZE):
+            md5.update(chunk)
+    return md5.hexdigest()
@@ -0,0 +1,217 @@
+from __future__ import annotations
+import json
+import os
+import threading
+import time
+import pika
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+RABBITMQ_HOST = "rabbitmq" # change-me
+# topic exchange, the routing key is "<business_id>.<stage>" so consumers can subscribe to a single job ("<uuid>.#") or to everything ("#")
+STATUS_EXCHANGE = "conversion_status" # change-me
+# at most one event per stage is published within this interval (the first and last event of a stage are always published)
+MIN_PUBLISH_INTERVAL_SECONDS = float(os.environ.get("CONVERTER_PROGRESS_INTERVAL_SECONDS", "2")) # change-me
+
+
+class ProgressReporter:
+    """
+    Publishes stage-level and fine-grained progress events of a single conversion job to the status exchange.
+
+    Every event is a json object like:
+
+    .. code-block:: json
+    {
+        "id": "<business id>",
+        "stage": "extract",
+        "event": "progress",
+        "unit": "bytes",
+        "done": 1048576,
+        "total": 4194304,
+        "percent": 25.0,
+        "throughput_per_second": 524288.0,
+        "eta_seconds": 6.0,
+        "timestamp": 1700000000.0
+    }
+
+    The events are throttled (see `MIN_PUBLISH_INTERVAL_SECONDS`). Reporting progress never fails the job:
+    if the broker is not reachable the error is logged and the event is dropped.
+    """
+    def __init__(self, business_id: str, publish: bool = True) -> None:
+        """
+        :param business_id: The business ID of the job.
+        :type business_id: str
+        :param publish: Whether events are published at all. If False, only the bookkeeping is done (used when no broker exists).
+        :type publish: bool
+        """
+        self.business_id = business_id
+        self._publish_enabled = publish
+        self._connection = None
+        self._channel = None
+        self._lock = threading.Lock()
+        self._stage: str | None = None
+        self._unit = ""
+        self._total: float | None = None
+        self._stage_started_at = 0.0
+        self._last_published_at = 0.0
+
+    def start_stage(self, stage: str, total: float | None = None, unit: str = "bytes", **extra) -> None:
+        """
+        Start a new stage (e.g. "extract", "convert", "fill", "send_to_pacs").
+
+        :param stage: Name of the stage.
+        :type stage: str
+        :param total: The expected amount of work in `unit`, if known. Needed for the ETA.
+        :type total: float | None
+        :param unit: The unit of the progress (e.g. "bytes", "instances").
+        :type unit: str
+        """
+        with self._lock:
+            self._stage = stage
+            self._unit = unit
+            self._total = total
+            self._stage_started_at = time.monotonic()
+            self._last_published_at = 0.0
+        self._publish({"event": "stage_started", "unit": unit, "total": total, **extra})
+
+    def update(self, done: float, total: float | None = None, **extra) -> None:
+        """
+        Report the progress of the current stage. Calls within `MIN_PUBLISH_INTERVAL_SECONDS` of the previous
+        published event are dropped, so this may be called for every tile/chunk.
+
+        :param done: The amount of work done in this stage so far (in the unit of the stage).
+        :type done: float
+        :param total: Updated expected total, if it changed.
+        :type total: float | None
+        """
+        now = time.monotonic()
+        with self._lock:
+            if total is not None:
+                self._total = total
+            if now - self._last_published_at < MIN_PUBLISH_INTERVAL_SECONDS:
+                return
+            self._last_published_at = now
+            event = self._progress_event(done, now)
+        event.update(extra)
+        self._publish(event)
+
+    def finish_stage(self, **extra) -> None:
+        with self._lock:
+            duration = time.monotonic() - self._stage_started_at
+        self._publish({"event": "stage_finished", "duration_seconds": round(duration, 3), **extra})
+
+    def job_finished(self, converted: bool, error_msg: str = "") -> None:
+        """
+        Publish the final event of the job (stage "job", event "completed" or "failed").
+        """
+        with self._lock:
+            self._stage = "job"
+        self._publish({"event": "completed" if converted else "failed", "converted": converted, "error_msg": error_msg})
+
+    def job_retrying(self, delay_seconds: int, attempt: int, error_msg: str = "") -> None:
+        """
+        Publish that the job failed transiently and runs again after the delay (stage "job", event "retrying").
+        """
+        with self._lock:
+            self._stage = "job"
+        self._publish({"event": "retrying", "delay_seconds": delay_seconds, "attempt": attempt, "error_msg": error_msg})
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None and self._connection.is_open:
+                try:
+                    self._connection.close()
+                except Exception as e:
+                    logger.debug("Error while closing connection to the broker %s", e)
+            self._connection = None
+            self._channel = None
+
+    def _progress_event(self, done: float, now: float) -> dict:
+        elapsed = now - self._stage_started_at
+        throughput = done / elapsed if elapsed > 0 else None
+        event = {
+            "event": "progress",
+            "unit": self._unit,
+            "done": done,
+            "total": self._total,
+            "throughput_per_second": round(throughput, 3) if throughput else None,
+            "percent": None,
+            "eta_seconds": None
+        }
+        if self._total:
+            event["percent"] = round(min(done / self._total, 1.0) * 100, 2)
+            if throughput:
+                event["eta_seconds"] = round(max(self._total - done, 0) / throughput, 1)
+        return event
+
+    def _publish(self, event: dict) -> None:
+        if not self._publish_enabled:
+            return
+        with self._lock:
+            stage = self._stage or "job"
+            event = {"id": self.business_id, "stage": stage, **event, "timestamp": time.time()}
+            body = json.dumps(event)
+            # a single reconnect, the connection may have been closed by the broker during a long stage without events
+            for attempt in range(2):
+                try:
+                    channel = self._get_channel()
+                    channel.basic_publish(exchange=STATUS_EXCHANGE, routing_key=f"{self.business_id}.{stage}", body=body)
+                    return
+                except Exception as e:
+                    self._connection = None
+                    self._channel = None
+                    if attempt == 1:
+                        logger.warning("Could not publish progress event for %s: %s", self.business_id, e)
+
+    def _get_channel(self):
+        if self._channel is None or self._connection is None or not self._connection.is_open:
+            self._connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
+            self._channel = self._connection.channel()
+            self._channel.exchange_declare(exchange=STATUS_EXCHANGE, exchange_type="topic")
+        return self._channel
+
+
+class FolderSizeMonitor:
+    """
+    Reports the amount of bytes written into a folder in a background thread. Used for stages which do not
+    provide progress callbacks themselves (e.g. the conversion through wsidicomizer).
+    """
+    def __init__(self, reporter: ProgressReporter, path: str, interval_seconds: float = MIN_PUBLISH_INTERVAL_SECONDS) -> None:
+        self._reporter = reporter
+        self._path = path
+        self._interval_seconds = interval_seconds
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> FolderSizeMonitor:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self._interval_seconds):
+            files_written, bytes_written = folder_size(self._path)
+            self._reporter.update(bytes_written, files_written=files_written)
+
+
+def folder_size(path: str) -> tuple[int, int]:
+    """
+    :return: The amount of files and their total size in bytes in the folder (and its subfolders).
+    :rtype: tuple[int, int]
+    """
+    files = 0
+    size = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(root, filename))
+                files += 1
+            except OSError:
+                pass # file was removed in the meantime
+    return files, size
@@ -0,0 +1,242 @@
+from __future__ import annotations
+import atexit
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.pool
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+PROP_DB_HOST = "prop-postgres" # container name change-me
+PROP_DB_PORT = "5432" # port defined in docker-compose.yml change-me
+PROP_DB_NAME = "prop" # defined in db.sql in prop folder change-me
+PROP_DB_USER = "postgres" # defined in environment variables for prop-postgres container secret-me
+PROP_DB_PASSWORD = "postgres" # defined in environment variables for prop-postgres container secret-me
+
+# upper bound of open connections of this process, callers wait (up to POOL_TIMEOUT_SECONDS) if all are in use
+POOL_MIN_CONNECTIONS = int(os.environ.get("PROP_DB_POOL_MIN", "1")) # change-me
+POOL_MAX_CONNECTIONS = int(os.environ.get("PROP_DB_POOL_MAX", "8")) # change-me
+POOL_TIMEOUT_SECONDS = float(os.environ.get("PROP_DB_POOL_TIMEOUT_SECONDS", "30")) # change-me
+# connections idle for longer than this are checked with "SELECT 1" before they are handed out
+HEALTH_CHECK_AFTER_IDLE_SECONDS = 30.0
+# asynchronous writes are flushed in one transaction once this many are queued or the interval passed
+BATCH_MAX_SIZE = 100
+BATCH_FLUSH_INTERVAL_SECONDS = float(os.environ.get("PROP_DB_BATCH_FLUSH_INTERVAL_SECONDS", "1")) # change-me
+
+_pool: psycopg2.pool.ThreadedConnectionPool | None = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises instead of blocking when exhausted, the semaphore makes callers wait instead
+_pool_slots = threading.BoundedSemaphore(POOL_MAX_CONNECTIONS)
+_last_used: dict[int, float] = {}
+
+
+def connect():
+    """
+    Open a new connection to the prop database, which is not part of the pool. The caller is responsible
+    for committing and closing it. Only needed for long-lived connections (e.g. LISTEN), use `connection()` otherwise.
+
+    :return: A psycopg2 connection.
+    """
+    conn = psycopg2.connect(
+        host=PROP_DB_HOST,
+        port=PROP_DB_PORT,
+        database=PROP_DB_NAME,
+        user=PROP_DB_USER,
+        password=PROP_DB_PASSWORD
+    )
+    logger.debug("Established connection to prop database.")
+    return conn
+
+
+@contextmanager
+def connection():
+    """
+    Borrow a connection from the process-wide pool. The transaction is committed if the block succeeds and
+    rolled back otherwise. Broken connections are discarded instead of being returned to the pool.
+
+    .. code-block:: python
+    with prop_db.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(...)
+
+    :raises TimeoutError: No connection became available within `POOL_TIMEOUT_SECONDS`.
+    """
+    if not _pool_slots.acquire(timeout=POOL_TIMEOUT_SECONDS):
+        raise TimeoutError(f"No prop database connection available within {POOL_TIMEOUT_SECONDS} seconds!")
+    conn = None
+    broken = False
+    try:
+        conn = _get_healthy_connection()
+        yield conn
+        conn.commit()
+    except Exception:
+        if conn is not None:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        raise
+    finally:
+        if conn is not None:
+            broken = broken or conn.closed != 0
+            _last_used[id(conn)] = time.monotonic()
+            _get_pool().putconn(conn, close=broken)
+            if broken:
+                _last_used.pop(id(conn), None)
+        _pool_slots.release()
+
+
+def execute(sql: str, params: tuple | None = None) -> None:
+    """
+    Execute a single statement synchronously in its own transaction using a pooled connection.
+    """
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+
+
+def execute_async(sql: str, params: tuple | None = None) -> None:
+    """
+    Queue a statement which is written in the background together with other queued statements (see `BatchWriter`).
+    Use for rows which are not needed immediately (e.g. the job ledger), so the database round trip is not on
+    the conversion path. Errors are logged, the statement is not retried.
+    """
+    _get_batch_writer().submit(sql, params)
+
+
+def flush(timeout: float | None = None) -> bool:
+    """
+    Wait until all statements queued with `execute_async` are written.
+
+    :return: False if the timeout passed before everything was written.
+    :rtype: bool
+    """
+    if _batch_writer is None:
+        return True
+    return _batch_writer.flush(timeout)
+
+
+def _get_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = psycopg2.pool.ThreadedConnectionPool(
+                POOL_MIN_CONNECTIONS,
+                POOL_MAX_CONNECTIONS,
+                host=PROP_DB_HOST,
+                port=PROP_DB_PORT,
+                database=PROP_DB_NAME,
+                user=PROP_DB_USER,
+                password=PROP_DB_PASSWORD
+            )
+            logger.info("Created prop database pool with %s to %s connections.", POOL_MIN_CONNECTIONS, POOL_MAX_CONNECTIONS)
+        return _pool
+
+
+def _get_healthy_connection():
+    pool = _get_pool()
+    # e.g. after the database was restarted, every idle connection of the pool is broken. They are discarded one
+    # after the other until the pool opens a new connection, which is checked as well.
+    for _ in range(POOL_MAX_CONNECTIONS + 1):
+        conn = pool.getconn()
+        if _is_healthy(conn):
+            return conn
+        _last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    raise psycopg2.OperationalError(f"Got no healthy prop database connection in {POOL_MAX_CONNECTIONS + 1} attempts!")
+
+
+def _is_healthy(conn) -> bool:
+    idle_for = time.monotonic() - _last_used.get(id(conn), 0.0)
+    if conn.closed == 0 and idle_for < HEALTH_CHECK_AFTER_IDLE_SECONDS:
+        return True
+    try:
+        if conn.closed != 0:
+            raise psycopg2.InterfaceError("connection already closed")
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error as e:
+        logger.info("Discarding broken prop database connection: %s", e)
+        return False
+
+
+class BatchWriter:
+    """
+    Writes queued statements in a background thread. All statements queued within `BATCH_FLUSH_INTERVAL_SECONDS`
+    (at most `BATCH_MAX_SIZE`) are written in a single transaction with one pooled connection. If the batch fails,
+    the statements are retried one by one, so a single bad row does not drop the others.
+    """
+    def __init__(self) -> None:
+        self._queue: queue.Queue[tuple[str, tuple | None] | None] = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="prop-db-batch-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, sql: str, params: tuple | None) -> None:
+        self._queue.put((sql, params))
+
+    def flush(self, timeout: float | None = None) -> bool:
+        # Queue.join does not support a timeout, so wait for it in a helper thread
+        joiner = threading.Thread(target=self._queue.join, daemon=True)
+        joiner.start()
+        joiner.join(timeout)
+        return not joiner.is_alive()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + BATCH_FLUSH_INTERVAL_SECONDS
+            while len(batch) < BATCH_MAX_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    @staticmethod
+    def _write(batch: list[tuple[str, tuple | None]]) -> None:
+        try:
+            with connection() as conn:
+                with conn.cursor() as cur:
+                    for sql, params in batch:
+                        cur.execute(sql, params)
+            logger.debug("Wrote batch of %s statements to the prop database.", len(batch))
+            return
+        except Exception as e:
+            if len(batch) == 1:
+                logger.warning("Could not write to the prop database: %s", e)
+                return
+            logger.info("Batch of %s statements failed (%s), writing them one by one.", len(batch), e)
+        for sql, params in batch:
+            try:
+                execute(sql, params)
+            except Exception as e:
+                logger.warning("Could not write to the prop database: %s", e)
+
+
+_batch_writer: BatchWriter | None = None
+
+
+def _get_batch_writer() -> BatchWriter:
+    global _batch_writer
+    with _pool_lock:
+        if _batch_writer is None:
+            _batch_writer = BatchWriter()
+        return _batch_writer
+
+
+atexit.register(flush, 10.0)
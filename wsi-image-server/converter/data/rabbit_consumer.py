@@ -1,10 +1,26 @@
 import pika, sys, os
-from threading import Thread
+import time
+import struct
+from pathlib import Path
 import converter
 import filler
 from concurrent import futures
 import sender
+import progress
+import job_ledger
+import metrics
+import tracing
+import diagnostics
+import admission
+import scratch
+import scheduler
+import job_intake
+import job_lease
+import job_manifest
+import retry_policy
+from contextlib import nullcontext
 import json
+import uuid
 from exceptions import format_exception
 import logging
 
@@ -12,35 +28,315 @@ logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(n
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-def main():
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq')) # change-me
-    channel = connection.channel()
+# unacknowledged messages per replica. A message is acknowledged as soon as it is stored in the job intake
+# (see job_intake.py), the scheduler orders all pending jobs of the intake, not only the received messages.
+PREFETCH_COUNT = int(os.environ.get("CONVERTER_PREFETCH_COUNT", "32")) # change-me
+RABBITMQ_HOST = "rabbitmq" # change-me
+# wait before reconnecting after the broker closed the connection or channel, and before returning a message
+# to the queue which could not be stored in the intake
+RECONNECT_DELAY_SECONDS = 5.0
 
-    queue_name = 'hello' # matches queue name in HAPI FHIR interceptor
+def _tarball_size(path_to_wsi_tarball: str | None) -> int | None:
+    # same path handling as in the converter: "./app/create-data/<uuid>.tar.gz" -> "create-data/<uuid>.tar.gz"
+    if not path_to_wsi_tarball:
+        return None
+    path_object = Path(path_to_wsi_tarball)
+    try:
+        return os.path.getsize(path_object.relative_to(*path_object.parts[:1]))
+    except (OSError, ValueError):
+        return None
 
-    channel.queue_declare(queue=queue_name) 
-    
-    def start_conversion(json_body: str):
-        data = json.loads(json_body)
-        business_id: str = data["uuid"]
-        try:
-            conv, kc_info = converter.Converter.fromBroker(data)
-            business_id, path_to_dcm_folder = conv.handle()
-            sender.send_and_cleanup(business_id, kc_info=kc_info, path_to_dcm_folder=path_to_dcm_folder)
-            sender.update_prop_db_status(business_id, converted=True)
+def _uncompressed_size(path_to_wsi_tarball: str | None, input_bytes: int | None) -> int:
+    if input_bytes is None:
+        return 0 # the job fails while extracting anyway
+    path_object = Path(path_to_wsi_tarball)
+    try:
+        return admission.uncompressed_tarball_size(str(path_object.relative_to(*path_object.parts[:1])))
+    except (OSError, ValueError, struct.error):
+        return input_bytes
+
+def expected_job_bytes(data: dict) -> int:
+    """
+    The expected size of a job for scheduling: the size hint of the message ("size_bytes") if present, else
+    the extracted size of the tarball, which is read from the gzip trailer and therefore cheap.
+    """
+    size_hint = data.get("size_bytes")
+    if isinstance(size_hint, int) and size_hint > 0:
+        return size_hint
+    return _uncompressed_size(data.get("path_to_wsi_tarball"), _tarball_size(data.get("path_to_wsi_tarball")))
+
+def dead_letter_queue_name(queue_name: str) -> str:
+    return f"{queue_name}.dead-letter"
+
+class BrokerConnection:
+    """
+    The connection and channel of the consumer, both are replaced after the broker closed them. The channel must
+    only be used from the connection thread, workers hand their messages over with `publish_threadsafe`.
+    """
+    def __init__(self, host: str, queue_name: str) -> None:
+        self.host = host
+        self.queue_name = queue_name
+        self.connection: pika.BlockingConnection | None = None
+        self.channel = None
+
+    def connect(self) -> None:
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
+        channel = self.connection.channel()
+        channel.queue_declare(queue=self.queue_name)
+        channel.queue_declare(queue=dead_letter_queue_name(self.queue_name))
+        channel.basic_qos(prefetch_count=PREFETCH_COUNT)
+        self.channel = channel
+
+    def dead_letter(self, body: str | bytes, attempt: int, error_msg: str) -> None:
+        """
+        Publish a message to the dead-letter queue, which keeps permanently failed jobs for inspection and manual
+        replay. Only from the connection thread, see `publish_threadsafe`.
+        """
+        properties = pika.BasicProperties(headers={"x-retry-attempt": attempt, "x-error": error_msg[:4096]})
+        self.channel.basic_publish(exchange="", routing_key=dead_letter_queue_name(self.queue_name), body=body, properties=properties)
+
+    def dead_letter_threadsafe(self, body: str | bytes, attempt: int, error_msg: str) -> None:
+        def run() -> None:
+            try:
+                self.dead_letter(body, attempt, error_msg)
+            except Exception as e:
+                # raised in the connection thread, it must not stop consuming
+                logger.warning("Could not publish to the dead-letter queue: %s", e)
+        try:
+            self.connection.add_callback_threadsafe(run)
+        except Exception as e:
+            logger.warning("Could not hand the dead-letter message to the broker connection: %s", e)
+
+    def close(self) -> None:
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except Exception as e:
+            logger.debug("Could not close the broker connection: %s", e)
+
+class IntakeDelivery:
+    """
+    A pending job of the intake (see job_intake.py) handed to a worker. The outcome is written back to the intake:
+    a transient failure postpones the job, a completed or permanently failed job is removed. Errors are logged, a
+    job which is still pending is offered again with the next poll of the intake.
+    """
+    def __init__(self, broker: BrokerConnection | None, job: job_intake.PendingJob) -> None:
+        self.broker = broker
+        self.job = job
+
+    @property
+    def body(self) -> str:
+        return self.job.body
+
+    @property
+    def attempt(self) -> int:
+        # amount of job-level retries so far
+        return self.job.attempt
+
+    def refresh(self) -> bool:
+        """
+        Re-read the job once its lease is held, the scheduler may have queued it before another replica ran or
+        postponed it.
+
+        :return: Whether the job is still pending and may run now.
+        :rtype: bool
+        """
+        job = job_intake.get_due(self.job.business_id)
+        if job is None:
+            return False
+        self.job = job
+        return True
+
+    def requeue(self, delay_seconds: int) -> None:
+        try:
+            job_intake.postpone(self.job.business_id, delay_seconds)
         except Exception as e:
-            sender.update_prop_db_status(business_id, converted=False, error_msg=format_exception(e))
+            logger.warning("Could not postpone job %s, it is retried with the next poll: %s", self.job.business_id, e)
 
+    def dead_letter(self, error_msg: str) -> None:
+        if self.broker is not None:
+            self.broker.dead_letter_threadsafe(self.job.body, self.job.attempt, error_msg)
+        self.complete()
+
+    def complete(self) -> None:
+        try:
+            job_intake.remove(self.job.business_id)
+        except Exception as e:
+            # handled again, a completed job is skipped (see start_conversion)
+            logger.warning("Could not remove job %s from the intake: %s", self.job.business_id, e)
+
+def start_conversion(json_body: str, publish_progress: bool = True, delivery: IntakeDelivery | None = None) -> bool:
+    """
+    Run a single conversion job from a broker message.
+
+    :param json_body: The message as sent by the FHIR server.
+    :type json_body: str
+    :param publish_progress: Whether progress and completion events are published to the status exchange.
+    :type publish_progress: bool
+    :param delivery: The job of the intake, needed to postpone transient failures and dead-letter permanent ones.
+        Without it, every failure is final.
+    :type delivery: IntakeDelivery | None
+    :return: Whether the job was converted and uploaded. Failures are written to the prop database, not raised.
+    :rtype: bool
+    """
+    data = json.loads(json_body)
+    business_id: str = data["uuid"]
+    lease = job_lease.JobLease(business_id)
+    # a replica which crashed holds the lease until it expires, the job stays in the intake and is offered again then
+    if not lease.acquire():
+        logger.info("Job %s is handled by another replica, skipping it.", business_id)
+        return False
+    try:
+        if delivery is not None and not delivery.refresh():
+            logger.info("Job %s was handled or postponed by another replica, skipping it.", business_id)
+            return False
+        if job_lease.get_completion(business_id, "job") is not None:
+            logger.info("Job %s already completed, ignoring the duplicate message.", business_id)
+            if delivery is not None:
+                delivery.complete()
+            return True
+        return _run_job(data, business_id, publish_progress, lease, delivery)
+    finally:
+        lease.release()
+
+def _run_job(data: dict, business_id: str, publish_progress: bool, lease: job_lease.JobLease, delivery: IntakeDelivery | None) -> bool:
+    progress_reporter = progress.ProgressReporter(business_id, publish=publish_progress)
+    ledger = job_ledger.JobLedger(business_id)
+    ledger.lease = lease
+    input_bytes = _tarball_size(data.get("path_to_wsi_tarball"))
+    # wait for scratch space before anything is extracted, memory is reserved before the conversion (see
+    # Converter.prepare_conversion) or, for a RAM-backed folder, together with the scratch space
+    uncompressed_bytes = _uncompressed_size(data.get("path_to_wsi_tarball"), input_bytes)
+    job_folder = scratch.manager.reserve(business_id, scratch.estimate_disk_bytes(uncompressed_bytes), memory_bytes=admission.estimate_memory_bytes(uncompressed_bytes))
+    try:
+        # checkpoints of a previous attempt, the job resumes at the first incomplete stage
+        manifest = job_manifest.JobManifest(business_id, folder=job_folder)
+        ledger.start_job(input_bytes=input_bytes)
+        metrics.add_bytes("input", input_bytes)
+        output_bytes = None
+        # cProfile/tracemalloc per stage, only for flagged or sampled jobs
+        ledger.diagnostics = diagnostics.JobDiagnostics(business_id) if diagnostics.should_diagnose(data) else None
+        with ledger.diagnostics or nullcontext(), metrics.track_job(), tracing.span("conversion_job", business_id=business_id, input_bytes=input_bytes) as job_span:
+            try:
+                conv, kc_info = converter.Converter.fromBroker(data, progress_reporter, ledger, manifest)
+                business_id, path_to_dcm_folder = conv.handle()
+                _, output_bytes = progress.folder_size(path_to_dcm_folder) # before the files are deleted by the sender
+                metrics.add_bytes("output", output_bytes)
+                job_span.set_attribute("output_bytes", output_bytes)
+                sender.send_and_cleanup(business_id, kc_info=kc_info, path_to_dcm_folder=path_to_dcm_folder, progress_reporter=progress_reporter, ledger=ledger, manifest=manifest)
+                sender.update_prop_db_status(business_id, converted=True)
+                _mark_job_completed(business_id)
+                if delivery is not None:
+                    delivery.complete()
+                progress_reporter.job_finished(converted=True)
+                metrics.job_succeeded()
+                return True
+            except Exception as e:
+                error_msg = format_exception(e)
+                job_span.set_attribute("error", error_msg)
+                if lease.lost:
+                    # another replica took the job over, it records the outcome
+                    logger.warning("Stopped job %s after losing its lease: %s", business_id, error_msg)
+                    return False
+                delay_seconds = retry_policy.job_retry_delay(e, delivery.attempt) if delivery is not None else None
+                if delay_seconds is not None:
+                    # resumes at the first incomplete stage (see JobManifest), the outcome is not final yet
+                    logger.warning("Job %s failed transiently, retrying in %ss: %s", business_id, delay_seconds, error_msg)
+                    metrics.job_retried()
+                    progress_reporter.job_retrying(delay_seconds, delivery.attempt + 1, error_msg=error_msg)
+                    delivery.requeue(delay_seconds)
+                    return False
+                metrics.job_failed(e)
+                sender.update_prop_db_status(business_id, converted=False, error_msg=error_msg)
+                progress_reporter.job_finished(converted=False, error_msg=error_msg)
+                if delivery is not None:
+                    delivery.dead_letter(error_msg)
+                # the job will not be resumed, a manual replay from the dead-letter queue starts over
+                scratch.manager.remove(business_id)
+                return False
+            finally:
+                ledger.finish_job(output_bytes=output_bytes)
+                progress_reporter.close()
+    finally:
+        # also if the job fails before it started, e.g. the manifest could not be read
+        scratch.manager.release(business_id)
+        admission.controller.release(business_id)
+
+def _mark_job_completed(business_id: str) -> None:
+    try:
+        job_lease.mark_completed(business_id, "job")
+    except Exception as e:
+        # the job succeeded, a redelivery would only repeat the PACS upload (FHIR and Keycloak are checkpointed in the manifest)
+        logger.warning("Could not mark job %s as completed: %s", business_id, e)
+
+def _run_delivery(delivery: IntakeDelivery) -> None:
+    try:
+        start_conversion(delivery.body, delivery=delivery)
+    except Exception as e:
+        # failed before the job started (e.g. prop database not reachable for the lease)
+        logger.exception("Could not start job %s", delivery.job.business_id)
+        delay_seconds = retry_policy.job_retry_delay(e, delivery.attempt)
+        if delay_seconds is not None:
+            delivery.requeue(delay_seconds)
+        else:
+            delivery.dead_letter(format_exception(e))
+
+def main():
+    queue_name = 'hello' # matches queue name in HAPI FHIR interceptor
+
+    broker = BrokerConnection(RABBITMQ_HOST, queue_name)
+    metrics.start(queue_name, RABBITMQ_HOST)
+    # folders of jobs which crashed or failed with this (or a previous) process
+    scratch.manager.start_reclaimer()
+    # a bounded pool of workers, fair between users and shortest expected job first (see scheduler.py), over all
+    # pending jobs of the intake
+    def run(job: job_intake.PendingJob) -> None:
+        try:
+            _run_delivery(IntakeDelivery(broker, job))
+        finally:
+            # offered again with the next poll if it is still pending (postponed, or run by a replica which crashed)
+            feeder.done(job.business_id)
+    job_scheduler = scheduler.Scheduler(run, workers=metrics.WORKER_CAPACITY)
+    feeder = job_intake.IntakeFeeder(lambda job: job_scheduler.submit(job.business_id, job, job.expected_bytes, job.user))
+    job_scheduler.start()
+    feeder.start()
+    
     def callback(ch, method, properties, body):
         logger.debug(" [x] Received %r", body)
-        t = Thread(target=start_conversion, args=[body])
-        t.start()
+        attempt = (properties.headers or {}).get("x-retry-attempt", 0)
+        try:
+            data = json.loads(body)
+            business_id = str(uuid.UUID(data["uuid"]))
+            job = job_intake.PendingJob(business_id, body.decode("utf-8"), data.get("keycloak_user_id"), expected_job_bytes(data), attempt)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            # can never become a job
+            logger.error("Dead-lettering invalid message %s: %r", method.delivery_tag, e)
+            broker.dead_letter(body, attempt, format_exception(e))
+            ch.basic_ack(method.delivery_tag)
+            return
+        try:
+            job_intake.accept(job)
+        except Exception as e:
+            logger.warning("Could not store job %s in the intake, returning it to the queue in %ss: %s", business_id, RECONNECT_DELAY_SECONDS, e)
+            broker.connection.sleep(RECONNECT_DELAY_SECONDS)
+            ch.basic_nack(method.delivery_tag, requeue=True)
+            return
+        ch.basic_ack(method.delivery_tag)
+        feeder.offer(job)
 
     print(' [*] Awaiting RPC request. To exit press CTRL+C')
 
-    channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=True)
-
-    channel.start_consuming()
+    # running jobs keep running while reconnecting, unacknowledged messages are redelivered by the broker and
+    # stored in the intake only once
+    while True:
+        try:
+            broker.connect()
+            broker.channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=False)
+            broker.channel.start_consuming()
+        except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as e:
+            logger.warning("Lost the connection to the broker, reconnecting in %ss: %r", RECONNECT_DELAY_SECONDS, e)
+            broker.close()
+            time.sleep(RECONNECT_DELAY_SECONDS)
 
 if __name__ == '__main__':
     try:
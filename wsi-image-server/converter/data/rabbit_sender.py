@@ -1,29 +1,306 @@
+"""
+Load generator for the converter. Publishes valid conversion messages (the same fields the HAPI FHIR interceptor
+sends, see `Converter.fromBroker`) at a configurable rate and shape, and collects the completion events from the
+status exchange (see `progress.py`) to compute end-to-end latency percentiles and the sustained jobs/hour.
+
+Against the RabbitMQ and the prop database of the docker stack, e.g. from the converter container (the tarball has
+to exist in the shared create-data volume):
+
+    python rabbit_sender.py --tarball "./app/create-data/CMU-1.tar.gz" --path-in-tarball "Generic CMU-1.tiff" \
+        --shape poisson --rate 0.05 --count 50 --output load.json
+
+Without a broker, the messages are handled by the consumer code in this process against the fake services of
+the benchmark (Orthanc, HAPI FHIR, Keycloak and prop DB stand-ins), run from the converter folder:
+
+    python rabbit_sender.py --in-process --tarball "./app/create-data/CMU-1.tar.gz" --path-in-tarball "Generic CMU-1.tiff" \
+        --shape burst --burst-size 8 --burst-interval 60 --count 32
+"""
+from __future__ import annotations
+import argparse
+import json
+import math
+import queue
+import random
+import statistics
+import sys
+import time
+import uuid
 import pika
+import progress
+import prop_db
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+RABBITMQ_HOST = "rabbitmq" # change-me
+QUEUE_NAME = "hello" # matches queue name in HAPI FHIR interceptor and rabbit_consumer.py
+DEFAULT_TAGS = [
+    {"key": "PatientName", "value": "Load Test"},
+    {"key": "PatientID", "value": "load-test-patient"},
+    {"key": "PatientAge", "value": "042Y"},
+    {"key": "PatientBirthDate", "value": "19700101"},
+    {"key": "PatientSex", "value": "O"}
+]
+LATENCY_PERCENTILES = (50, 90, 95, 99)
+# seconds `InProcessBroker.close` waits for running jobs before the fake services are stopped
+IN_PROCESS_STOP_TIMEOUT = 60.0
+
 
-connection = pika.BlockingConnection(
-    pika.ConnectionParameters(host='rabbitmq'))
-channel = connection.channel()
-
-channel.queue_declare(queue='hello')
-
-json_body = \
-    """
-    {
-        "uuid": "70e158e3-50e4-40ff-880b-3b95a532c195",
-        "path": "some/test/path/file.tar.gz",
-        "tags": [
-            {
-                "key": "0010,0010",
-                "value": "Peter"
-            },
-            {
-                "key": "0010,0020",
-                "value": "5"
-            }
-        ]
+def send_times(shape: str, count: int, rate: float, burst_size: int = 1, burst_interval: float = 60.0, ramp_to: float | None = None, seed: int = 0) -> list[float]:
+    """
+    Offsets (in seconds after the start) at which the messages are published.
+
+    :param shape: "constant" (evenly spaced), "poisson" (exponential inter-arrival times), "burst" (`burst_size`
+        messages at once every `burst_interval` seconds) or "ramp" (rate increases linearly from `rate` to `ramp_to`).
+    :type shape: str
+    :param count: Amount of messages.
+    :type count: int
+    :param rate: Messages per second.
+    :type rate: float
+    :rtype: list[float]
+    """
+    if shape == "constant":
+        return [i / rate for i in range(count)]
+    if shape == "poisson":
+        rng = random.Random(seed)
+        offsets = [0.0]
+        while len(offsets) < count:
+            offsets.append(offsets[-1] + rng.expovariate(rate))
+        return offsets
+    if shape == "burst":
+        return [(i // burst_size) * burst_interval for i in range(count)]
+    if shape == "ramp":
+        # the rate grows linearly over the messages, the offset of message i is the integral of 1/rate
+        end_rate = ramp_to if ramp_to is not None else rate
+        offsets = [0.0]
+        for i in range(1, count):
+            current_rate = rate + (end_rate - rate) * i / max(count - 1, 1)
+            offsets.append(offsets[-1] + 1 / current_rate)
+        return offsets
+    raise ValueError(f"Unknown shape {shape}!")
+
+
+def build_message(path_to_wsi_tarball: str, path_in_tarball: str, keycloak_user_id: str) -> tuple[str, str]:
+    """
+    :return: The business ID and the json message.
+    :rtype: tuple[str, str]
+    """
+    business_id = str(uuid.uuid4())
+    message = {
+        "uuid": business_id,
+        "keycloak_user_id": keycloak_user_id,
+        "path_to_wsi_tarball": path_to_wsi_tarball,
+        "path_in_tarball_for_openslide": path_in_tarball,
+        "tags": DEFAULT_TAGS
     }
+    return business_id, json.dumps(message)
+
+
+class RabbitMQBroker:
+    """
+    Publishes to the conversion queue and receives the completion events ("<uuid>.job") from the status exchange.
+    Both happen on a single connection in the thread of the load generator.
+
+    Every job needs its row in the `data` table of the prop database (the ledger, lease and completion tables
+    reference it), which the FHIR server creates before it publishes a message. The rows of the generated jobs are
+    created before publishing and deleted (with everything referencing them) on `close`.
+    """
+    def __init__(self, host: str) -> None:
+        self._business_ids: list[str] = []
+        self._connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+        self._channel = self._connection.channel()
+        self._channel.queue_declare(queue=QUEUE_NAME)
+        self._channel.exchange_declare(exchange=progress.STATUS_EXCHANGE, exchange_type="topic")
+        events_queue = self._channel.queue_declare(queue="", exclusive=True).method.queue
+        self._channel.queue_bind(queue=events_queue, exchange=progress.STATUS_EXCHANGE, routing_key="*.job")
+        self._completions: list[tuple[str, bool, float]] = []
+        self._channel.basic_consume(queue=events_queue, on_message_callback=self._on_event, auto_ack=True)
+
+    def publish(self, business_id: str, body: str) -> None:
+        # same row as ProprietaryFileReceiveHandler.insertToDatabase of the FHIR server
+        sql = \
+            """
+            INSERT INTO data (id, path_to_file, converted) VALUES (%s::UUID, %s, %s)
+            ON CONFLICT (id) DO UPDATE SET path_to_file=excluded.path_to_file, converted=excluded.converted
+            """
+        prop_db.execute(sql, (business_id, json.loads(body)["path_to_wsi_tarball"], False))
+        self._business_ids.append(business_id)
+        self._channel.basic_publish(exchange="", routing_key=QUEUE_NAME, body=body)
+
+    def poll(self, timeout: float) -> list[tuple[str, bool, float]]:
+        """
+        :return: (business ID, converted, monotonic receive time) of all jobs completed since the last call.
+        """
+        self._connection.process_data_events(time_limit=max(timeout, 0))
+        completions, self._completions = self._completions, []
+        return completions
+
+    def close(self) -> None:
+        self._connection.close()
+        if not self._business_ids:
+            return
+        try:
+            # jobs which did not complete are removed from the intake as well, so they are not retried
+            prop_db.execute("DELETE FROM job_intake WHERE job_id = ANY(%s::UUID[])", (self._business_ids,))
+            prop_db.execute("DELETE FROM data WHERE id = ANY(%s::UUID[])", (self._business_ids,))
+            logger.info("Deleted the prop database rows of %s generated jobs.", len(self._business_ids))
+        except Exception as e:
+            logger.warning("Could not delete the prop database rows of the generated jobs: %s", e)
+
+    def _on_event(self, ch, method, properties, body) -> None:
+        event = json.loads(body)
+        if event.get("event") in ("completed", "failed"):
+            self._completions.append((event["id"], bool(event.get("converted")), time.monotonic()))
+
+
+class InProcessBroker:
     """
+    Stand-in for RabbitMQ: every message is handled by `rabbit_consumer.start_conversion` on the same scheduler
+    the consumer uses (see scheduler.py), against the fake services of the benchmark.
+    """
+    def __init__(self, workers: int) -> None:
+        from benchmark.fake_services import FakePropDB, FakeServices
+        import rabbit_consumer
+        import scheduler
+        import tracing
+        tracing.TRACE_FILE = ""
+        self._start_conversion = rabbit_consumer.start_conversion
+        self._expected_job_bytes = rabbit_consumer.expected_job_bytes
+        self._services = FakeServices().__enter__()
+        self._prop_db = FakePropDB().__enter__()
+        self._completions: queue.Queue[tuple[str, bool, float]] = queue.Queue()
+        self._scheduler = scheduler.Scheduler(lambda job: self._run(*job), workers=workers)
+        self._scheduler.start()
+
+    def publish(self, business_id: str, body: str) -> None:
+        data = json.loads(body)
+        self._scheduler.submit(business_id, (business_id, body), self._expected_job_bytes(data), data["keycloak_user_id"])
+
+    def poll(self, timeout: float) -> list[tuple[str, bool, float]]:
+        completions = []
+        try:
+            completions.append(self._completions.get(timeout=max(timeout, 0.001)))
+            while True:
+                completions.append(self._completions.get_nowait())
+        except queue.Empty:
+            pass
+        return completions
+
+    def close(self) -> None:
+        # queued jobs are dropped, running ones still need the fake services
+        self._scheduler.stop(IN_PROCESS_STOP_TIMEOUT)
+        self._prop_db.__exit__(None, None, None)
+        self._services.__exit__(None, None, None)
+
+    def _run(self, business_id: str, body: str) -> None:
+        converted = self._start_conversion(body, publish_progress=False)
+        self._completions.put((business_id, converted, time.monotonic()))
+
+
+def run_load(broker, offsets: list[float], path_to_wsi_tarball: str, path_in_tarball: str, keycloak_user_id: str, timeout: float) -> dict:
+    """
+    Publish a message at every offset and wait for all completions (or the timeout after the last message).
+
+    :return: The measurements (see `summarize`).
+    :rtype: dict
+    """
+    published_at: dict[str, float] = {}
+    completed: dict[str, tuple[bool, float]] = {}
+    started_at = time.monotonic()
+    next_message = 0
+    deadline = None
+    while len(completed) < len(offsets):
+        now = time.monotonic()
+        while next_message < len(offsets) and now - started_at >= offsets[next_message]:
+            business_id, body = build_message(path_to_wsi_tarball, path_in_tarball, keycloak_user_id)
+            broker.publish(business_id, body)
+            published_at[business_id] = time.monotonic()
+            next_message += 1
+            if next_message == len(offsets):
+                deadline = time.monotonic() + timeout
+                logger.info("Published all %s messages, waiting up to %ss for the completions.", len(offsets), timeout)
+        if deadline is not None and now > deadline:
+            logger.warning("Timeout, %s jobs did not complete.", len(offsets) - len(completed))
+            break
+        until_next = offsets[next_message] - (now - started_at) if next_message < len(offsets) else 1.0
+        for business_id, converted, received_at in broker.poll(min(max(until_next, 0), 1.0)):
+            if business_id in published_at: # ignore jobs which were not started by this run
+                completed[business_id] = (converted, received_at)
+                logger.info("Job %s %s (%s/%s)", business_id, "completed" if converted else "failed", len(completed), len(offsets))
+    return summarize(published_at, completed, started_at)
+
+
+def summarize(published_at: dict[str, float], completed: dict[str, tuple[bool, float]], started_at: float) -> dict:
+    """
+    Throughput and latencies only count the converted jobs, a failing job often fails fast and would make both
+    look better. Failed jobs are reported separately.
+    """
+    succeeded = {business_id: received_at for business_id, (converted, received_at) in completed.items() if converted}
+    failed = {business_id: received_at for business_id, (converted, received_at) in completed.items() if not converted}
+    last_success = max(succeeded.values(), default=started_at)
+    elapsed = last_success - started_at
+    return {
+        "published": len(published_at),
+        "completed": len(succeeded),
+        "failed": len(failed),
+        "missing": len(published_at) - len(completed),
+        "elapsed_seconds": round(elapsed, 3),
+        "jobs_per_hour": round(len(succeeded) / elapsed * 3600, 2) if elapsed > 0 else None,
+        "latency_seconds": _latency_summary(sorted(received_at - published_at[business_id] for business_id, received_at in succeeded.items())),
+        "failed_latency_seconds": _latency_summary(sorted(received_at - published_at[business_id] for business_id, received_at in failed.items()))
+    }
+
+
+def _latency_summary(latencies: list[float]) -> dict:
+    return {
+        "min": round(latencies[0], 3) if latencies else None,
+        "mean": round(statistics.fmean(latencies), 3) if latencies else None,
+        **{f"p{p}": round(_percentile(latencies, p), 3) if latencies else None for p in LATENCY_PERCENTILES},
+        "max": round(latencies[-1], 3) if latencies else None
+    }
+
+
+def _percentile(ordered: list[float], percentile: float) -> float:
+    # nearest-rank
+    rank = max(1, math.ceil(percentile / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Publish conversion messages at a configurable rate and measure end-to-end latency.")
+    parser.add_argument("--tarball", required=True, help="path_to_wsi_tarball as the FHIR server sends it, e.g. './app/create-data/CMU-1.tar.gz'")
+    parser.add_argument("--path-in-tarball", required=True, help="path_in_tarball_for_openslide, e.g. 'Generic CMU-1.tiff'")
+    parser.add_argument("--keycloak-user-id", default="load-test-user")
+    parser.add_argument("--shape", choices=["constant", "poisson", "burst", "ramp"], default="constant")
+    parser.add_argument("--rate", type=float, default=0.1, help="messages per second (start rate for 'ramp')")
+    parser.add_argument("--ramp-to", type=float, help="end rate for 'ramp'")
+    parser.add_argument("--burst-size", type=int, default=4)
+    parser.add_argument("--burst-interval", type=float, default=60.0, help="seconds between two bursts")
+    parser.add_argument("--count", type=int, default=10, help="amount of messages")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the 'poisson' shape")
+    parser.add_argument("--timeout", type=float, default=3600.0, help="seconds to wait for completions after the last message")
+    parser.add_argument("--host", default=RABBITMQ_HOST)
+    parser.add_argument("--in-process", action="store_true", help="handle the messages in this process instead of publishing to RabbitMQ")
+    parser.add_argument("--workers", type=int, default=4, help="worker threads of the scheduler for --in-process")
+    parser.add_argument("--output", help="write the json results to this file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    offsets = send_times(args.shape, args.count, args.rate, burst_size=args.burst_size, burst_interval=args.burst_interval, ramp_to=args.ramp_to, seed=args.seed)
+    broker = InProcessBroker(args.workers) if args.in_process else RabbitMQBroker(args.host)
+    try:
+        summary = run_load(broker, offsets, args.tarball, args.path_in_tarball, args.keycloak_user_id, args.timeout)
+    finally:
+        broker.close()
+    summary["parameters"] = {key: value for key, value in vars(args).items() if key != "output"}
+    output = json.dumps(summary, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + "\n")
+
 
-# channel.basic_publish(exchange='', routing_key='hello', body=json_body)
-print(" [x] Sent 'Hello World!'")
-# connection.close()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Central retry policy of the converter. Failures are classified as transient (worth retrying) or permanent:
+
+- Single HTTP requests to Orthanc, HAPI FHIR and Keycloak are retried in place with exponential backoff and full
+  jitter (see `request` and `call`).
+- Whole jobs which still failed with a transient error are postponed in the job intake (`JOB_RETRY_DELAYS_SECONDS`,
+  see `job_intake.py`) and resume at their first incomplete stage. Jobs which failed permanently or ran out of
+  attempts end up in the dead-letter queue.
+"""
+from __future__ import annotations
+import os
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, Callable
+import requests
+import exceptions
+import metrics
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# responses which signal an overloaded or restarting service
+RETRIABLE_STATUS_CODES = frozenset({408, 425, 429, 500, 502, 503, 504})
+# failures of the job itself (bad input, conversion errors), retrying does not change the outcome
+PERMANENT_EXCEPTIONS = (
+    exceptions.ConverterConstructionException,
+    exceptions.DicomTagKeyIsMissingException,
+    exceptions.WsiTarballExtractionException,
+    exceptions.WsiDicomizerConversionException,
+    exceptions.InvalidTagNameException,
+    exceptions.MandatoryTagIsMissing,
+    exceptions.LeaseLostException # another replica handles the job
+)
+# delays of the job-level retries
+JOB_RETRY_DELAYS_SECONDS = [int(delay) for delay in os.environ.get("CONVERTER_JOB_RETRY_DELAYS_SECONDS", "30,300,1800").split(",") if delay] # change-me
+
+
+@dataclass(frozen=True)
+class Backoff:
+    base_seconds: float
+    max_seconds: float
+    max_attempts: int
+
+    def delay(self, attempt: int) -> float:
+        """
+        Full jitter: a random delay between 0 and the exponential backoff, so many jobs hitting the same
+        overloaded service do not retry in lockstep.
+
+        :param attempt: The failed attempt, starting at 1.
+        :type attempt: int
+        """
+        return random.uniform(0, min(self.max_seconds, self.base_seconds * 2 ** (attempt - 1)))
+
+
+REQUEST_BACKOFF = Backoff(
+    base_seconds=float(os.environ.get("CONVERTER_REQUEST_RETRY_BASE_SECONDS", "0.5")), # change-me
+    max_seconds=float(os.environ.get("CONVERTER_REQUEST_RETRY_MAX_SECONDS", "30")), # change-me
+    max_attempts=int(os.environ.get("CONVERTER_REQUEST_RETRY_ATTEMPTS", "5")) # change-me
+)
+
+
+def is_transient(exception: BaseException) -> bool:
+    """
+    Classify a failure. The whole cause chain is inspected, as the job-level exceptions of `exceptions.py`
+    (e.g. `UploadToPacsException`) wrap the actual error with "raise X from Y".
+
+    :param exception: The outer-most exception.
+    :type exception: BaseException
+    :return: Whether retrying later may succeed.
+    :rtype: bool
+    """
+    current: BaseException | None = exception
+    while current is not None:
+        if isinstance(current, PERMANENT_EXCEPTIONS):
+            return False
+        if _is_transient_cause(current):
+            return True
+        current = current.__cause__ or current.__context__
+    return False
+
+
+def _is_transient_cause(exception: BaseException) -> bool:
+    if isinstance(exception, requests.HTTPError):
+        return exception.response is not None and exception.response.status_code in RETRIABLE_STATUS_CODES
+    if isinstance(exception, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError)):
+        return True
+    # optional dependencies of single stages, matched by name to not import them here
+    if type(exception).__name__ in ("OperationalError", "InterfaceError") and type(exception).__module__.startswith("psycopg2"):
+        return True
+    if type(exception).__module__.startswith("keycloak"):
+        if type(exception).__name__ in ("KeycloakConnectionError", "KeycloakTimeoutError"):
+            return True
+        return getattr(exception, "response_code", None) in RETRIABLE_STATUS_CODES
+    return False
+
+
+def call(fn: Callable[..., Any], *args, target: str, backoff: Backoff = REQUEST_BACKOFF, **kwargs) -> Any:
+    """
+    Call `fn` and retry it on transient failures (see `is_transient`).
+
+    :param target: The called service ("orthanc", "fhir", "keycloak"), used for logging and metrics.
+    :type target: str
+    :param backoff: Delays and attempts, defaults to `REQUEST_BACKOFF`.
+    :type backoff: Backoff
+    :return: The return value of `fn`.
+    :raises: The last exception, if it is permanent or the attempts are exhausted.
+    """
+    attempt = 1
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt >= backoff.max_attempts or not is_transient(e):
+                raise
+            delay = max(backoff.delay(attempt), _retry_after_seconds(e, backoff.max_seconds))
+            logger.warning("Attempt %s/%s to %s failed with %r, retrying in %.1fs", attempt, backoff.max_attempts, target, e, delay)
+            metrics.REQUEST_RETRIES.labels(target=target).inc()
+            time.sleep(delay)
+            attempt += 1
+
+
+def request(method: str, url: str, target: str, **kwargs) -> requests.Response:
+    """
+    `requests.request` with retries. Responses with a status in `RETRIABLE_STATUS_CODES` are retried like connection
+    errors; all other responses (including other errors) are returned to the caller.
+    A file object passed as `data` is rewound before every attempt.
+
+    :param target: The called service ("orthanc", "fhir", "keycloak"), used for logging and metrics.
+    :type target: str
+    :raises requests.HTTPError: The service still answered with a retriable status after the last attempt.
+    """
+    data = kwargs.get("data")
+    start_position = data.tell() if hasattr(data, "seek") else None
+
+    def send() -> requests.Response:
+        if start_position is not None:
+            data.seek(start_position)
+        r = requests.request(method, url, **kwargs)
+        if r.status_code in RETRIABLE_STATUS_CODES:
+            r.raise_for_status()
+        return r
+
+    return call(send, target=target)
+
+
+def _retry_after_seconds(exception: BaseException, max_seconds: float) -> float:
+    # honour "Retry-After" (in seconds) of 429/503 responses
+    response = getattr(exception, "response", None)
+    retry_after = response.headers.get("Retry-After") if isinstance(response, requests.Response) else None
+    try:
+        return min(float(retry_after), max_seconds) if retry_after is not None else 0.0
+    except ValueError:
+        return 0.0
+
+
+def job_retry_delay(exception: BaseException, attempt: int) -> int | None:
+    """
+    :param exception: The exception the job failed with.
+    :type exception: BaseException
+    :param attempt: Amount of retries of this job so far.
+    :type attempt: int
+    :return: Seconds after which the job should run again, None if it failed permanently or ran out of retries.
+    :rtype: int | None
+    """
+    if attempt >= len(JOB_RETRY_DELAYS_SECONDS) or not is_transient(exception):
+        return None
+    return JOB_RETRY_DELAYS_SECONDS[attempt]
@@ -0,0 +1,249 @@
+"""
+Predicts the convert time, output size and peak memory of a conversion job from the history of completed jobs
+(tables `job_resources` and `job_stage`, see `job_ledger.py`).
+
+The model is a least squares fit per target over a few features of the slide: the pixel count, the tile count,
+the size of the extracted input, the bits per pixel (how strongly the input is compressed) and the vendor format.
+It is refitted from the prop database every `REFIT_INTERVAL_SECONDS`.
+
+The peak memory is learned from the memory a job added (peak RSS minus the RSS at its start) and only from jobs
+which ran alone. RSS is measured for the whole process, with concurrent jobs every sample would contain the others,
+the predictions would grow with the concurrency and the admission control would reserve more and more per job.
+
+    python runtime_model.py --slide "temp_data/<uuid>/CMU-1.svs"   # prediction for a slide
+    python runtime_model.py --fit                                   # coefficients and error of the current history
+"""
+from __future__ import annotations
+import argparse
+import json
+import math
+import os
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+import numpy as np
+import prop_db
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+REFIT_INTERVAL_SECONDS = float(os.environ.get("CONVERTER_RUNTIME_MODEL_REFIT_SECONDS", "3600")) # change-me
+HISTORY_LIMIT = 5000 # most recent jobs used for the fit
+MIN_SAMPLES = 10 # below that, no predictions are made and the callers use their heuristics
+MIN_VENDOR_SAMPLES = 3 # vendors with less jobs share the coefficients of all other vendors
+RIDGE = 1e-3 # regularization, keeps the fit stable with few or collinear samples
+DEFAULT_TILE_SIZE = 256
+TARGETS = ("convert_seconds", "output_bytes", "peak_rss_bytes")
+
+
+@dataclass
+class SlideFeatures:
+    vendor: str | None
+    level_dimensions: list[tuple[int, int]] = field(default_factory=list)
+    tiles: int = 0
+    extracted_bytes: int = 0
+
+    @property
+    def pixels(self) -> int:
+        return sum(width * height for width, height in self.level_dimensions)
+
+    @property
+    def bits_per_pixel(self) -> float:
+        return self.extracted_bytes * 8 / self.pixels if self.pixels else 0.0
+
+
+@dataclass
+class Prediction:
+    convert_seconds: float
+    output_bytes: float
+    # None if not enough jobs ran alone yet (see `load_history`)
+    peak_rss_bytes: float | None
+    # root mean squared error of the fit per target, in the unit of the target
+    rmse: dict[str, float]
+    samples: int
+
+    def upper(self, target: str, deviations: float = 2.0) -> float | None:
+        """
+        :return: A conservative estimate for the target (prediction plus `deviations` times the error of the fit).
+        """
+        predicted = getattr(self, target)
+        return predicted + deviations * self.rmse[target] if predicted is not None else None
+
+
+def probe(path_to_wsi_file: str, extracted_bytes: int) -> SlideFeatures:
+    """
+    Read the features of an extracted slide with OpenSlide. Only the header is read, which is cheap.
+
+    :param path_to_wsi_file: Path to the slide file.
+    :type path_to_wsi_file: str
+    :param extracted_bytes: Size of the extracted tarball.
+    :type extracted_bytes: int
+    :return: The features, without dimensions and tiles if OpenSlide cannot open the slide.
+    :rtype: SlideFeatures
+    """
+    import openslide
+    features = SlideFeatures(vendor=None, extracted_bytes=extracted_bytes)
+    try:
+        features.vendor = openslide.OpenSlide.detect_format(path_to_wsi_file)
+        with openslide.OpenSlide(path_to_wsi_file) as slide:
+            features.level_dimensions = list(slide.level_dimensions)
+            for level, (width, height) in enumerate(slide.level_dimensions):
+                tile_width = int(slide.properties.get(f"openslide.level[{level}].tile-width", DEFAULT_TILE_SIZE))
+                tile_height = int(slide.properties.get(f"openslide.level[{level}].tile-height", DEFAULT_TILE_SIZE))
+                features.tiles += math.ceil(width / tile_width) * math.ceil(height / tile_height)
+    except Exception as e:
+        logger.info("Could not probe %s: %s", path_to_wsi_file, e)
+    return features
+
+
+class RuntimeModel:
+    def __init__(self, coefficients: dict[str, np.ndarray], rmse: dict[str, float], vendors: list[str], samples: int) -> None:
+        self.coefficients = coefficients
+        self.rmse = rmse
+        self.vendors = vendors
+        self.samples = samples
+
+    @classmethod
+    def fit(cls, history: list[tuple[SlideFeatures, dict[str, float]]]) -> RuntimeModel | None:
+        """
+        :param history: The features of completed jobs and their measured targets (see `TARGETS`), None if a target
+            was not measured for a job. Targets with less than `MIN_SAMPLES` measurements are not predicted.
+        :type history: list[tuple[SlideFeatures, dict[str, float | None]]]
+        :return: The fitted model, None if the history is too short.
+        :rtype: RuntimeModel | None
+        """
+        if len(history) < MIN_SAMPLES:
+            return None
+        vendor_counts: dict[str, int] = {}
+        for features, _ in history:
+            vendor_counts[features.vendor or ""] = vendor_counts.get(features.vendor or "", 0) + 1
+        vendors = sorted(vendor for vendor, count in vendor_counts.items() if vendor and count >= MIN_VENDOR_SAMPLES)
+        model = cls({}, {}, vendors, len(history))
+        x = np.array([model._feature_vector(features) for features, _ in history])
+        regularization = math.sqrt(RIDGE) * np.eye(x.shape[1])
+        regularization[0, 0] = 0 # the intercept is not regularized
+        for target in TARGETS:
+            measured_rows = [i for i, (_, measured) in enumerate(history) if measured[target] is not None]
+            if len(measured_rows) < MIN_SAMPLES:
+                logger.info("Only %s jobs measured %s, it is not predicted", len(measured_rows), target)
+                continue
+            x_target = x[measured_rows]
+            y = np.array([history[i][1][target] for i in measured_rows], dtype=float)
+            coefficients, *_ = np.linalg.lstsq(np.vstack([x_target, regularization]), np.concatenate([y, np.zeros(x.shape[1])]), rcond=None)
+            model.coefficients[target] = coefficients
+            model.rmse[target] = float(np.sqrt(np.mean((x_target @ coefficients - y) ** 2)))
+        return model
+
+    def predict(self, features: SlideFeatures) -> Prediction:
+        x = self._feature_vector(features)
+        predicted = {target: max(float(x @ self.coefficients[target]), 0.0) if target in self.coefficients else None for target in TARGETS}
+        return Prediction(**predicted, rmse=self.rmse, samples=self.samples)
+
+    def _feature_vector(self, features: SlideFeatures) -> np.ndarray:
+        # scaled to similar magnitudes: gigapixels, 100k tiles, GB
+        return np.array([
+            1.0,
+            features.pixels / 1e9,
+            features.tiles / 1e5,
+            features.extracted_bytes / 1e9,
+            features.bits_per_pixel,
+            *(1.0 if features.vendor == vendor else 0.0 for vendor in self.vendors)
+        ])
+
+
+def load_history(limit: int = HISTORY_LIMIT) -> list[tuple[SlideFeatures, dict[str, float | None]]]:
+    """
+    :return: Features and measured targets of the most recent successfully converted jobs. The peak memory is the
+        RSS the job added and None for jobs which ran concurrently with others (see `job_ledger.JobLedger`).
+    """
+    sql = \
+        """
+        SELECT r.vendor, r.level_dimensions, r.tiles, r.extracted_bytes, r.output_bytes,
+               CASE WHEN r.concurrent_jobs = 1 THEN r.peak_rss_bytes - r.start_rss_bytes END,
+               EXTRACT(EPOCH FROM (s.finished_at - s.started_at))
+        FROM job_resources r
+        JOIN (
+            -- a retried job may have converted several times, only its latest conversion counts
+            SELECT DISTINCT ON (job_id) job_id, started_at, finished_at
+            FROM job_stage
+            WHERE stage = 'convert' AND succeeded
+            ORDER BY job_id, finished_at DESC
+        ) s ON s.job_id = r.job_id
+        WHERE r.level_dimensions IS NOT NULL AND r.output_bytes IS NOT NULL
+        ORDER BY r.started_at DESC
+        LIMIT %s
+        """
+    with prop_db.connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, (limit,))
+            rows = cursor.fetchall()
+    history = []
+    for vendor, level_dimensions, tiles, extracted_bytes, output_bytes, peak_rss_bytes, convert_seconds in rows:
+        # jsonb is already decoded by psycopg2
+        features = SlideFeatures(vendor, [tuple(level) for level in level_dimensions], tiles or 0, extracted_bytes or 0)
+        history.append((features, {"convert_seconds": float(convert_seconds), "output_bytes": float(output_bytes),
+                                   "peak_rss_bytes": float(max(peak_rss_bytes, 0)) if peak_rss_bytes is not None else None}))
+    return history
+
+
+_model: RuntimeModel | None = None
+_fitted_at: float | None = None
+_lock = threading.Lock()
+
+
+def current_model() -> RuntimeModel | None:
+    """
+    :return: The model fitted on the recent history (refitted every `REFIT_INTERVAL_SECONDS`), None if there is not enough history.
+    """
+    global _model, _fitted_at
+    with _lock:
+        if _fitted_at is None or time.monotonic() - _fitted_at > REFIT_INTERVAL_SECONDS:
+            _fitted_at = time.monotonic()
+            try:
+                _model = RuntimeModel.fit(load_history())
+            except Exception as e:
+                # keep the previous model, predictions are optional
+                logger.warning("Could not fit the runtime model: %s", e)
+        return _model
+
+
+def predict(features: SlideFeatures) -> Prediction | None:
+    """
+    Predict convert time, output size and peak RSS (added by the job) of a slide.
+
+    :param features: The features of the slide (see `probe`).
+    :type features: SlideFeatures
+    :return: The prediction, None if there is not enough history or the slide could not be probed.
+    :rtype: Prediction | None
+    """
+    if not features.level_dimensions:
+        return None
+    model = current_model()
+    return model.predict(features) if model is not None else None
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Predict conversion time, output size and peak memory from the job history.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--slide", help="path to an extracted slide file")
+    group.add_argument("--fit", action="store_true", help="print the coefficients and the error of the fit")
+    args = parser.parse_args(argv)
+    model = current_model()
+    if model is None:
+        sys.exit(f"Not enough history in the prop database (at least {MIN_SAMPLES} converted jobs are needed).")
+    if args.fit:
+        output = {"samples": model.samples, "vendors": model.vendors, "rmse": model.rmse,
+                  "coefficients": {target: coefficients.tolist() for target, coefficients in model.coefficients.items()}}
+    else:
+        features = probe(args.slide, os.path.getsize(args.slide))
+        prediction = predict(features)
+        output = {"features": {**asdict(features), "pixels": features.pixels, "bits_per_pixel": features.bits_per_pixel},
+                  "prediction": asdict(prediction) if prediction else None}
+    sys.stdout.write(json.dumps(output, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
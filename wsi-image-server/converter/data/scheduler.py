@@ -0,0 +1,222 @@
+from __future__ import annotations
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable
+import metrics
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# jobs with a larger expected size (extracted bytes) run in the slow lane
+LARGE_JOB_BYTES = int(os.environ.get("CONVERTER_LARGE_JOB_BYTES", str(1024 * 1024 * 1024))) # change-me
+# workers which never pick up a job of the slow lane, so small slides are not stuck behind huge ones
+RESERVED_SMALL_WORKERS = int(os.environ.get("CONVERTER_RESERVED_SMALL_WORKERS", "1")) # change-me
+# every second of waiting counts as this many bytes less, so large jobs are eventually picked up even under a
+# constant stream of small ones (with 1 MiB/s a job 1 GiB larger than the rest overtakes them after ~17 minutes)
+AGING_BYTES_PER_SECOND = float(os.environ.get("CONVERTER_AGING_BYTES_PER_SECOND", str(1024 * 1024))) # change-me
+# fair share between users (deficit round-robin): every round a user may start jobs of this many expected bytes times their weight
+FAIR_SHARE_QUANTUM_BYTES = int(os.environ.get("CONVERTER_FAIR_SHARE_QUANTUM_BYTES", str(1024 * 1024 * 1024))) # change-me
+# weights per keycloak user ID, e.g. "<user id>=4,<other user id>=0.5", every other user has weight 1
+USER_WEIGHTS = os.environ.get("CONVERTER_USER_WEIGHTS", "") # change-me
+ANONYMOUS_USER = "anonymous"
+
+
+def parse_user_weights(weights: str) -> dict[str, float]:
+    """
+    :param weights: Comma separated "<keycloak user id>=<weight>" pairs.
+    :type weights: str
+    :rtype: dict[str, float]
+    """
+    parsed = {}
+    for pair in filter(None, (pair.strip() for pair in weights.split(","))):
+        user, _, weight = pair.partition("=")
+        if float(weight) <= 0:
+            raise ValueError(f"Weight of user {user} has to be positive!")
+        parsed[user.strip()] = float(weight)
+    return parsed
+
+
+@dataclass(order=True)
+class _Job:
+    # waiting reduces the priority of all queued jobs at the same rate, so the aged priority
+    # `size - (now - submitted_at) * rate` orders the same as the static `size + submitted_at * rate`
+    priority: float
+    sequence: int
+    job_id: str = field(compare=False)
+    payload: Any = field(compare=False)
+    expected_bytes: int = field(compare=False)
+    lane: str = field(compare=False)
+    submitted_at: float = field(compare=False)
+    user: str = field(compare=False)
+
+
+@dataclass
+class _UserQueue:
+    queues: dict[str, list[_Job]] = field(default_factory=lambda: {"small": [], "large": []})
+    deficit: float = 0.0
+
+    def __len__(self) -> int:
+        return sum(len(jobs) for jobs in self.queues.values())
+
+
+class Scheduler:
+    """
+    Runs jobs on a bounded pool of worker threads, fair between users and shortest expected job first.
+
+    The expected size of a job is the size hint from the message or the extracted size of its tarball (see
+    `rabbit_consumer.expected_job_bytes`). Jobs above `LARGE_JOB_BYTES` form the slow lane, which may use all
+    workers except `RESERVED_SMALL_WORKERS`.
+
+    Every user (keycloak user ID) has their own sub-queue. The next user is chosen by deficit round-robin with the
+    expected bytes as cost, so a user bulk-uploading hundreds of slides gets the same share of the workers as a
+    user uploading a single one (weighted by `USER_WEIGHTS`). Within the sub-queue of a user the smallest (aged,
+    see `AGING_BYTES_PER_SECOND`) job runs next.
+    """
+    def __init__(self, run: Callable[[Any], Any], workers: int, user_weights: dict[str, float] | None = None) -> None:
+        """
+        :param run: Called with the payload of a job in a worker thread. Exceptions are logged, not raised.
+        :type run: Callable[[Any], Any]
+        :param workers: Amount of jobs running at the same time.
+        :type workers: int
+        :param user_weights: Share of every user, defaults to `USER_WEIGHTS`. Users not listed have weight 1.
+        :type user_weights: dict[str, float] | None
+        """
+        self._run = run
+        self.workers = max(workers, 1)
+        self.max_large_workers = max(self.workers - RESERVED_SMALL_WORKERS, 1)
+        self.user_weights = parse_user_weights(USER_WEIGHTS) if user_weights is None else user_weights
+        self._users: dict[str, _UserQueue] = {}
+        # users with queued jobs in round-robin order, the first one is served next
+        self._active: deque[str] = deque()
+        self._queued = {"small": 0, "large": 0}
+        self._busy_large = 0
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._threads = [threading.Thread(target=self._work, name=f"conversion-worker-{i}", daemon=True) for i in range(self.workers)]
+
+    def start(self) -> None:
+        for thread in self._threads:
+            thread.start()
+        logger.info("Started %s workers (at most %s for jobs larger than %s bytes)", self.workers, self.max_large_workers, LARGE_JOB_BYTES)
+
+    def stop(self, timeout: float | None = None) -> bool:
+        """
+        Stop the workers. Running jobs are finished, queued jobs are not started anymore.
+
+        :param timeout: Seconds to wait for the running jobs, None waits until they are done.
+        :type timeout: float | None
+        :return: Whether all workers stopped within the timeout.
+        :rtype: bool
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            if thread.ident is not None: # never started
+                thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        running = sum(1 for thread in self._threads if thread.is_alive())
+        if running:
+            logger.warning("%s workers are still running a job after %ss", running, timeout)
+        else:
+            logger.info("Stopped %s workers, %s jobs were not started", self.workers, sum(self._queued.values()))
+        return running == 0
+
+    def submit(self, job_id: str, payload: Any, expected_bytes: int, user: str | None = None) -> None:
+        """
+        Queue a job.
+
+        :param job_id: The business ID of the job, only used for logging.
+        :type job_id: str
+        :param payload: Passed to `run`.
+        :type payload: Any
+        :param expected_bytes: The expected (extracted) size of the slide.
+        :type expected_bytes: int
+        :param user: The keycloak user ID of the uploader.
+        :type user: str | None
+        """
+        now = time.monotonic()
+        user = user or ANONYMOUS_USER
+        lane = "large" if expected_bytes > LARGE_JOB_BYTES else "small"
+        job = _Job(expected_bytes + now * AGING_BYTES_PER_SECOND, next(self._sequence), job_id, payload, expected_bytes, lane, now, user)
+        with self._condition:
+            user_queue = self._users.setdefault(user, _UserQueue())
+            if not user_queue:
+                self._active.append(user)
+            heapq.heappush(user_queue.queues[lane], job)
+            self._queued[lane] += 1
+            metrics.SCHEDULER_QUEUED.labels(lane=lane).set(self._queued[lane])
+            metrics.SCHEDULER_ACTIVE_USERS.set(len(self._active))
+            self._condition.notify()
+        logger.info("Queued job %s of user %s (%s bytes expected) in the %s lane", job_id, user, expected_bytes, lane)
+
+    def queued(self) -> int:
+        with self._condition:
+            return sum(self._queued.values())
+
+    def _head(self, user_queue: _UserQueue) -> list[_Job] | None:
+        """
+        :return: The queue of the user whose first job may run now, None if none may.
+        """
+        candidates = [user_queue.queues["small"]]
+        if self._busy_large < self.max_large_workers:
+            candidates.append(user_queue.queues["large"])
+        candidates = [jobs for jobs in candidates if jobs]
+        return min(candidates, key=lambda jobs: jobs[0]) if candidates else None
+
+    def _next_job(self) -> _Job | None:
+        heads = {user: self._head(self._users[user]) for user in self._active}
+        if not any(heads.values()):
+            return None
+        while True:
+            user = self._active[0]
+            user_queue, jobs = self._users[user], heads[user]
+            if jobs is not None and jobs[0].expected_bytes <= user_queue.deficit:
+                break
+            if jobs is not None:
+                user_queue.deficit += FAIR_SHARE_QUANTUM_BYTES * self.user_weights.get(user, 1.0)
+            self._active.rotate(-1)
+        job = heapq.heappop(jobs)
+        user_queue.deficit -= job.expected_bytes
+        self._queued[job.lane] -= 1
+        if not user_queue:
+            # an idle user does not save up a share for later
+            del self._users[user]
+            self._active.popleft()
+        metrics.SCHEDULER_QUEUED.labels(lane=job.lane).set(self._queued[job.lane])
+        metrics.SCHEDULER_ACTIVE_USERS.set(len(self._active))
+        return job
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                job = None
+                while job is None:
+                    if self._stopping:
+                        return
+                    job = self._next_job()
+                    if job is None:
+                        self._condition.wait()
+                if job.lane == "large":
+                    self._busy_large += 1
+            waited = time.monotonic() - job.submitted_at
+            metrics.SCHEDULER_WAIT_SECONDS.labels(lane=job.lane).observe(waited)
+            logger.info("Starting job %s of user %s after %.1fs in the %s lane", job.job_id, job.user, waited, job.lane)
+            try:
+                self._run(job.payload)
+            except Exception:
+                logger.exception("Job %s raised", job.job_id)
+            finally:
+                if job.lane == "large":
+                    with self._condition:
+                        self._busy_large -= 1
+                        # a worker may be waiting because the slow lane was full
+                        self._condition.notify_all()
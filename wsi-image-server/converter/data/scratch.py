@@ -0,0 +1,328 @@
+"""
+Scratch space of the conversion jobs: the extracted slide and the DICOM files in `<root>/<uuid>/` (with `dicom/`
+and `manifest.json`, see `converter.py` and `job_manifest.py`).
+
+- Every job reserves its estimated footprint against the quota of a root before anything is extracted and waits
+  while no root has enough room left.
+- Several roots (e.g. one per disk) are used round-robin, so the extraction and conversion of concurrent jobs
+  do not compete for the same disk.
+- Small slides can go to an optional RAM-backed root (tmpfs). Its pages count against the memory limit of the
+  container, so the job also reserves the same amount of memory (see `admission.py`), together with the memory of
+  its conversion.
+- Folders of jobs which are not running anymore are reclaimed at startup and then periodically. Folders of
+  failed jobs are kept for `RETENTION_SECONDS`, so a retried job can still resume from its manifest.
+"""
+from __future__ import annotations
+import os
+import shutil
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+import admission
+import job_lease
+import job_manifest
+import metrics
+import progress
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# comma-separated, relative to the working directory (/app) or absolute
+ROOTS = [root for root in os.environ.get("CONVERTER_SCRATCH_ROOTS", "temp_data").split(",") if root] # change-me
+# quota per root in bytes, detected from the free space of the root if not set
+QUOTA_BYTES = int(os.environ.get("CONVERTER_SCRATCH_QUOTA_BYTES", "0")) # change-me
+# share of the free space which may be reserved, the rest is headroom for everything not estimated
+QUOTA_FRACTION = 0.9
+# RAM-backed root (e.g. a tmpfs mounted at /app/scratch-tmpfs) for jobs up to TMPFS_MAX_JOB_BYTES, disabled if empty
+TMPFS_ROOT = os.environ.get("CONVERTER_SCRATCH_TMPFS_ROOT", "") # change-me
+TMPFS_QUOTA_BYTES = int(os.environ.get("CONVERTER_SCRATCH_TMPFS_QUOTA_BYTES", "0")) # change-me
+TMPFS_MAX_JOB_BYTES = int(os.environ.get("CONVERTER_SCRATCH_TMPFS_MAX_JOB_BYTES", str(256 * 1024 * 1024))) # change-me
+# longer than all job-level retries together (see retry_policy.JOB_RETRY_DELAYS_SECONDS)
+RETENTION_SECONDS = float(os.environ.get("CONVERTER_SCRATCH_RETENTION_SECONDS", str(6 * 3600))) # change-me
+RECLAIM_INTERVAL_SECONDS = float(os.environ.get("CONVERTER_SCRATCH_RECLAIM_INTERVAL_SECONDS", "600")) # change-me
+
+# the output of wsidicomizer is about the size of the extracted input (tiles are mostly copied, not re-encoded)
+OUTPUT_TO_INPUT_RATIO = admission.OUTPUT_TO_INPUT_RATIO
+# folders are renamed before they are deleted, so a job never resumes from a half-deleted folder
+_RECLAIMING_SUFFIX = ".reclaiming"
+
+
+def estimate_disk_bytes(uncompressed_bytes: int) -> int:
+    """
+    Scratch space of a job: the extracted slide and the DICOM files.
+    """
+    return int(uncompressed_bytes * (1 + OUTPUT_TO_INPUT_RATIO))
+
+
+@dataclass
+class ScratchRoot:
+    path: str
+    quota: int
+    in_memory: bool = False
+    reserved: int = 0
+
+    def fits(self, amount: int) -> bool:
+        return self.reserved == 0 or self.reserved + amount <= self.quota
+
+
+class ScratchManager:
+    """
+    Hands out the job folders and holds jobs back until their scratch space fits into the quota of a root.
+    A job which alone exceeds the quota is admitted once nothing else holds that root, so it still runs.
+    """
+    def __init__(self, roots: list[ScratchRoot], tmpfs_root: ScratchRoot | None = None) -> None:
+        """
+        :param roots: The disk-backed roots, used round-robin.
+        :type roots: list[ScratchRoot]
+        :param tmpfs_root: The RAM-backed root for small jobs, None to use only the disk-backed roots.
+        :type tmpfs_root: ScratchRoot | None
+        """
+        self.roots = roots
+        self.tmpfs_root = tmpfs_root
+        self._next_root = 0
+        # business ID -> (root, reserved bytes)
+        self._reservations: dict[str, tuple[ScratchRoot, int]] = {}
+        # jobs waiting for their reservation, their folders are not reclaimed either
+        self._claimed: set[str] = set()
+        self._condition = threading.Condition()
+        self._waiting = 0
+        for root in self._all_roots():
+            os.makedirs(root.path, exist_ok=True)
+            metrics.SCRATCH_QUOTA.labels(root=root.path).set(root.quota)
+
+    def reserve(self, business_id: str, amount: int, timeout: float | None = None, memory_bytes: int = 0) -> str | None:
+        """
+        Block until `amount` bytes can be reserved for the job and return its folder. A job whose folder still
+        exists (from a previous attempt) stays on that root, so it can resume.
+
+        :param business_id: The business ID of the job.
+        :type business_id: str
+        :param amount: Bytes to reserve (see `estimate_disk_bytes`).
+        :type amount: int
+        :param timeout: Seconds to wait at most, None waits until a root has enough room.
+        :type timeout: float | None
+        :param memory_bytes: Expected memory of the conversion (see `admission.estimate_memory_bytes`). A RAM-backed
+            folder reserves it together with its pages, the job must not wait for more memory while it holds these.
+        :type memory_bytes: int
+        :return: The folder of the job (not created yet), None if the timeout passed without reserving anything.
+        :rtype: str | None
+        """
+        started_at = time.monotonic()
+        with self._condition:
+            self._claimed.add(business_id)
+        try:
+            with self._condition:
+                existing_root = self._root_of_existing_folder(business_id)
+            if existing_root is None or existing_root is self.tmpfs_root:
+                if self._reserve_tmpfs(business_id, amount, memory_bytes, resumed=existing_root is not None):
+                    return self._reserved(business_id, self.tmpfs_root, amount, started_at)
+            with self._condition:
+                self._waiting += 1
+                metrics.SCRATCH_WAITING.set(self._waiting)
+                try:
+                    admitted = self._condition.wait_for(lambda: self._pick_root(amount, existing_root) is not None, timeout=timeout)
+                finally:
+                    self._waiting -= 1
+                    metrics.SCRATCH_WAITING.set(self._waiting)
+                if not admitted:
+                    self._claimed.discard(business_id)
+                    return None
+                root = self._pick_root(amount, existing_root)
+                if existing_root is None:
+                    self._next_root = (self.roots.index(root) + 1) % len(self.roots)
+                self._book(business_id, root, amount)
+            return self._reserved(business_id, root, amount, started_at)
+        except BaseException:
+            # the caller only releases reservations it got (including the memory of a RAM-backed folder)
+            self.release(business_id)
+            admission.controller.release(business_id)
+            raise
+
+    def _reserve_tmpfs(self, business_id: str, amount: int, memory_bytes: int, resumed: bool) -> bool:
+        if self.tmpfs_root is None or (amount > TMPFS_MAX_JOB_BYTES and not resumed):
+            return False
+        # a new job only goes to memory if it fits right away, a resumed one waits for the memory of its folder.
+        # Both wait (if at all) without holding memory, the conversion does not reserve any more (see
+        # Converter._reserve_memory).
+        if not admission.controller.acquire(business_id, "memory", amount + memory_bytes, timeout=None if resumed else 0):
+            return False
+        with self._condition:
+            if resumed or self.tmpfs_root.fits(amount):
+                self._book(business_id, self.tmpfs_root, amount)
+                return True
+        admission.controller.release(business_id)
+        return False
+
+    def _pick_root(self, amount: int, existing_root: ScratchRoot | None) -> ScratchRoot | None:
+        if existing_root is not None:
+            return existing_root if existing_root.fits(amount) else None
+        for offset in range(len(self.roots)):
+            root = self.roots[(self._next_root + offset) % len(self.roots)]
+            if root.fits(amount):
+                return root
+        return None
+
+    def _book(self, business_id: str, root: ScratchRoot, amount: int) -> None:
+        # called with the condition held
+        root.reserved += amount
+        self._reservations[business_id] = (root, amount)
+        metrics.SCRATCH_RESERVED.labels(root=root.path).set(root.reserved)
+
+    def _reserved(self, business_id: str, root: ScratchRoot, amount: int, started_at: float) -> str:
+        waited = time.monotonic() - started_at
+        metrics.ADMISSION_WAIT_SECONDS.labels(resource="disk").observe(waited)
+        logger.info("Reserved %s bytes of scratch space in %s for %s after %.1fs (%s of %s bytes reserved)", amount, root.path, business_id, waited, root.reserved, root.quota)
+        return os.path.join(root.path, business_id)
+
+    def release(self, business_id: str) -> None:
+        """
+        Release the reservation of the job. The folder is kept, it is deleted by the job or reclaimed later.
+        The memory reserved for a RAM-backed folder is released with `admission.controller.release`.
+        """
+        with self._condition:
+            self._claimed.discard(business_id)
+            reservation = self._reservations.pop(business_id, None)
+            if reservation is None:
+                return
+            root, amount = reservation
+            root.reserved -= amount
+            metrics.SCRATCH_RESERVED.labels(root=root.path).set(root.reserved)
+            self._condition.notify_all()
+
+    def folder(self, business_id: str) -> str:
+        """
+        :return: The folder of the job: the reserved one, an existing one of a previous attempt or a new one in the first root.
+        :rtype: str
+        """
+        with self._condition:
+            if business_id in self._reservations:
+                return os.path.join(self._reservations[business_id][0].path, business_id)
+            root = self._root_of_existing_folder(business_id) or self.roots[0]
+        return os.path.join(root.path, business_id)
+
+    def remove(self, business_id: str) -> None:
+        """
+        Delete the folder of a job which will not be resumed (e.g. it failed permanently).
+        """
+        path = self.folder(business_id)
+        if os.path.isdir(path):
+            logger.info("Deleting folder (and subfolders) %s", path)
+            shutil.rmtree(path, ignore_errors=True)
+
+    def reclaim(self) -> int:
+        """
+        Delete the folders of jobs which are not running anymore: completed jobs and folders which were not
+        touched for `RETENTION_SECONDS`. Folders of jobs leased by any replica are kept.
+
+        :return: The amount of reclaimed bytes.
+        :rtype: int
+        """
+        try:
+            leased = job_lease.leased_job_ids()
+        except Exception as e:
+            # without the leases, a folder of a running job cannot be told apart from an orphaned one
+            logger.warning("Could not look up the leased jobs, skipping reclamation: %s", e)
+            return 0
+        reclaimed = 0
+        for root in self._all_roots():
+            for entry in os.scandir(root.path):
+                if entry.is_dir() and self._is_reclaimable(entry, leased):
+                    reclaimed += self._delete(root, entry)
+        if reclaimed:
+            logger.info("Reclaimed %s bytes of scratch space", reclaimed)
+        return reclaimed
+
+    def _is_reclaimable(self, entry: os.DirEntry, leased: set[str]) -> bool:
+        if entry.name.endswith(_RECLAIMING_SUFFIX):
+            return True # interrupted deletion
+        try:
+            uuid.UUID(entry.name)
+        except ValueError:
+            return False # not a job folder
+        with self._condition:
+            if entry.name in self._claimed or entry.name in self._reservations:
+                return False
+        if entry.name in leased:
+            return False
+        if time.time() - _last_modified(entry.path) >= RETENTION_SECONDS:
+            return True
+        try:
+            return job_lease.get_completion(entry.name, "job") is not None
+        except Exception:
+            return False
+
+    def _delete(self, root: ScratchRoot, entry: os.DirEntry) -> int:
+        path = entry.path
+        with self._condition:
+            # a job claiming the folder in the meantime either sees it (and keeps it) or starts over without it
+            if entry.name in self._claimed:
+                return 0
+            if not entry.name.endswith(_RECLAIMING_SUFFIX):
+                path = f"{entry.path}{_RECLAIMING_SUFFIX}"
+                try:
+                    os.rename(entry.path, path)
+                except OSError as e:
+                    logger.warning("Could not reclaim %s: %s", entry.path, e)
+                    return 0
+        _, size = progress.folder_size(path)
+        logger.info("Reclaiming orphaned job folder %s (%s bytes)", entry.path, size)
+        shutil.rmtree(path, ignore_errors=True)
+        metrics.SCRATCH_RECLAIMED_BYTES.labels(root=root.path).inc(size)
+        return size
+
+    def start_reclaimer(self) -> None:
+        """
+        Reclaim orphaned folders now and then every `RECLAIM_INTERVAL_SECONDS` in a background thread.
+        """
+        threading.Thread(target=self._reclaim_periodically, name="scratch-reclaimer", daemon=True).start()
+
+    def _reclaim_periodically(self) -> None:
+        while True:
+            try:
+                self.reclaim()
+            except Exception:
+                logger.exception("Reclaiming scratch space failed")
+            time.sleep(RECLAIM_INTERVAL_SECONDS)
+
+    def _root_of_existing_folder(self, business_id: str) -> ScratchRoot | None:
+        return next((root for root in self._all_roots() if os.path.isdir(os.path.join(root.path, business_id))), None)
+
+    def _all_roots(self) -> list[ScratchRoot]:
+        return self.roots + ([self.tmpfs_root] if self.tmpfs_root is not None else [])
+
+
+def _last_modified(path: str) -> float:
+    # the manifest is rewritten after every completed stage
+    manifest_path = os.path.join(path, job_manifest.MANIFEST_FILE_NAME)
+    try:
+        return max(os.path.getmtime(path), os.path.getmtime(manifest_path) if os.path.exists(manifest_path) else 0)
+    except OSError:
+        return time.time() # deleted in the meantime
+
+
+def _create_root(path: str, quota: int, in_memory: bool = False) -> ScratchRoot:
+    os.makedirs(path, exist_ok=True)
+    return ScratchRoot(path, quota or int(shutil.disk_usage(path).free * QUOTA_FRACTION), in_memory)
+
+
+def _create_manager() -> ScratchManager:
+    roots = [_create_root(root, QUOTA_BYTES) for root in ROOTS]
+    tmpfs_root = _create_root(TMPFS_ROOT, TMPFS_QUOTA_BYTES, in_memory=True) if TMPFS_ROOT else None
+    for root in roots + ([tmpfs_root] if tmpfs_root else []):
+        logger.info("Scratch root %s: quota of %s bytes%s", root.path, root.quota, " (in memory)" if root.in_memory else "")
+    return ScratchManager(roots, tmpfs_root)
+
+
+# process-wide, shared by all jobs of this converter
+manager = _create_manager()
+
+
+def job_folder(business_id: str) -> str:
+    """
+    :return: The folder of the job (see `ScratchManager.folder`).
+    :rtype: str
+    """
+    return manager.folder(business_id)
@@ -1,19 +1,27 @@
-import requests
 from requests.auth import HTTPBasicAuth
 import os
+import json
 import shutil
 import uuid
+import functools
 from fhir.resources.R4B.imagingstudy import *
 from fhir.resources.R4B import patient, endpoint, codeableconcept, coding
 import conversion_util
 import pydicom
 from fhir_communication import fhir_handler
-import psycopg2
+import prop_db
 import pprint
 import exceptions
 import typing
+import tracing
+import retry_policy
+import metrics
+import pacs_lookup
 from keycloak import KeycloakOpenID, KeycloakAdmin, KeycloakOpenIDConnection
 from keycloak_info import KeycloakInfo
+from progress import ProgressReporter
+from job_ledger import JobLedger
+from job_manifest import JobManifest
 import logging
 
 logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
@@ -45,13 +53,22 @@ CONVERTER_PACS_UPLOADER_PASSWORD = "converter_pacs_uploader" # secret-me
 FHIR_ADMIN_NAME = "fhir_admin" # secret-me
 FHIR_ADMIN_PASSWORD = "fhir_admin" # secret-me
 
+# files which Orthanc already stores (same SOPInstanceUID, size and MD5) are not uploaded again
+SKIP_STORED_INSTANCES = os.environ.get("CONVERTER_SKIP_STORED_INSTANCES", "true").lower() in ("1", "true", "yes") # change-me
+VERIFY_STORED_MD5 = os.environ.get("CONVERTER_VERIFY_STORED_MD5", "true").lower() in ("1", "true", "yes") # change-me
 
-def send_and_cleanup(business_id: str, kc_info: KeycloakInfo, path_to_dcm_folder: str):
+# clients LISTEN on this channel to be notified once a conversion is done (must match the client and the HAPI FHIR handler)
+PROP_DB_STATUS_CHANNEL = "conversion_status" # change-me
+
+
+@tracing.traced("sender.send_and_cleanup")
+def send_and_cleanup(business_id: str, kc_info: KeycloakInfo, path_to_dcm_folder: str, progress_reporter: ProgressReporter | None = None, ledger: JobLedger | None = None, manifest: JobManifest | None = None):
     """
     Sends the dicom images to the PACS server (orthanc) through the Orthanc REST-API. 
     Then a ImagingStudy is constructed with a WADO-RS endpoint and sent to the FHIR server (HAPI) through the FHIR REST-API.
     Then the necessary roles are created and assigned to the user in Keycloak through the Keycloak REST-API.
     Lastly all the temporary DICOM files are deleted from the filepath.
+    Steps which already completed in a previous attempt (see `JobManifest`) are skipped.
 
     :param business_id: The business ID for the DICOM study and FHIR ImagingStudy.
     :type business_id: str
@@ -59,6 +76,12 @@ def send_and_cleanup(business_id: str, kc_info: KeycloakInfo, path_to_dcm_folder
     :type kc_info: KeycloakInfo
     :param path_to_dcm_folder: Path where the DICOM files are located on the system.
     :type path_to_dcm_folder: str
+    :param progress_reporter: Receives the progress of every stage, defaults to None.
+    :type progress_reporter: ProgressReporter | None
+    :param ledger: Records the duration of every stage in the prop database, defaults to None.
+    :type ledger: JobLedger | None
+    :param manifest: Checkpoints of the completed stages, defaults to the manifest next to the DICOM folder.
+    :type manifest: JobManifest | None
     :raises exceptions.UploadToPacsException: An error occurred while uploading to the PACS server.
     :raises exceptions.UploadToFHIRException: An error occurred while uploading to the FHIR server.
     :raises exceptions.GrantKeycloakRoleException: An error occurred while creating and/or assigning the roles to the user.
@@ -70,48 +93,81 @@ def send_and_cleanup(business_id: str, kc_info: KeycloakInfo, path_to_dcm_folder
         client_secret_key=CLIENT_SECRET
     )
 
-    fhir_token: dict = keycloak_openid.token(
-        username=CONVERTER_FHIR_UPLOADER_NAME,
-        password=CONVERTER_FHIR_UPLOADER_PASSWORD
-    )
+    with tracing.span("sender.request_tokens"):
+        fhir_token: dict = retry_policy.call(
+            keycloak_openid.token,
+            username=CONVERTER_FHIR_UPLOADER_NAME,
+            password=CONVERTER_FHIR_UPLOADER_PASSWORD,
+            target="keycloak"
+        )
+        pacs_token: dict = retry_policy.call(
+            keycloak_openid.token,
+            username=CONVERTER_PACS_UPLOADER_NAME,
+            password=CONVERTER_PACS_UPLOADER_PASSWORD,
+            target="keycloak"
+        )
     fhir_access_token = fhir_token["access_token"]
     logger.debug("User %s got access token %s", CONVERTER_FHIR_UPLOADER_NAME, fhir_access_token)
     fhir_header_with_auth = {
         "Authorization": f"Bearer {fhir_access_token}"
     }
 
-    pacs_token: dict = keycloak_openid.token(
-        username=CONVERTER_PACS_UPLOADER_NAME,
-        password=CONVERTER_PACS_UPLOADER_PASSWORD
-    )
     pacs_access_token = pacs_token["access_token"]
     logger.debug("User %s got access token %s", CONVERTER_PACS_UPLOADER_NAME, pacs_access_token)
     pacs_header_with_auth = {
         "Authorization": f"Bearer {pacs_access_token}"
     }
 
-    try:
-        send_to_pacs(path_to_dcm_folder, pacs_header_with_auth)
-        logger.debug("Sent to PACS.")
-    except Exception as e:
-        logger.exception("Exception occurred while uploading to PACS %s", e)
-        raise exceptions.UploadToPacsException("Uploading to PACS failed!") from e
-    pat_id = None
-    try:
-        pat_id = send_to_fhir(path_to_dcm_folder, business_id, fhir_header_with_auth)
-        logger.debug("Sent to FHIR.")
-    except Exception as e:
-        logger.exception("Exception occurred while uploading to FHIR %s", e)
-        raise exceptions.UploadToFHIRException("Uploading to FHIR failed!") from e
-    if pat_id is not None: # skip this step if the resource failed to be sent to the FHIR server
+    if progress_reporter is None:
+        progress_reporter = ProgressReporter(business_id, publish=False)
+    if ledger is None:
+        ledger = JobLedger(business_id, record=False)
+    if manifest is None:
+        manifest = JobManifest(business_id, folder=os.path.dirname(os.path.normpath(path_to_dcm_folder)))
+
+    if manifest.is_done("pacs_uploaded"):
+        logger.info("DICOM files of %s were already uploaded, skipping.", business_id)
+    else:
+        try:
+            with ledger.stage("send_to_pacs"):
+                send_to_pacs(path_to_dcm_folder, pacs_header_with_auth, progress_reporter)
+            manifest.complete("pacs_uploaded")
+            logger.debug("Sent to PACS.")
+        except Exception as e:
+            logger.exception("Exception occurred while uploading to PACS %s", e)
+            raise exceptions.UploadToPacsException("Uploading to PACS failed!") from e
+    pat_id = manifest.detail("fhir_created")
+    if pat_id is not None:
+        logger.info("ImagingStudy of %s was already uploaded, skipping.", business_id)
+    else:
         try:
-            create_and_assign_keycloak_roles(business_id, pat_id, kc_info)
+            with ledger.stage("send_to_fhir"):
+                progress_reporter.start_stage("send_to_fhir", unit="resources")
+                pat_id = send_to_fhir(path_to_dcm_folder, business_id, fhir_header_with_auth)
+                progress_reporter.finish_stage()
+            manifest.complete("fhir_created", detail=pat_id)
+            logger.debug("Sent to FHIR.")
+        except Exception as e:
+            logger.exception("Exception occurred while uploading to FHIR %s", e)
+            raise exceptions.UploadToFHIRException("Uploading to FHIR failed!") from e
+    if pat_id is not None and manifest.is_done("roles_assigned"):
+        logger.info("Keycloak roles of %s were already assigned, skipping.", business_id)
+    elif pat_id is not None: # skip this step if the resource failed to be sent to the FHIR server
+        try:
+            with ledger.stage("keycloak"):
+                progress_reporter.start_stage("keycloak", unit="roles")
+                # creating and assigning the roles is idempotent, so the whole step is retried
+                retry_policy.call(create_and_assign_keycloak_roles, business_id, pat_id, kc_info, target="keycloak")
+                progress_reporter.finish_stage()
+            manifest.complete("roles_assigned")
             logger.debug("Created and assigned Keycloak roles.")
         except Exception as e:
             logger.exception("Exception occurred while creating and/or assigning Keycloak roles %s", e)
             raise exceptions.GrantKeycloakRoleException("Creating or granting necessary roles failed!") from e
-    cleanup(os.path.join("./temp_data", business_id))
+    # the job folder (`temp_data/<uuid>/` or another scratch root, see scratch.py)
+    cleanup(os.path.dirname(os.path.normpath(path_to_dcm_folder)))
 
+@tracing.traced("sender.create_and_assign_keycloak_roles")
 def create_and_assign_keycloak_roles(imaging_study_id: str, patient_id: str, kc_info: KeycloakInfo):
     # use "special" admin user to create te
     keycloak_conn = KeycloakOpenIDConnection(
@@ -146,31 +202,38 @@ def create_and_assign_keycloak_roles(imaging_study_id: str, patient_id: str, kc_
     keycloak_admin.assign_realm_roles(user_id=kc_info.user_id, roles=roles_to_assign)
     logger.info("Assigned roles %s to user %s", roles_to_assign, kc_info.user_id)
 
+@tracing.traced("sender.update_prop_db_status")
 def update_prop_db_status(business_id: str, converted: bool, error_msg: str=""):
-    
-    conn = psycopg2.connect(
-        host="prop-postgres", # container name change-me
-        port="5432", # port defined in docker-compose.yml change-me
-        database="prop", # defined in db.sql in prop folder change-me
-        user="postgres", # defined in environment variables for prop-postgres container secret-me
-        password="postgres" # defined in environment variables for prop-postgres container secret-me
-    )
-    logger.debug("Established connection to prop database.")
-    cur = conn.cursor()
+    """
+    Write the outcome of a conversion to the prop database and notify all listening clients
+    (`LISTEN conversion_status`) in the same transaction. The notification payload is a json object
+    with the fields "id", "converted" and "failed". The (possibly long) error message is not part of
+    the payload, it has to be read from the database.
+
+    :param business_id: The business ID of the conversion.
+    :type business_id: str
+    :param converted: Whether the conversion (and all uploads) succeeded.
+    :type converted: bool
+    :param error_msg: The formatted exception if the conversion failed, defaults to "".
+    :type error_msg: str, optional
+    """
     sql = \
         """
         UPDATE data
         SET converted=%s, error_msg=%s
         WHERE id=%s::UUID
         """
-    cur.execute(sql, (converted, error_msg, business_id))
-    conn.commit()
+    payload = json.dumps({"id": business_id, "converted": converted, "failed": error_msg != ""})
+    with prop_db.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, (converted, error_msg, business_id))
+            # the notification is only delivered once the transaction commits, so listeners always see the updated row
+            cur.execute("SELECT pg_notify(%s, %s)", (PROP_DB_STATUS_CHANNEL, payload))
     logger.info("Updated prop database with converted=%s and error_msg=%s for user=%s", converted, error_msg, business_id)
     if error_msg == "":
         logger.info("No error occurred.")
-    cur.close()
-    conn.close()
 
+@tracing.traced("sender.cleanup")
 def cleanup(path_to_delete: str):
     """
     Cleanup after "converter" container is done.
@@ -181,29 +244,78 @@ def cleanup(path_to_delete: str):
     logger.info("Deleting folder (and subfolders) %s", path_to_delete)
     shutil.rmtree(path_to_delete)
 
-def send_to_pacs(path_to_dcm_folder: str, pacs_header_with_auth: dict[str, str]):
+@tracing.traced("sender.send_to_pacs")
+def send_to_pacs(path_to_dcm_folder: str, pacs_header_with_auth: dict[str, str], progress_reporter: ProgressReporter | None = None, skip_stored: bool = SKIP_STORED_INSTANCES):
     """
-    Send dicom files to PACS.
+    Send dicom files to PACS. Files which the PACS already stores are skipped (see `pacs_lookup.py`).
 
     :param path_to_dcm_folder: Path where the DICOM files are located on the system.
     :type path_to_dcm_folder: str
     :param pacs_header_with_auth: HTTP header containing bearer token.
     :type pacs_header_with_auth: dict[str, str]
+    :param progress_reporter: Receives the amount of uploaded bytes after every file, defaults to None.
+    :type progress_reporter: ProgressReporter | None
+    :param skip_stored: Whether the stored instances of the study are looked up first, defaults to `SKIP_STORED_INSTANCES`.
+    :type skip_stored: bool
     """
     logger.debug("Sending to PACS...")
-    for dcm_file in os.scandir(path_to_dcm_folder):
-            if os.path.isfile(dcm_file):
-                upload_file(dcm_file, pacs_header_with_auth)
+    dcm_files = [dcm_file for dcm_file in os.scandir(path_to_dcm_folder) if dcm_file.is_file()]
+    total_bytes = sum(dcm_file.stat().st_size for dcm_file in dcm_files)
+    tracing.set_attribute("files", len(dcm_files))
+    tracing.set_attribute("bytes", total_bytes)
+    if progress_reporter is not None:
+        progress_reporter.start_stage("send_to_pacs", total=total_bytes, unit="bytes")
+    stored = _find_stored_instances(dcm_files, pacs_header_with_auth) if skip_stored and dcm_files else None
+    uploaded_bytes = 0
+    skipped_files = 0
+    for uploaded_files, dcm_file in enumerate(dcm_files, start=1):
+        size = dcm_file.stat().st_size
+        if stored and _is_stored(stored, dcm_file, size):
+            logger.debug("Orthanc already stores %s, skipping.", dcm_file.name)
+            skipped_files += 1
+            metrics.PACS_SKIPPED_BYTES.inc(size)
+        else:
+            upload_file(dcm_file, pacs_header_with_auth)
+        # skipped files count as uploaded, the progress is about the files being in the PACS
+        uploaded_bytes += size
+        if progress_reporter is not None:
+            progress_reporter.update(uploaded_bytes, files_uploaded=uploaded_files)
+    tracing.set_attribute("skipped_files", skipped_files)
+    if skipped_files:
+        logger.info("Skipped %s of %s files which Orthanc already stores.", skipped_files, len(dcm_files))
+    if progress_reporter is not None:
+        progress_reporter.finish_stage(files_uploaded=len(dcm_files), bytes_uploaded=uploaded_bytes, files_skipped=skipped_files)
+
+def _find_stored_instances(dcm_files: list[os.DirEntry], pacs_header_with_auth: dict[str, str]) -> pacs_lookup.StoredInstances | None:
+    try:
+        # all files of a job belong to the same study (see `filler._fill_default_metadata`)
+        study_instance_uid, _ = pacs_lookup.read_uids(dcm_files[0].path)
+        return pacs_lookup.StoredInstances(ORTHANC_URL, study_instance_uid, verify_md5=VERIFY_STORED_MD5,
+                                           send=functools.partial(retry_policy.request, target="orthanc"), headers=pacs_header_with_auth)
+    except Exception as e:
+        # the lookup is only an optimization, uploading everything again is always correct
+        logger.warning("Could not look up the instances Orthanc already stores, uploading all files: %s", e)
+        return None
+
+def _is_stored(stored: pacs_lookup.StoredInstances, dcm_file: os.DirEntry, size: int) -> bool:
+    try:
+        return stored.contains(pacs_lookup.read_uids(dcm_file.path)[1], size, functools.partial(pacs_lookup.file_md5, dcm_file.path))
+    except Exception as e:
+        # e.g. the MD5 lookup was rejected, uploading the file again is always correct
+        logger.warning("Could not check whether Orthanc already stores %s, uploading it: %s", dcm_file.name, e)
+        return False
 
 def upload_file(path, pacs_header_with_auth: dict[str, str]):
+    # the file object is streamed by requests, so the (possibly multiple GB large) instance is not read into memory at once
     with open(path, "rb") as f:
-        dicom = f.read()
-        # print("Uploading: %s (%dMB)" % (path, len(dicom) / (1024 * 1024)))
-        upload_buffer(dicom, pacs_header_with_auth)
+        upload_buffer(f, pacs_header_with_auth)
 
+@tracing.traced("sender.upload_buffer")
 def upload_buffer(dicom, pacs_header_with_auth: dict[str, str]) -> None:
     url = "%s/instances" % ORTHANC_URL
-    r = requests.post(url, headers=pacs_header_with_auth, data=dicom)
+    tracing.set_attribute("bytes", len(dicom) if isinstance(dicom, (bytes, bytearray)) else os.fstat(dicom.fileno()).st_size)
+    r = retry_policy.request("POST", url, target="orthanc", headers=pacs_header_with_auth, data=dicom)
+    tracing.set_attribute("http.status_code", r.status_code)
     try:
         r.raise_for_status()
     except Exception as e:
@@ -254,6 +366,7 @@ def get_wado_rs_endpoint_to_(type: typing.Literal["study", "series"], business_i
     ep.id = type
     return ep
 
+@tracing.traced("sender.send_to_fhir")
 def send_to_fhir(path_to_dcm_folder: str, business_id: str, header_with_auth: dict[str, str]) -> str:
     """
     Send generated DICOM files to the FHIR server by converting/wrapping it in an ImagingStudy.
@@ -269,10 +382,12 @@ def send_to_fhir(path_to_dcm_folder: str, business_id: str, header_with_auth: di
     """
 
     # TODO: re-reading all the files... poor performance probably
+    # only the headers are needed for the ImagingStudy, reading the pixel data would load the whole study into memory
     ds_list = []
-    for dcm_file in os.scandir(path_to_dcm_folder):
-        if os.path.isfile(dcm_file):
-            ds_list.append(pydicom.dcmread(dcm_file))
+    with tracing.span("sender.read_datasets"):
+        for dcm_file in os.scandir(path_to_dcm_folder):
+            if os.path.isfile(dcm_file):
+                ds_list.append(pydicom.dcmread(dcm_file, stop_before_pixels=True))
     
     pat_id = ds_list[0].PatientID
     patient_reference = fhir_handler.patient_already_exists(f"urn:uuid:{pat_id}", header_with_auth)
@@ -280,5 +395,5 @@ def send_to_fhir(path_to_dcm_folder: str, business_id: str, header_with_auth: di
         fhir_patient = fhir_handler.construct_fhir_patient(ds_list[0])
         patient_reference = fhir_handler.upload_patient(fhir_patient, header_with_auth)
     fhir_imaging_study = fhir_handler.construct_fhir_imaging_study(business_id, fhir_patient_reference_path=patient_reference ,ds_list=ds_list)
-    fhir_handler.upload_imaging_study(fhir_imaging_study, header_with_auth)
+    fhir_handler.upload_imaging_study(fhir_imaging_study, header_with_auth, business_id=business_id)
     return pat_id
\ No newline at end of file
@@ -0,0 +1,174 @@
+from __future__ import annotations
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import logging
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s", datefmt="%d/%b/%Y %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# every finished span is appended as a single line in the OTLP/JSON format (ExportTraceServiceRequest), so the file can be
+# read by the OpenTelemetry collector ("otlpjsonfile" receiver) or any OTLP tool later on. An empty value disables tracing.
+TRACE_FILE = os.environ.get("CONVERTER_TRACE_FILE", "traces/spans.jsonl") # change-me
+# the file is rotated to "<file>.1" once it exceeds this size
+TRACE_FILE_MAX_BYTES = int(os.environ.get("CONVERTER_TRACE_FILE_MAX_BYTES", str(256 * 1024 * 1024))) # change-me
+SERVICE_NAME = "converter"
+
+_STATUS_ERROR = 2
+_SPAN_KIND_INTERNAL = 1
+
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar("current_span", default=None)
+_export_lock = threading.Lock()
+
+
+class Span:
+    """
+    A single timed operation. Create spans with `span()` or the `traced` decorator instead of directly.
+    """
+    def __init__(self, name: str, trace_id: str, parent_span_id: str | None, attributes: dict) -> None:
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent_span_id
+        self.attributes = dict(attributes)
+        self.start_time_ns = time.time_ns()
+        self.end_time_ns: int | None = None
+        self.error: str | None = None
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def to_otlp(self) -> dict:
+        otlp_span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": _SPAN_KIND_INTERNAL,
+            "startTimeUnixNano": str(self.start_time_ns),
+            "endTimeUnixNano": str(self.end_time_ns),
+            "attributes": [_to_otlp_attribute(key, value) for key, value in self.attributes.items() if value is not None],
+            "status": {"code": _STATUS_ERROR, "message": self.error} if self.error is not None else {}
+        }
+        if self.parent_span_id is not None:
+            otlp_span["parentSpanId"] = self.parent_span_id
+        return otlp_span
+
+
+@contextmanager
+def span(name: str, business_id: str | None = None, **attributes):
+    """
+    Time the block as a span. Spans opened inside the block (in the same thread) become its children.
+    A span without a parent starts a new trace. If a business ID is given for such a root span, it is used as the
+    trace ID (a UUID has exactly the 16 bytes of a trace ID), so the trace of a job can be found by its business ID.
+
+    .. code-block:: python
+    with tracing.span("sender.upload_buffer", bytes=len(dicom)) as s:
+        r = requests.post(...)
+        s.set_attribute("http.status_code", r.status_code)
+
+    :param name: Name of the span, usually "<module>.<function>".
+    :type name: str
+    :param business_id: Business ID of the job, also added as attribute "business_id".
+    :type business_id: str | None
+    """
+    if not TRACE_FILE:
+        yield _NOOP_SPAN
+        return
+    parent = _current_span.get()
+    if parent is not None:
+        trace_id = parent.trace_id
+        parent_span_id = parent.span_id
+    else:
+        trace_id = uuid.UUID(business_id).hex if business_id else os.urandom(16).hex()
+        parent_span_id = None
+    if business_id is not None:
+        attributes["business_id"] = business_id
+    current = Span(name, trace_id, parent_span_id, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = repr(e)
+        current.set_attribute("exception.type", type(e).__name__)
+        raise
+    finally:
+        current.end_time_ns = time.time_ns()
+        _current_span.reset(token)
+        _export(current)
+
+
+def traced(name: str | None = None):
+    """
+    Decorator which runs the whole function in a span (see `span()`).
+
+    :param name: Name of the span, defaults to "<module>.<function name>".
+    :type name: str | None
+    """
+    def decorator(func):
+        span_name = name or f"{func.__module__}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def set_attribute(key: str, value) -> None:
+    """
+    Set an attribute (e.g. the HTTP status or a file size) on the currently open span, if any.
+    """
+    current = _current_span.get()
+    if current is not None:
+        current.set_attribute(key, value)
+
+
+def _export(finished: Span) -> None:
+    request = {
+        "resourceSpans": [{
+            "resource": {"attributes": [_to_otlp_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{
+                "scope": {"name": __name__},
+                "spans": [finished.to_otlp()]
+            }]
+        }]
+    }
+    line = json.dumps(request, separators=(",", ":")) + "\n"
+    try:
+        with _export_lock:
+            directory = os.path.dirname(TRACE_FILE)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) > TRACE_FILE_MAX_BYTES:
+                os.replace(TRACE_FILE, f"{TRACE_FILE}.1")
+            with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(line)
+    except OSError as e:
+        logger.warning("Could not export span %s: %s", finished.name, e)
+
+
+def _to_otlp_attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        otlp_value = {"boolValue": value}
+    elif isinstance(value, int):
+        otlp_value = {"intValue": str(value)} # int64 is encoded as string in OTLP/JSON
+    elif isinstance(value, float):
+        otlp_value = {"doubleValue": value}
+    else:
+        otlp_value = {"stringValue": str(value)}
+    return {"key": key, "value": otlp_value}
+
+
+class _NoopSpan:
+    def set_attribute(self, key: str, value) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
@@ -44,6 +44,8 @@ import bz2
 
 import gzip
 
+import hashlib
+
 import json
 
 import os
@@ -59,6 +61,8 @@ import zipfile
 
 from requests.auth import HTTPBasicAuth
 
+import pacs_lookup
+
 
 parser = argparse.ArgumentParser(
     description="Command-line tool to import files or archives into Orthanc."
@@ -90,6 +94,12 @@ parser.add_argument(
     action="store_true",
 )
 
+parser.add_argument(
+    "--skip-existing",
+    help="Do not upload instances which Orthanc already stores (same SOPInstanceUID, size and MD5)",
+    action="store_true",
+)
+
 parser.add_argument("files", metavar="N", nargs="*", help="Files to import")
 
 
@@ -123,6 +133,10 @@ COUNT_DICOM = 0
 
 COUNT_JSON = 0
 
+COUNT_SKIPPED = 0
+
+STORED_INSTANCES = {}
+
 
 def IsJson(content):
     try:
@@ -140,6 +154,25 @@ def IsJson(content):
         return False
 
 
+def IsStored(dicom):
+    try:
+        study_instance_uid, sop_instance_uid = pacs_lookup.read_uids(dicom)
+
+    except:
+        # not a DICOM file, Orthanc reports the error on upload
+        return False
+
+    if study_instance_uid not in STORED_INSTANCES:
+        # a single lookup per study
+        STORED_INSTANCES[study_instance_uid] = pacs_lookup.StoredInstances(
+            args.url, study_instance_uid, auth=HTTPBasicAuth(args.username, args.password)
+        )
+
+    return STORED_INSTANCES[study_instance_uid].contains(
+        sop_instance_uid, len(dicom), lambda: hashlib.md5(dicom).hexdigest()
+    )
+
+
 def UploadBuffer(dicom):
     global IMPORTED_STUDIES
 
@@ -149,11 +182,21 @@ def UploadBuffer(dicom):
 
     global COUNT_JSON
 
+    global COUNT_SKIPPED
+
     if IsJson(dicom):
         COUNT_JSON += 1
 
         return
 
+    if args.skip_existing and IsStored(dicom):
+        COUNT_SKIPPED += 1
+
+        if args.verbose:
+            print("  already stored in Orthanc, skipping it")
+
+        return
+
     auth = HTTPBasicAuth(args.username, args.password)
 
     r = requests.post("%s/instances" % args.url, auth=auth, data=dicom)
@@ -356,6 +399,8 @@ print("  %d DICOM studies properly imported" % len(IMPORTED_STUDIES))
 
 print("  %d JSON files ignored" % COUNT_JSON)
 
+print("  %d DICOM instances already stored" % COUNT_SKIPPED)
+
 print("  Error in %d files" % COUNT_ERROR)
 
 print("")
@@ -35,6 +35,7 @@ public class ProprietaryFileReceiveHandler {
 	public static final String PROP_DB_NAME = "prop"; // defined in db.sql in prop folder change-me
 	public static final String PROP_DB_USERNAME = "postgres"; // defined in environment variables for prop-postgres container secret-me
 	public static final String PROP_DB_PASSWORD = "postgres"; // defined in environment variables for prop-postgres container secret-me
+	public static final String PROP_DB_STATUS_CHANNEL = "conversion_status"; // matches channel in converter script change-me
 
 	public static UUID generateUUID() {
 		return UUID.randomUUID();
@@ -51,12 +52,20 @@ public class ProprietaryFileReceiveHandler {
 				IParser parser = context.newJsonParser();
 				DocumentReference documentReference = parser.parseResource(DocumentReference.class, json);
 				ourLog.debug("Parsed incoming request to DocumentReference.");
-				byte[] decodedFile = documentReference.getContent().get(0).getAttachment().getData();
-				if(decodedFile.length == 0) {
-					ourLog.warn("DocumentReference contains no base64 encoded data.");
-					throw new DataFormatException();
+				Attachment attachment = documentReference.getContent().get(0).getAttachment();
+				String pathToWsiTarball;
+				if(attachment.hasUrl()) {
+					// the file was streamed beforehand through the upload endpoint (see ProprietaryUploadController)
+					pathToWsiTarball = moveUploadToFile(uuid, attachment.getUrl(), keycloakUserID);
+				}
+				else {
+					byte[] decodedFile = attachment.getData();
+					if(decodedFile == null || decodedFile.length == 0) {
+						ourLog.warn("DocumentReference contains no base64 encoded data.");
+						throw new DataFormatException();
+					}
+					pathToWsiTarball = writeToFile(uuid, decodedFile);
 				}
-				String pathToWsiTarball = writeToFile(uuid, decodedFile);
 				insertToDatabase(uuid, pathToWsiTarball, PROP_DB_CONTAINER_NAME, PROP_DB_NAME, PROP_DB_USERNAME, PROP_DB_PASSWORD);
 				String jsonUUIDAndFilepathAndDicomTags = compose(
 					uuid,
@@ -150,6 +159,15 @@ public class ProprietaryFileReceiveHandler {
 		return pathInSharedVolume;
 	}
 
+	private static String moveUploadToFile(UUID uuid, String uploadUrl, String keycloakUserID) throws IOException {
+		String uploadId = ProprietaryFlatFileStorage.uploadIdFromUrl(uploadUrl);
+		ProprietaryFlatFileStorage.UploadSession session = ProprietaryFlatFileStorage.getUploadSession(uploadId);
+		if(session == null || !session.getOwner().equals(keycloakUserID)) {
+			throw new DataFormatException(String.format("DocumentReference references unknown upload %s!", uploadUrl));
+		}
+		return ProprietaryFlatFileStorage.moveUploadToTarball(session, uuid);
+	}
+
 	public static void insertToDatabase(UUID uuid, String pathToFile, String dbHost, String dbName, String user, String password) throws SQLException {
 		final String url = String.format("jdbc:postgresql://%s/%s", dbHost, dbName);
 		ourLog.info("Connecting to database {}", url);
@@ -229,6 +247,17 @@ public class ProprietaryFileReceiveHandler {
 		preparedStatement.setBoolean(1, converted);
 		preparedStatement.setString(2, errorMessage);
 		preparedStatement.executeUpdate();
+		if(!errorMessage.isEmpty()) {
+			// the converter will never pick this file up, so tell waiting clients right away (same payload as the converter)
+			JsonObject payload = new JsonObject()
+				.add("id", businessID.toString())
+				.add("converted", converted)
+				.add("failed", true);
+			PreparedStatement notify = connection.prepareStatement("SELECT pg_notify(?, ?)");
+			notify.setString(1, PROP_DB_STATUS_CHANNEL);
+			notify.setString(2, payload.toString());
+			notify.execute();
+		}
 		connection.close();
 		ourLog.info("Updated the database with error message {}", errorMessage);
 	}
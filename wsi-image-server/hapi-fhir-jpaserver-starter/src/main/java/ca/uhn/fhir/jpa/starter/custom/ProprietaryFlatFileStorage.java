@@ -1,12 +1,32 @@
 package ca.uhn.fhir.jpa.starter.custom;
 
-import java.io.FileNotFoundException;
 import java.io.FileOutputStream;
 import java.io.IOException;
+import java.io.InputStream;
 import java.io.OutputStream;
+import java.nio.ByteBuffer;
+import java.nio.channels.Channels;
+import java.nio.channels.FileChannel;
+import java.nio.channels.ReadableByteChannel;
+import java.nio.file.Files;
+import java.nio.file.Path;
+import java.nio.file.Paths;
+import java.nio.file.StandardCopyOption;
+import java.nio.file.StandardOpenOption;
+import java.util.Properties;
+import java.util.UUID;
 
 public class ProprietaryFlatFileStorage {
 
+	private static final org.slf4j.Logger ourLog = org.slf4j.LoggerFactory.getLogger(ProprietaryFlatFileStorage.class);
+
+	// ./app/create-data/* contains all proprietary files (see line 30 in Dockerfile for hapi-fhir)
+	public static final String CREATE_DATA_FOLDER = "./app/create-data"; // change-me
+	// unfinished uploads are kept on the same volume, so finishing an upload is a rename and not a copy
+	public static final String UPLOAD_FOLDER = CREATE_DATA_FOLDER + "/uploads"; // change-me
+
+	private static final int TRANSFER_BUFFER_SIZE = 1024 * 1024;
+
 	public static String storeOnDisk(byte[] base64DecodedBytes) throws IOException {
 
 		OutputStream stream = new FileOutputStream("./create-data/test.tar.gz");
@@ -15,4 +35,178 @@ public class ProprietaryFlatFileStorage {
 		return null;
 	}
 
+	/**
+	 * Thrown when a chunk does not start at the current end of the upload (e.g. the client has to resume first).
+	 */
+	public static class UploadOffsetMismatchException extends Exception {
+		private final long currentOffset;
+
+		public UploadOffsetMismatchException(long currentOffset) {
+			super(String.format("Chunk has to start at offset %d!", currentOffset));
+			this.currentOffset = currentOffset;
+		}
+
+		public long getCurrentOffset() {
+			return currentOffset;
+		}
+	}
+
+	/**
+	 * State of a single (possibly unfinished) upload. The state is kept on disk next to the uploaded bytes,
+	 * so uploads can be resumed after a restart of the server.
+	 */
+	public static class UploadSession {
+		private final String id;
+		private final String owner;
+		private final long length;
+		private final long offset;
+
+		private UploadSession(String id, String owner, long length, long offset) {
+			this.id = id;
+			this.owner = owner;
+			this.length = length;
+			this.offset = offset;
+		}
+
+		public String getId() {
+			return id;
+		}
+
+		public String getOwner() {
+			return owner;
+		}
+
+		public long getLength() {
+			return length;
+		}
+
+		public long getOffset() {
+			return offset;
+		}
+
+		public boolean isComplete() {
+			return offset == length;
+		}
+	}
+
+	/**
+	 * Create a new (empty) upload.
+	 *
+	 * @param owner  Keycloak user ID of the uploading user. Only this user may append to or use the upload.
+	 * @param length Total size of the file in bytes.
+	 * @return The new upload session.
+	 */
+	public static UploadSession createUploadSession(String owner, long length) throws IOException {
+		Files.createDirectories(Paths.get(UPLOAD_FOLDER));
+		String id = UUID.randomUUID().toString();
+		Properties metadata = new Properties();
+		metadata.setProperty("owner", owner);
+		metadata.setProperty("length", Long.toString(length));
+		try(OutputStream stream = Files.newOutputStream(metadataPath(id))) {
+			metadata.store(stream, null);
+		}
+		Files.createFile(dataPath(id));
+		ourLog.info("Created upload session {} with length {} for user {}", id, length, owner);
+		return new UploadSession(id, owner, length, 0);
+	}
+
+	/**
+	 * Look up an existing upload.
+	 *
+	 * @return The upload session or null if no upload with this ID exists.
+	 */
+	public static UploadSession getUploadSession(String id) throws IOException {
+		if(!isValidId(id) || !Files.exists(metadataPath(id))) {
+			return null;
+		}
+		Properties metadata = new Properties();
+		try(InputStream stream = Files.newInputStream(metadataPath(id))) {
+			metadata.load(stream);
+		}
+		return new UploadSession(
+			id,
+			metadata.getProperty("owner"),
+			Long.parseLong(metadata.getProperty("length")),
+			Files.size(dataPath(id)));
+	}
+
+	/**
+	 * Append a chunk to an upload. The chunk is streamed directly from the request to the file,
+	 * so the memory usage does not depend on the chunk (or file) size.
+	 *
+	 * @param session The upload to append to.
+	 * @param offset  Offset of the first byte of the chunk. Has to match the current size of the upload.
+	 * @param chunk   The chunk contents.
+	 * @return The new offset (size of the upload).
+	 */
+	public static long appendChunk(UploadSession session, long offset, InputStream chunk) throws IOException, UploadOffsetMismatchException {
+		if(offset != session.getOffset()) {
+			throw new UploadOffsetMismatchException(session.getOffset());
+		}
+		try(FileChannel channel = FileChannel.open(dataPath(session.getId()), StandardOpenOption.WRITE)) {
+			channel.position(offset);
+			ReadableByteChannel source = Channels.newChannel(chunk);
+			ByteBuffer buffer = ByteBuffer.allocate(TRANSFER_BUFFER_SIZE);
+			long position = offset;
+			while(source.read(buffer) != -1) {
+				buffer.flip();
+				position += buffer.remaining();
+				if(position > session.getLength()) {
+					// do not keep anything beyond the announced length
+					channel.truncate(offset);
+					throw new IOException(String.format("Upload %s exceeds its announced length of %d bytes!", session.getId(), session.getLength()));
+				}
+				while(buffer.hasRemaining()) {
+					channel.write(buffer);
+				}
+				buffer.clear();
+			}
+			channel.force(false);
+			return position;
+		}
+	}
+
+	/**
+	 * Move a completed upload to its final place in the flat file storage. Both are on the same volume, so this is
+	 * a rename instead of a copy.
+	 *
+	 * @param session  The completed upload.
+	 * @param uuid     The business ID of the file.
+	 * @return The path to the stored tarball (e.g. "./app/create-data/<uuid>.tar.gz").
+	 */
+	public static String moveUploadToTarball(UploadSession session, UUID uuid) throws IOException {
+		if(!session.isComplete()) {
+			throw new IOException(String.format("Upload %s is incomplete (%d of %d bytes)!", session.getId(), session.getOffset(), session.getLength()));
+		}
+		final String pathInSharedVolume = String.format("%s/%s.tar.gz", CREATE_DATA_FOLDER, uuid.toString());
+		Files.move(dataPath(session.getId()), Paths.get(pathInSharedVolume), StandardCopyOption.ATOMIC_MOVE);
+		Files.deleteIfExists(metadataPath(session.getId()));
+		ourLog.info("Moved upload {} to {}", session.getId(), pathInSharedVolume);
+		return pathInSharedVolume;
+	}
+
+	/**
+	 * Extract the upload ID from an attachment url (e.g. "http://localhost:8081/upload/sessions/<id>").
+	 */
+	public static String uploadIdFromUrl(String url) {
+		String trimmed = url.endsWith("/") ? url.substring(0, url.length() - 1) : url;
+		return trimmed.substring(trimmed.lastIndexOf('/') + 1);
+	}
+
+	private static boolean isValidId(String id) {
+		try {
+			return UUID.fromString(id).toString().equals(id); // prevents path traversal through the ID
+		} catch (IllegalArgumentException e) {
+			return false;
+		}
+	}
+
+	private static Path dataPath(String id) {
+		return Paths.get(UPLOAD_FOLDER, id + ".part");
+	}
+
+	private static Path metadataPath(String id) {
+		return Paths.get(UPLOAD_FOLDER, id + ".properties");
+	}
+
 }
@@ -0,0 +1,99 @@
+package ca.uhn.fhir.jpa.starter.custom;
+
+import ca.uhn.fhir.jpa.starter.interceptors.KeycloakAuthorizationInterceptor;
+import org.keycloak.adapters.springsecurity.token.KeycloakAuthenticationToken;
+import org.keycloak.representations.AccessToken;
+import org.springframework.http.HttpStatus;
+import org.springframework.http.ResponseEntity;
+import org.springframework.web.bind.annotation.*;
+import org.springframework.web.servlet.support.ServletUriComponentsBuilder;
+
+import javax.servlet.http.HttpServletRequest;
+import java.io.IOException;
+import java.net.URI;
+
+/**
+ * Resumable upload of (large) proprietary files. Instead of embedding the base64 encoded tarball in the
+ * DocumentReference, the client streams it in chunks to this endpoint and references the finished upload with
+ * DocumentReference.content.attachment.url. Neither the client nor the server has to hold the file in memory.
+ * <p>
+ * 1. POST /upload/sessions with header "Upload-Length" creates an upload. The url is returned in the "Location" header.
+ * 2. PATCH /upload/sessions/{id} with header "Upload-Offset" appends a chunk (request body) to the upload.
+ * 3. HEAD /upload/sessions/{id} returns the current "Upload-Offset", so interrupted uploads can be resumed.
+ */
+@RestController
+@RequestMapping("upload/sessions")
+public class ProprietaryUploadController {
+
+	private static final org.slf4j.Logger ourLog = org.slf4j.LoggerFactory.getLogger(ProprietaryUploadController.class);
+
+	public static final String UPLOAD_LENGTH_HEADER = "Upload-Length";
+	public static final String UPLOAD_OFFSET_HEADER = "Upload-Offset";
+
+	@PostMapping
+	public ResponseEntity<Void> createUpload(@RequestHeader(UPLOAD_LENGTH_HEADER) long length, HttpServletRequest request) throws IOException {
+		AccessToken token = getAccessToken(request);
+		if(token == null || !token.getRealmAccess().getRoles().contains(KeycloakAuthorizationInterceptor.ROLE_CREATE)) {
+			return ResponseEntity.status(HttpStatus.FORBIDDEN).build();
+		}
+		if(length <= 0) {
+			return ResponseEntity.badRequest().build();
+		}
+		ProprietaryFlatFileStorage.UploadSession session = ProprietaryFlatFileStorage.createUploadSession(token.getSubject(), length);
+		URI location = ServletUriComponentsBuilder.fromCurrentRequest().path("/{id}").buildAndExpand(session.getId()).toUri();
+		return ResponseEntity.created(location)
+			.header(UPLOAD_OFFSET_HEADER, "0")
+			.build();
+	}
+
+	@RequestMapping(path = "{id}", method = RequestMethod.HEAD)
+	public ResponseEntity<Void> getUploadOffset(@PathVariable String id, HttpServletRequest request) throws IOException {
+		ProprietaryFlatFileStorage.UploadSession session = getOwnedSession(id, request);
+		if(session == null) {
+			return ResponseEntity.notFound().build();
+		}
+		return ResponseEntity.ok()
+			.header(UPLOAD_OFFSET_HEADER, Long.toString(session.getOffset()))
+			.header(UPLOAD_LENGTH_HEADER, Long.toString(session.getLength()))
+			.header("Cache-Control", "no-store")
+			.build();
+	}
+
+	@PatchMapping("{id}")
+	public ResponseEntity<Void> appendChunk(@PathVariable String id, @RequestHeader(UPLOAD_OFFSET_HEADER) long offset, HttpServletRequest request) throws IOException {
+		ProprietaryFlatFileStorage.UploadSession session = getOwnedSession(id, request);
+		if(session == null) {
+			return ResponseEntity.notFound().build();
+		}
+		try {
+			long newOffset = ProprietaryFlatFileStorage.appendChunk(session, offset, request.getInputStream());
+			ourLog.debug("Upload {} is at {} of {} bytes", id, newOffset, session.getLength());
+			return ResponseEntity.noContent()
+				.header(UPLOAD_OFFSET_HEADER, Long.toString(newOffset))
+				.build();
+		} catch (ProprietaryFlatFileStorage.UploadOffsetMismatchException e) {
+			ourLog.info("Rejected chunk for upload {}: {}", id, e.getMessage());
+			return ResponseEntity.status(HttpStatus.CONFLICT)
+				.header(UPLOAD_OFFSET_HEADER, Long.toString(e.getCurrentOffset()))
+				.build();
+		}
+	}
+
+	private ProprietaryFlatFileStorage.UploadSession getOwnedSession(String id, HttpServletRequest request) throws IOException {
+		AccessToken token = getAccessToken(request);
+		ProprietaryFlatFileStorage.UploadSession session = ProprietaryFlatFileStorage.getUploadSession(id);
+		if(token == null || session == null || !session.getOwner().equals(token.getSubject())) {
+			// do not reveal whether uploads of other users exist
+			return null;
+		}
+		return session;
+	}
+
+	private static AccessToken getAccessToken(HttpServletRequest request) {
+		if(!(request.getUserPrincipal() instanceof KeycloakAuthenticationToken)) {
+			return null;
+		}
+		KeycloakAuthenticationToken token = (KeycloakAuthenticationToken) request.getUserPrincipal();
+		return token.getAccount().getKeycloakSecurityContext().getToken();
+	}
+}
@@ -17,6 +17,8 @@ package ca.uhn.fhir.jpa.starter.interceptors;
 
 import static org.springframework.http.HttpMethod.DELETE;
 import static org.springframework.http.HttpMethod.GET;
+import static org.springframework.http.HttpMethod.HEAD;
+import static org.springframework.http.HttpMethod.PATCH;
 import static org.springframework.http.HttpMethod.POST;
 import static org.springframework.http.HttpMethod.PUT;
 
@@ -65,7 +67,7 @@ import org.springframework.web.cors.UrlBasedCorsConfigurationSource;
 public class KeycloakSecurityConfig extends KeycloakWebSecurityConfigurerAdapter {
 
 	private static final String CORS_ALLOWED_HEADERS =
-		"origin,content-type,accept,x-requested-with,Authorization";
+		"origin,content-type,accept,x-requested-with,Authorization,Upload-Length,Upload-Offset";
 
 	private String opensrpAllowedSources = "*";
 
@@ -158,6 +160,8 @@ public class KeycloakSecurityConfig extends KeycloakWebSecurityConfigurerAdapter
 			.permitAll()
 			.antMatchers("/fhir/**")
 			.authenticated()
+			.antMatchers("/upload/**")
+			.authenticated()
 			.and()
 			.csrf()
 			.disable()
@@ -201,7 +205,7 @@ public class KeycloakSecurityConfig extends KeycloakWebSecurityConfigurerAdapter
 		CorsConfiguration configuration = new CorsConfiguration();
 		configuration.setAllowedOrigins(Arrays.asList(opensrpAllowedSources.split(",")));
 		configuration.setAllowedMethods(
-			Arrays.asList(GET.name(), POST.name(), PUT.name(), DELETE.name()));
+			Arrays.asList(GET.name(), POST.name(), PUT.name(), DELETE.name(), PATCH.name(), HEAD.name()));
 		configuration.setAllowedHeaders(Arrays.asList(CORS_ALLOWED_HEADERS.split(",")));
 		configuration.setMaxAge(corsMaxAge);
 		UrlBasedCorsConfigurationSource source = new UrlBasedCorsConfigurationSource();
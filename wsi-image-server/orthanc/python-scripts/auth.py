@@ -15,6 +15,11 @@ def is_converter_pacs_uploader(url: str, request, roles):
     is_post_request = request["method"] == 2
     return is_post_request and "converter_pacs_upload" in roles
 
+def is_converter_md5_lookup(url: str, request, roles):
+    # the converter compares the MD5 of stored instances before uploading them again (POST /tools/find is covered above)
+    is_get_request = request["method"] == 1
+    return is_get_request and url.startswith("/instances/") and url.endswith("/attachments/dicom/md5") and "converter_pacs_upload" in roles
+
 def filter(uri, **request):
     # TODO: REMOVE, ONLY FOR TESTING!!!
     # return True
@@ -42,6 +47,9 @@ def filter(uri, **request):
     if is_converter_pacs_uploader(uri, request, roles):
         logger.info("Detected that the uploader is the converter. Grant access.")
         return True
+    if is_converter_md5_lookup(uri, request, roles):
+        logger.info("Detected that the converter looks up a stored instance. Grant access.")
+        return True
     split = uri.split("/")[1:] # ignore empty string because the url starts with '/'
     # 0 -> "dicom-web"
     # 1 -> "studies"
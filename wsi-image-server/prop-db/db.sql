@@ -3,4 +3,72 @@ CREATE TABLE data (
     path_to_file varchar(100) NOT NULL,
     converted boolean NOT NULL,
     error_msg  text NULL
-);
\ No newline at end of file
+);
+
+-- one row per stage (extract, convert, fill, send_to_pacs, send_to_fhir, keycloak) and attempt of a job
+CREATE TABLE job_stage (
+    id bigserial PRIMARY KEY,
+    job_id uuid NOT NULL REFERENCES data(id) ON DELETE CASCADE,
+    stage varchar(32) NOT NULL,
+    started_at timestamptz NOT NULL,
+    finished_at timestamptz NOT NULL,
+    succeeded boolean NOT NULL,
+    error_msg text NULL
+);
+CREATE INDEX job_stage_job_id_idx ON job_stage (job_id);
+CREATE INDEX job_stage_started_at_idx ON job_stage (started_at);
+CREATE INDEX job_stage_stage_started_at_idx ON job_stage (stage, started_at);
+
+-- resources used by a job (RSS and CPU are measured for the whole converter process, they only belong to the
+-- job alone if concurrent_jobs is 1; peak_rss_bytes - start_rss_bytes is the memory added during the job)
+CREATE TABLE job_resources (
+    job_id uuid PRIMARY KEY REFERENCES data(id) ON DELETE CASCADE,
+    vendor varchar(32) NULL,
+    level_dimensions jsonb NULL, -- [[width, height], ...] of every level, as reported by OpenSlide
+    tiles bigint NULL,
+    extracted_bytes bigint NULL,
+    input_bytes bigint NULL,
+    output_bytes bigint NULL,
+    peak_rss_bytes bigint NULL,
+    start_rss_bytes bigint NULL,
+    cpu_seconds double precision NULL,
+    concurrent_jobs integer NULL, -- most jobs measured at the same time while this one ran (including itself)
+    started_at timestamptz NOT NULL,
+    finished_at timestamptz NULL
+);
+CREATE INDEX job_resources_started_at_idx ON job_resources (started_at);
+CREATE INDEX job_resources_vendor_started_at_idx ON job_resources (vendor, started_at);
+
+-- conversion messages accepted from the broker (see job_intake.py). The message is acknowledged once it is
+-- stored here, the schedulers of all replicas order every pending job instead of the FIFO of the broker queue.
+-- No reference to data(id), the row is written before the message is validated by the converter.
+CREATE TABLE job_intake (
+    job_id uuid PRIMARY KEY,
+    body text NOT NULL,
+    user_id varchar(128) NULL,
+    expected_bytes bigint NOT NULL,
+    attempt integer NOT NULL DEFAULT 0,
+    received_at timestamptz NOT NULL DEFAULT now(),
+    not_before timestamptz NOT NULL DEFAULT now()
+);
+CREATE INDEX job_intake_not_before_idx ON job_intake (not_before);
+
+-- claim of a job by a converter replica, renewed by heartbeats (see job_lease.py)
+CREATE TABLE job_lease (
+    job_id uuid PRIMARY KEY REFERENCES data(id) ON DELETE CASCADE,
+    owner varchar(128) NOT NULL,
+    acquired_at timestamptz NOT NULL,
+    heartbeat_at timestamptz NOT NULL,
+    expires_at timestamptz NOT NULL,
+    attempts integer NOT NULL DEFAULT 1
+);
+CREATE INDEX job_lease_expires_at_idx ON job_lease (expires_at);
+
+-- stages (and whole jobs, stage 'job') which completed, skipped if the job is delivered again
+CREATE TABLE job_completion (
+    job_id uuid NOT NULL REFERENCES data(id) ON DELETE CASCADE,
+    stage varchar(32) NOT NULL,
+    completed_at timestamptz NOT NULL DEFAULT now(),
+    detail text NOT NULL DEFAULT '',
+    PRIMARY KEY (job_id, stage)
+);